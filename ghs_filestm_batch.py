@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Unpack several FILE.STMs at once, sharing worker processes and caches
+
+All STMs are unpacked concurrently through one pool of worker processes, so workers
+stay busy until all of them are done rather than idling at the end of each one. They
+share one cache directory: decompressed .sli contents are kept in it, and so is every
+converted file, which is copied into each output directory that contains the same
+contents. Contents that several STMs have in common are thereby only decompressed and
+converted once. With --hardlink, files are hard-linked rather than copied, so that
+they're also only stored once on disk.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+from sys import argv
+from typing import NamedTuple, Optional
+
+from ghs_filestm_unpack import (
+    GHSUnpackError,
+    check_stm_source,
+    default_dest,
+    unpack_stm,
+)
+from mymodules.ghsslicache import DEFAULT_MAX_SIZE, SLICache
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser()
+    parser.description = (
+        "Unpack several Gregory Horror Show FILE.STMs at once, sharing worker "
+        "processes and caches between them"
+    )
+    parser.add_argument(
+        metavar="FILE_STM",
+        dest="file_stm_paths",
+        nargs="*",
+        help="paths to the FILE.STMs to unpack. Each is unpacked into a directory "
+        "named as ghs_filestm_unpack.py would, numbered if several would have the "
+        "same name",
+    )
+    parser.add_argument(
+        "--job-file",
+        metavar="JOB_FILE",
+        dest="job_file",
+        help="text file listing FILE.STMs to unpack, one per line, each optionally "
+        "followed by a tab and the directory to unpack it into. Empty lines and lines "
+        "starting with # are ignored",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        dest="cache_dir",
+        default=".ghs_batch_cache",
+        help="directory of the shared caches, kept for later batches (default "
+        "%(default)s)",
+    )
+    parser.add_argument(
+        "--hardlink",
+        dest="hardlink",
+        action="store_true",
+        help="hard-link converted files from the cache directory into the output "
+        "directories instead of copying them, to store them only once. The cache "
+        "directory must be on the same drive as the output directories. Linked files "
+        "are read-only, since changing one would change all of them",
+    )
+    parser.add_argument(
+        "--sli-cache-size",
+        metavar="MB",
+        dest="sli_cache_size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="size limit of the decompressed .sli cache in megabytes (default "
+        "%(default)s)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes shared by all FILE.STMs (default: number of "
+        "CPUs)",
+    )
+    parser.add_argument(
+        "--raw-textures",
+        dest="raw_textures",
+        action="store_true",
+        help="see ghs_filestm_unpack.py",
+    )
+    parser.add_argument(
+        "--split-maps",
+        dest="split_maps",
+        action="store_true",
+        help="see ghs_filestm_unpack.py",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="print how much was unpacked, and how many .sli files were found in the "
+        "cache, for each FILE.STM",
+    )
+    return parser
+
+
+class BatchJob(NamedTuple):
+    source: str
+    dest: Optional[str] = None
+
+
+def main(args=tuple(argv[1:])):
+    """args: sequence of command line argument strings"""
+    parser = build_argparser()
+    parsed_args = parser.parse_args(args)
+
+    jobs = [BatchJob(path) for path in parsed_args.file_stm_paths]
+    if parsed_args.job_file is not None:
+        try:
+            jobs += read_job_file(parsed_args.job_file)
+        except OSError as e:
+            print(f"can't read job file: {e}", file=sys.stderr)
+            sys.exit(1)
+    if not jobs:
+        parser.error("no FILE.STMs given")
+
+    try:
+        results = unpack_batch(
+            jobs,
+            parsed_args.cache_dir,
+            jobs=parsed_args.jobs,
+            sli_cache_size=parsed_args.sli_cache_size * 1024 * 1024,
+            raw_textures=parsed_args.raw_textures,
+            split_maps=parsed_args.split_maps,
+            dedup_link=parsed_args.hardlink,
+        )
+    except GHSUnpackError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    failed = False
+    for job, result in zip(jobs, results):
+        if isinstance(result, GHSUnpackError):
+            print(f"{job.source}: {result}", file=sys.stderr)
+            failed = True
+        elif parsed_args.stats:
+            print(f"{job.source} -> {result.root_dir}")
+            for line in result.stats():
+                print(f"  {line}")
+    if failed:
+        sys.exit(1)
+
+
+def read_job_file(path) -> list[BatchJob]:
+    jobs = []
+    with open(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            source, _, dest = line.partition("\t")
+            jobs.append(BatchJob(source.strip(), dest.strip() or None))
+    return jobs
+
+
+def unpack_batch(
+    batch: list[BatchJob],
+    cache_dir,
+    *,
+    jobs: int = 1,
+    sli_cache_size: int = DEFAULT_MAX_SIZE,
+    **unpack_kwargs,
+) -> list:
+    """unpack all STM files in batch concurrently, with shared workers and caches
+
+    :param batch: the STMs to unpack. Those without a dest are unpacked into the
+        directory unpack_stm would choose, numbered if it would be the same as
+        another job's
+    :param cache_dir: directory to keep the decompressed .sli cache and the converted
+        files in, see unpack_stm's sli_cache and dedup_dir
+    :param jobs: number of worker processes shared by all STMs
+    :param unpack_kwargs: further options passed to unpack_stm
+    :return: an UnpackResult for each job, or the GHSUnpackError it failed with
+    :raises GHSUnpackError: if several jobs are given the same dest
+    """
+    cache_dir = Path(cache_dir)
+    sli_cache = SLICache(cache_dir / "sli", sli_cache_size)
+    dedup_dir = cache_dir / "files"
+    dests = batch_dests(batch)
+
+    def run(job: BatchJob, dest: str, executor=None):
+        try:
+            return unpack_stm(
+                job.source,
+                dest,
+                executor=executor,
+                jobs=jobs,
+                sli_cache=sli_cache,
+                dedup_dir=dedup_dir,
+                **unpack_kwargs,
+            )
+        except GHSUnpackError as e:
+            return e
+        except OSError as e:
+            return GHSUnpackError(str(e))
+
+    if jobs <= 1:
+        return [run(job, dest) for job, dest in zip(batch, dests)]
+
+    # concurrent.futures is only imported when it's needed, it's slow to import
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    # a thread per STM keeps feeding the shared process pool with that STM's items
+    with ProcessPoolExecutor(jobs) as executor, ThreadPoolExecutor(
+        len(batch)
+    ) as threads:
+        futures = [
+            threads.submit(run, job, dest, executor) for job, dest in zip(batch, dests)
+        ]
+        return [future.result() for future in futures]
+
+
+def batch_dests(batch: list[BatchJob]) -> list[str]:
+    """return the directory each job is unpacked into
+
+    :raises GHSUnpackError: if several jobs are given the same dest
+    """
+    # the given dests are kept as they are, so they're reserved first
+    taken = set()
+    for job in batch:
+        if job.dest is not None:
+            dest = os.path.normpath(job.dest)
+            if dest in taken:
+                raise GHSUnpackError(f"several jobs unpack into {job.dest}")
+            taken.add(dest)
+    dests = []
+    for job in batch:
+        if job.dest is not None:
+            dests.append(job.dest)
+            continue
+        try:
+            with open(job.source, "rb") as file_stm:
+                dest = default_dest(check_stm_source(file_stm, job.source))
+        except (OSError, GHSUnpackError):
+            dest = default_dest(0)  # unpack_stm reports the error
+        # number the ones that would be the same, GHS_EU_FILE_STM_2 and so on
+        numbered = dest
+        n = 1
+        while numbered in taken:
+            n += 1
+            numbered = f"{dest}_{n}"
+        taken.add(numbered)
+        dests.append(numbered)
+    return dests
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Pack edited files from an unpacked FILE.STM back into a new FILE.STM
+
+The directory must have been unpacked with ghs_filestm_unpack.py --manifest, which
+records every file written. Only the containers that contain edited files are rebuilt:
+everything else is copied from the original FILE.STM as it is, without being
+decompressed or converted.
+"""
+import argparse
+import mmap
+import os
+import shutil
+import sys
+from io import BytesIO
+from pathlib import Path
+from sys import argv
+from typing import Union
+
+from ghs_filestm_unpack import get_ext, vjoin
+from mymodules.common import BinaryCursor, atomic_write
+from mymodules.ghsmanifest import GHSManifestError, UnpackManifest
+from mymodules.ghssli import compress, decompress
+from mymodules.ghsstmcontainer import quickcheck_stm_file, read_stm_entries, write_stm
+from mymodules.ghsteximage import read_png_rgba, reencode_tex
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser()
+    parser.description = (
+        "Pack the edited files of an unpacked Gregory Horror Show FILE.STM back into "
+        "a new FILE.STM"
+    )
+    parser.add_argument(
+        metavar="FILE_STM",
+        dest="file_stm_path",
+        help="path to the original FILE.STM that was unpacked",
+    )
+    parser.add_argument(
+        metavar="UNPACKED_DIR",
+        dest="unpacked_dir",
+        help="directory FILE_STM was unpacked into with ghs_filestm_unpack.py "
+        "--manifest",
+    )
+    parser.add_argument(
+        metavar="OUTPUT_FILE_STM",
+        dest="output_path",
+        help="path to write the new FILE.STM to",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        help="list the edited files as they are packed",
+    )
+    return parser
+
+
+def main(args=tuple(argv[1:])):
+    """args: sequence of command line argument strings"""
+    parser = build_argparser()
+    parsed_args = parser.parse_args(args)
+    try:
+        packed = repack_stm(
+            parsed_args.file_stm_path,
+            parsed_args.unpacked_dir,
+            parsed_args.output_path,
+            verbose=parsed_args.verbose,
+        )
+    except GHSRepackError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if not packed:
+        print("No edited files, the original FILE.STM was copied as-is")
+
+
+class GHSRepackError(ValueError):
+    pass
+
+
+def repack_stm(
+    source: Union[str, os.PathLike],
+    unpacked_dir: Union[str, os.PathLike],
+    dest: Union[str, os.PathLike],
+    verbose: bool = False,
+) -> list[str]:
+    """write a copy of the STM file at source with the edited files from unpacked_dir
+
+    :param source: path to the original STM file
+    :param unpacked_dir: directory source was unpacked into, with a manifest
+    :param dest: path to write the new STM file to, may be the same as source
+    :param verbose: print the edited files as they are packed
+    :return: paths of the edited files that were packed, relative to unpacked_dir
+    :raises GHSRepackError: if unpacked_dir has no manifest or wasn't unpacked from
+        source, or an edited file can't be packed
+    """
+    try:
+        manifest = UnpackManifest.load(Path(unpacked_dir))
+        manifest.check_source(source)
+    except GHSManifestError as e:
+        raise GHSRepackError(
+            f"{e} (unpack it with ghs_filestm_unpack.py --manifest first)"
+        ) from e
+    changed = sorted(path for path in manifest.files if manifest.is_changed(path))
+    if not changed:
+        if os.path.abspath(source) != os.path.abspath(dest):
+            shutil.copyfile(source, dest)
+        return []
+
+    repacker = _Repacker(manifest, changed, verbose=verbose)
+    with open(source, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as stmdata:
+        if not quickcheck_stm_file(BinaryCursor(stmdata)):
+            raise GHSRepackError(f"{source} is not a valid STM file")
+        with memoryview(stmdata) as view:
+            contentfiles = repacker.rebuild_stm_contents(view, "")
+            try:
+                with atomic_write(dest) as outfile:
+                    write_stm(outfile, contentfiles)
+            finally:
+                release_views(contentfiles)
+    return changed
+
+
+def release_views(contentfiles: list) -> None:
+    """release the memoryviews among contentfiles, so their buffer can be closed"""
+    for data in contentfiles:
+        if isinstance(data, memoryview):
+            data.release()
+
+
+class _Repacker:
+    def __init__(self, manifest: UnpackManifest, changed: list, verbose: bool = False):
+        self.manifest = manifest
+        self.root_dir = manifest.root_dir
+        self.raw_textures = manifest.settings.get("raw_textures", False)
+        self.split_maps = manifest.settings.get("split_maps", False)
+        self.changed = changed
+        self.verbose = verbose
+
+    def changed_members(self, vdir: str) -> set[int]:
+        """return the indexes of the members of the STM at vdir with edited files"""
+        prefix = f"{vdir}/" if vdir else ""
+        indexes = set()
+        for path in self.changed:
+            if path.startswith(prefix):
+                name = path[len(prefix) :].split("/", 1)[0]
+                indexes.add(int(name.split(".", 1)[0], 16))
+        return indexes
+
+    def rebuild_stm_contents(self, stmview: memoryview, vdir: str) -> list:
+        """return the content files of the STM at vdir, with edited members rebuilt
+
+        Unchanged members are memoryview slices of stmview, which the caller must
+        release.
+        """
+        entries = read_stm_entries(BinaryCursor(stmview))
+        to_rebuild = self.changed_members(vdir)
+        contentfiles = []
+        try:
+            for i, (offset, size) in enumerate(entries):
+                member = stmview[offset : offset + size]
+                if i in to_rebuild:
+                    with member:
+                        data = self.rebuild_member(bytes(member), vdir, i)
+                    contentfiles.append(data)
+                else:
+                    contentfiles.append(member)
+        except BaseException:
+            release_views(contentfiles)
+            raise
+        return contentfiles
+
+    def rebuild_stm(self, data: bytes, vdir: str) -> bytes:
+        with memoryview(data) as view:
+            contentfiles = self.rebuild_stm_contents(view, vdir)
+            out = BytesIO()
+            try:
+                write_stm(out, contentfiles)
+            finally:
+                release_views(contentfiles)
+        return out.getvalue()
+
+    def rebuild_member(self, data: bytes, vdir: str, i: int, from_sli=False) -> bytes:
+        """return the new data of member i of the STM at vdir"""
+        ext = get_ext(data, BinaryCursor(data), from_sli=from_sli)
+        if ext == "sli":
+            decompressed = bytes(decompress(data))
+            return compress(self.rebuild_member(decompressed, vdir, i, from_sli=True))
+
+        dot_sli = ".sli" if from_sli else ""
+        vpath = vjoin(vdir, f"{i:03x}{dot_sli}.{ext}")
+        if ext == "stm":
+            return self.rebuild_stm(data, vpath)
+        elif ext in ("map-pm2", "map-atr") and self.split_maps:
+            raise GHSRepackError(
+                f"can't pack edited cells of {vpath}, maps unpacked with --split-maps "
+                "can't be packed back"
+            )
+        elif ext in ("tex", "tex2") and not self.raw_textures:
+            return self.rebuild_tex(data, vpath, tex2=(ext == "tex2"))
+        if vpath not in self.changed:
+            return data
+        if self.verbose:
+            print(vpath)
+        with open(self.root_dir / vpath, "rb") as file:
+            return file.read()
+
+    def rebuild_tex(self, data: bytes, vpath: str, tex2: bool) -> bytes:
+        """return the texture data with the edited .png files' pixels"""
+        replacements = {}
+        for path in self.changed:
+            if path.startswith(f"{vpath}/"):
+                if self.verbose:
+                    print(path)
+                pngname = path[len(vpath) + 1 :]
+                tex_i = int(pngname.split("_", 1)[0], 16)
+                replacements[tex_i] = read_png_rgba(self.root_dir / path)
+        try:
+            return reencode_tex(data, tex2, replacements)
+        except ValueError as e:
+            raise GHSRepackError(f"can't pack {vpath}: {e}") from e
+
+
+if __name__ == "__main__":
+    main()
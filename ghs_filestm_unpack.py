@@ -1,29 +1,99 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
+import mmap
 import os
+import re
+import shutil
 import sys
-from io import SEEK_END, BytesIO
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from io import SEEK_END
 from pathlib import Path
 from sys import argv
-from typing import BinaryIO, Optional
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
-from mymodules.common import is_eof
-from mymodules.ghsmap import GHSMap, quickcheck_mapx_file
-from mymodules.ghsmeshposrot import quickcheck_mpr_file, quickcheck_mpr_forcedfloat_file
-from mymodules.ghssli import decompress
+from mymodules.common import BinaryCursor, atomic_write, reading
+from mymodules.ghsindex import IndexWriter
+from mymodules.ghsjournal import JOURNAL_NAME, GHSJournalError, UnpackJournal
+from mymodules.ghsmanifest import (
+    GHSManifestError,
+    UnpackManifest,
+    hash_file,
+    source_identity,
+)
+from mymodules.ghsmemory import estimate_item_memory, format_size, peak_rss
+from mymodules.ghsmap import GHSMap, GHSMapX, quickcheck_mapx_file
+from mymodules.ghsmeshposrot import detect_mpr_layout
+from mymodules.ghspathfilter import PathFilter
+from mymodules.ghsprofile import (
+    MemberProfile,
+    MemberProfiler,
+    summary_lines,
+    write_summary,
+)
+from mymodules.ghsprogress import (
+    EventBatcher,
+    JSONLinesSink,
+    ListingSink,
+    MemberCompletion,
+    ProgressBarSink,
+)
+from mymodules.ghssli import decompress, read_decompressed_size
+from mymodules.ghsslicache import DEFAULT_MAX_SIZE, SLICache
 from mymodules.ghsstmcontainer import (
-    GHSStmContainer,
     quickcheck_stm_file,
     quickget_num_contentfiles_from_stm,
+    read_stm_entries,
 )
 from mymodules.ghsteximage import (
-    GHSTexExtraDataException,
-    GHSTexImageSingle,
     quickcheck_tex2_file,
     quickcheck_tex_file,
+    read_tex_headers,
+    read_tex_images,
+)
+from mymodules.ghsworkqueue import (
+    SCHEDULING_POLICIES,
+    FileSlice,
+    WorkItem,
+    WorkQueue,
+    subsource,
 )
 
+if TYPE_CHECKING:
+    # concurrent.futures is only imported when it's needed, it's slow to import
+    from concurrent.futures import Executor
+
+# extensions of everything that isn't a container, in other words file types
+FILE_TYPES = (
+    "pm2",
+    "atr",
+    "sdw",
+    "tex",
+    "tex2",
+    "mpr",
+    "map-pm2",
+    "map-atr",
+    "dat",
+    "000",
+    "fff",
+)
+# file types that can come out of a .sli
+SLI_FILE_TYPES = ("tex", "tex2", "dat", "000", "fff")
+
 
 def build_argparser():
     parser = argparse.ArgumentParser()
@@ -51,16 +121,172 @@ def build_argparser():
         action="store_true",
         help="list contents as they are unpacked",
     )
+    parser.add_argument(
+        "--progress",
+        dest="progress",
+        action="store_true",
+        help="show a progress bar with the estimated time remaining",
+    )
+    parser.add_argument(
+        "--progress-fd",
+        metavar="FD",
+        dest="progress_fd",
+        type=int,
+        help="write a line of JSON for each unpacked item to file descriptor FD, "
+        "followed by a final line with the number of items",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        dest="list",
+        action="store_true",
+        help="only list the contents that would be unpacked, without writing "
+        "anything. Textures are listed as .tex/.tex2 files (see --raw-textures)",
+    )
+    parser.add_argument(
+        "--index",
+        metavar="INDEX_FILE",
+        dest="index_path",
+        help="instead of unpacking, write an SQLite index of all contents (paths, "
+        "types, offsets, sizes, hashes and texture formats) to INDEX_FILE, which "
+        "ghs_query_index.py can search",
+    )
+    parser.add_argument(
+        "--raw-textures",
+        "--no-textures",
+        dest="raw_textures",
+        action="store_true",
+        help="don't convert textures to .png files, write the .tex/.tex2 files as-is "
+        "instead. This is much faster and doesn't require Pillow",
+    )
+    parser.add_argument(
+        "--split-maps",
+        dest="split_maps",
+        action="store_true",
+        help="write each cell of .map-pm2/.map-atr files as a separate file, named "
+        "after the cell's row and column",
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        action="store_true",
+        help="record the hashes of all files written, so that the edited files can be "
+        "found and packed back into a new FILE.STM with ghs_filestm_repack.py",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="continue an earlier unpack that was interrupted, skipping everything "
+        "it already finished. It must have used the same directory and the same "
+        "--include/--exclude/--types/--raw-textures settings, and the same unmodified "
+        "FILE.STM",
+    )
+    parser.add_argument(
+        "--sli-cache",
+        metavar="DIR",
+        dest="sli_cache_dir",
+        help="keep decompressed .sli contents in DIR, so that later unpacks (and other "
+        "tools using the same DIR) don't have to decompress them again",
+    )
+    parser.add_argument(
+        "--sli-cache-size",
+        metavar="MB",
+        dest="sli_cache_size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="size limit of the --sli-cache directory in megabytes, the least recently "
+        "used contents are removed beyond it (default %(default)s)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        metavar="MB",
+        dest="max_memory",
+        type=int,
+        help="keep the estimated memory use of the items being unpacked at once below "
+        "MB megabytes, and decompress large .sli files into temporary files rather "
+        "than into memory",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="print how many items were unpacked, how many .sli files were found "
+        "in the --sli-cache, and the peak memory use (RSS) after each stage",
+    )
+    parser.add_argument(
+        "--profile-member",
+        metavar="GLOB",
+        dest="profile_members",
+        action="append",
+        default=[],
+        help="profile unpacking the contents whose path matches GLOB (same as "
+        "--include) with cProfile and tracemalloc, and rank them by time and memory "
+        "use. Can be given multiple times",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        metavar="DIR",
+        dest="profile_dir",
+        help="directory to write a .prof and a .tracemalloc file per profiled content "
+        "to, and a summary.txt ranking them (default: the output directory's name "
+        "followed by _profile)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="unpack using N worker processes (default 1)",
+    )
+    parser.add_argument(
+        "--order",
+        dest="order",
+        choices=tuple(SCHEDULING_POLICIES),
+        default="depth",
+        help="order in which nested contents are unpacked: depth-first (default, "
+        "same order as FILE.STM), breadth-first, or largest-first",
+    )
+    parser.add_argument(
+        "--include",
+        metavar="GLOB",
+        dest="include",
+        action="append",
+        default=[],
+        help="only unpack contents whose path (relative to the output directory) "
+        "matches GLOB, e.g. '029.stm/**' or '0aa.stm/*.sli.tex'. "
+        "'**' matches any number of directories. Can be given multiple times",
+    )
+    parser.add_argument(
+        "--exclude",
+        metavar="GLOB",
+        dest="exclude",
+        action="append",
+        default=[],
+        help="don't unpack contents whose path matches GLOB. Can be given multiple "
+        "times",
+    )
+    parser.add_argument(
+        "--types",
+        metavar="TYPES",
+        dest="types",
+        type=parse_types,
+        help="only unpack files of these types, as a comma-separated list of "
+        f"extensions. Possible types: {','.join(FILE_TYPES)}",
+    )
     return parser
 
 
-def vindent(num: int) -> str:
-    """verbose indent. Return the str of whitespace with which to indent verbose output
-
-    :param num: indentation level
-    :return: str of whitespace with which to indent verbose output
-    """
-    return "  " * num
+def parse_types(types_str: str) -> frozenset[str]:
+    types = frozenset(t.strip().lower() for t in types_str.split(",") if t.strip())
+    unknown_types = types.difference(FILE_TYPES)
+    if unknown_types:
+        raise argparse.ArgumentTypeError(
+            f"unknown types {','.join(sorted(unknown_types))}"
+        )
+    return types
 
 
 def main(args=tuple(argv[1:])):
@@ -68,189 +294,1131 @@ def main(args=tuple(argv[1:])):
     parser = build_argparser()
     parsed_args = parser.parse_args(args)
 
-    file_stm_path = parsed_args.file_stm_path
-    alternate_dir = parsed_args.alternate_dir
-    verbose = parsed_args.verbose
-    vindentlvl = 0  # verbose output indentation level
+    pathfilter = None
+    if parsed_args.include or parsed_args.exclude or parsed_args.types is not None:
+        pathfilter = PathFilter(
+            parsed_args.include, parsed_args.exclude, parsed_args.types
+        )
 
-    with open(file_stm_path, "rb") as file_stm:
-        if not quickcheck_stm_file(file_stm):
-            print(f"{file_stm_path} is not a valid STM file", file=sys.stderr)
-            sys.exit(1)
+    sli_cache = None
+    if parsed_args.sli_cache_dir is not None:
+        sli_cache = SLICache(
+            parsed_args.sli_cache_dir, parsed_args.sli_cache_size * 1024 * 1024
+        )
 
-        num_contentfiles = quickget_num_contentfiles_from_stm(file_stm)
-        if alternate_dir is None:
-            if num_contentfiles == 300:
-                root_dir = "GHS_EU_FILE_STM"
-            elif num_contentfiles == 212:
-                root_dir = "GHS_JP_FILE_STM"
-            else:
-                root_dir = "GHS_UNK_FILE_STM"
-        else:
-            root_dir = alternate_dir
-        root_dir = Path(root_dir)
-        os.makedirs(root_dir, exist_ok=True)
-        process_stm(
-            file_stm,
-            root_dir,
-            subdirname_idx=None,
-            verbose=verbose,
-            vindentlvl=vindentlvl,
+    indexing = parsed_args.index_path is not None
+    if indexing:
+        # options that only apply to unpacking, which --index would ignore
+        unpack_options = {
+            "-d": "alternate_dir",
+            "-l": "list",
+            "--raw-textures": "raw_textures",
+            "--split-maps": "split_maps",
+            "--manifest": "manifest",
+            "--resume": "resume",
+            "--max-memory": "max_memory",
+            "--profile-member": "profile_members",
+            "--profile-dir": "profile_dir",
+            "-j": "jobs",
+            "--order": "order",
+            "--include": "include",
+            "--exclude": "exclude",
+            "--types": "types",
+        }
+        used = [
+            option
+            for option, dest in unpack_options.items()
+            if getattr(parsed_args, dest) != parser.get_default(dest)
+        ]
+        if used:
+            parser.error(f"--index can't be combined with {', '.join(used)}")
+
+    sinks = []
+    if parsed_args.list:
+        sinks.append(ListingSink(outputs_only=True))
+    elif parsed_args.verbose:
+        # the index goes through containers' members before nested contents, and
+        # unpacking only goes in tree order depth-first in a single process
+        in_order = (
+            not indexing and parsed_args.jobs <= 1 and parsed_args.order == "depth"
         )
+        sinks.append(ListingSink(full_paths=not in_order))
+    if parsed_args.progress:
+        sinks.append(ProgressBarSink())
+    if parsed_args.progress_fd is not None:
+        try:
+            sinks.append(JSONLinesSink(parsed_args.progress_fd))
+        except OSError as e:
+            parser.error(f"--progress-fd: {e}")
 
+    if indexing:
+        try:
+            with EventBatcher(sinks) as batcher:
+                num_members = index_stm(
+                    parsed_args.file_stm_path,
+                    parsed_args.index_path,
+                    sli_cache=sli_cache,
+                    on_event=batcher if sinks else None,
+                )
+        except GHSUnpackError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if parsed_args.stats:
+            print(f"index: {num_members} contents")
+            if sli_cache is not None:
+                print(*sli_cache.stats(), sep="\n")
+        return
 
-def process_stm(
-    file: BinaryIO,
-    outdir: Path,
-    subdirname_idx: Optional[int],
-    from_sli: bool = False,
+    try:
+        with EventBatcher(sinks) as batcher:
+            result = unpack_stm(
+                parsed_args.file_stm_path,
+                parsed_args.alternate_dir,
+                jobs=parsed_args.jobs,
+                filters=pathfilter,
+                on_event=batcher if sinks else None,
+                order=parsed_args.order,
+                raw_textures=parsed_args.raw_textures or parsed_args.list,
+                dry_run=parsed_args.list,
+                resume=parsed_args.resume,
+                split_maps=parsed_args.split_maps,
+                manifest=parsed_args.manifest,
+                sli_cache=sli_cache,
+                max_memory=(
+                    None
+                    if parsed_args.max_memory is None
+                    else parsed_args.max_memory * 1024 * 1024
+                ),
+                profile_members=parsed_args.profile_members,
+                profile_dir=parsed_args.profile_dir,
+            )
+    except GHSUnpackError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if parsed_args.stats:
+        for line in result.stats():
+            print(line)
+    if result.profiles:
+        print(*summary_lines(result.profiles, top=10), sep="\n")
+
+
+class GHSUnpackError(ValueError):
+    pass
+
+
+class UnpackOptions(NamedTuple):
+    """settings shared by all items of one unpack, passed along to worker processes"""
+
+    root_dir: Path
+    pathfilter: Optional[PathFilter] = None
+    raw_textures: bool = False  # write textures as-is instead of converting them
+    dry_run: bool = False  # don't write anything
+    split_maps: bool = False  # write each cell of MAP files separately
+    sli_cache: Optional[SLICache] = None  # where to cache decompressed .sli contents
+    dedup_dir: Optional[Path] = None  # see link_deduplicated
+    dedup_link: bool = False  # hard-link files from dedup_dir instead of copying them
+    # .sli contents at least spill_size bytes large are decompressed into temporary
+    # files in spill_dir instead of into memory
+    spill_dir: Optional[Path] = None
+    spill_size: int = 0
+    # items whose vpath profile_filter matches are profiled into profile_dir
+    profile_filter: Optional[PathFilter] = None
+    profile_dir: Optional[Path] = None
+
+
+class UnpackEvent(NamedTuple):
+    """passed to unpack_stm's on_event after each item has been unpacked
+
+    vpath: the item's path relative to the root dir, "" for the root container
+    filetype: the item's file type, or "stm"/"sli" for containers
+    size: size of the item's data in bytes
+    outputs: paths of the files written for the item, relative to the root dir
+    sli_cache_hit: for a .sli, whether its contents came from the sli cache. None if
+        it isn't a .sli or no sli cache is used
+    peak_rss: the peak RSS of the process that unpacked the item, right after it was
+        unpacked, in bytes. None where that can't be measured (on Windows)
+    peak_rss_increase: by how much unpacking the item raised that peak
+    started: when unpacking the item started, as a time.time() timestamp
+    duration: how long unpacking the item took in seconds
+    profile: the item's MemberProfile, if it was profiled
+    completed_size: total size in bytes of the top-level members of the STM that
+        have been unpacked completely since the previous event, see MemberCompletion
+    """
+
+    vpath: str
+    filetype: str
+    size: int
+    outputs: tuple[str, ...] = ()
+    sli_cache_hit: Optional[bool] = None
+    peak_rss: Optional[int] = None
+    peak_rss_increase: int = 0
+    started: float = 0.0
+    duration: float = 0.0
+    profile: Optional[MemberProfile] = None
+    completed_size: int = 0
+
+
+class ItemResult(NamedTuple):
+    children: list[WorkItem]
+    event: Optional[UnpackEvent] = None  # None if the item was filtered out
+
+
+@dataclass
+class UnpackResult:
+    """returned by unpack_stm
+
+    root_dir: directory the contents were unpacked into
+    num_items: number of items (files and containers) that were unpacked
+    outputs: paths of all files written, relative to root_dir
+    sli_cache_hits, sli_cache_misses: how many .sli files were found in the sli cache,
+        and how many had to be decompressed
+    peak_rss: for each stage (file type), the highest peak RSS of any process right
+        after unpacking an item of that type, in bytes
+    peak_rss_raised: for each stage, by how much its items raised their process's
+        peak RSS in total, which shows the stages that need the most memory
+    profiles: a MemberProfile for each profiled item
+    """
+
+    root_dir: Path
+    num_items: int = 0
+    outputs: list[str] = field(default_factory=list)
+    sli_cache_hits: int = 0
+    sli_cache_misses: int = 0
+    peak_rss: dict[str, int] = field(default_factory=dict)
+    peak_rss_raised: dict[str, int] = field(default_factory=dict)
+    profiles: list[MemberProfile] = field(default_factory=list)
+
+    def stats(self) -> list[str]:
+        lines = [
+            f"items: {self.num_items} unpacked, {len(self.outputs)} files written",
+            f"sli cache: {self.sli_cache_hits} hits, {self.sli_cache_misses} misses",
+        ]
+        for stage, rss in sorted(self.peak_rss.items()):
+            raised = format_size(self.peak_rss_raised.get(stage, 0))
+            lines.append(
+                f"peak rss after {stage}: {format_size(rss)} (raised by {raised})"
+            )
+        return lines
+
+
+def unpack_stm(
+    source: Union[str, os.PathLike, bytes, bytearray, memoryview],
+    dest: Union[str, os.PathLike, None] = None,
+    *,
+    jobs: int = 1,
+    filters: Optional[PathFilter] = None,
+    on_event: Optional[Callable[[UnpackEvent], None]] = None,
+    order: str = "depth",
+    executor: Optional["Executor"] = None,
+    raw_textures: bool = False,
+    dry_run: bool = False,
+    resume: bool = False,
+    split_maps: bool = False,
+    manifest: bool = False,
+    sli_cache: Union[SLICache, str, os.PathLike, None] = None,
+    dedup_dir: Union[str, os.PathLike, None] = None,
+    dedup_link: bool = False,
+    max_memory: Optional[int] = None,
+    profile_members: Iterable[str] = (),
+    profile_dir: Union[str, os.PathLike, None] = None,
     verbose: bool = False,
-    vindentlvl: int = 0,
-):
-    if subdirname_idx is not None:
-        dot_sli = ".sli" if from_sli else ""
-        outname = f"{subdirname_idx:03x}{dot_sli}.stm"
-        outdir /= outname
-        if verbose:
-            print(f"{vindent(vindentlvl)}{outname}")
-        os.makedirs(outdir, exist_ok=True)
+) -> UnpackResult:
+    """unpack an STM container such as FILE.STM, including all nested contents
 
-    stmcontainer = GHSStmContainer.from_stmfile(file)
-    for i, contentdata in enumerate(stmcontainer):
-        contentfile = BytesIO(contentdata)
-        if contentdata.startswith(b"SLI"):
-            process_sli(
-                contentfile, outdir, i, verbose=verbose, vindentlvl=vindentlvl + 1
+    :param source: path to the STM file, or the STM file's data
+    :param dest: directory to unpack into. By default, this is GHS_EU_FILE_STM or
+        GHS_JP_FILE_STM depending on which version source comes from
+    :param jobs: number of worker processes to unpack with. If executor is given,
+        the number of items to keep submitted to it at once instead
+    :param filters: if given, only contents that pass this PathFilter are unpacked
+    :param on_event: called with an UnpackEvent after each item has been unpacked,
+        such as an EventBatcher from mymodules.ghsprogress
+    :param order: scheduling policy, one of the keys of SCHEDULING_POLICIES
+    :param executor: a concurrent.futures.Executor to unpack with, such as a
+        ProcessPoolExecutor. Its workers stay alive after returning, so passing the
+        same executor to multiple calls avoids starting new worker processes each time
+    :param raw_textures: write .tex/.tex2 files as-is instead of converting them to
+        .png files. This skips all texture decoding, and doesn't require Pillow
+    :param dry_run: don't write anything, only report what would be written
+    :param resume: continue an earlier unpack into dest that was interrupted. While
+        unpacking, a journal of completed items is kept in dest, which is removed
+        once the unpack finishes. Only an unpack of the same, unmodified source can
+        be resumed, and the temporary files the interrupted one left are removed
+    :param split_maps: write each cell of .map-pm2/.map-atr files as a separate file
+    :param manifest: record the size, modification time and hash of every file
+        written in a manifest in dest, which ghs_filestm_repack.py uses to find out
+        which files were edited
+    :param sli_cache: an SLICache, or the directory of one, to keep decompressed .sli
+        contents in. Every .sli found in it is loaded from it instead of being
+        decompressed again
+    :param dedup_dir: if given, each file is converted into this directory once, and
+        copied into dest from there. Contents that are the same as ones unpacked
+        earlier (from any STM, using the same dedup_dir) are only copied
+    :param dedup_link: hard-link files from dedup_dir instead of copying them, which
+        saves the space but makes every unpacked copy of a file the same file.
+        dedup_dir must then be on the same file system as dest, otherwise files are
+        copied anyway
+    :param max_memory: memory budget in bytes. Items are only submitted to workers
+        while the estimated memory of all submitted items fits in it, and .sli
+        contents too large to fit in a worker's share of it are decompressed into
+        temporary files in dest instead of into memory
+    :param profile_members: glob patterns (see PathFilter) of contents to profile
+        with a MemberProfiler from mymodules.ghsprofile
+    :param profile_dir: directory to write the profiles and their summary to. By
+        default, dest's name followed by _profile
+    :param verbose: list contents as they are unpacked, through a ListingSink
+    :return: an UnpackResult
+    :raises GHSUnpackError: if source is not a valid STM file, or if resuming an
+        unpack that used different settings or a different source
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        root_source = bytes(source)
+        num_contentfiles = check_stm_source(BinaryCursor(root_source), "source")
+        fingerprint = source_fingerprint(BinaryCursor(root_source), len(root_source))
+    else:
+        path = os.fspath(source)
+        with open(path, "rb") as file_stm:
+            num_contentfiles = check_stm_source(file_stm, path)
+            file_stm_size = file_stm.seek(0, SEEK_END)
+            file_stm.seek(0)
+            fingerprint = source_fingerprint(
+                file_stm, file_stm_size, os.fstat(file_stm.fileno()).st_mtime_ns
             )
-        elif contentdata.startswith(b"MAP"):
-            process_map(
-                contentfile, outdir, i, verbose=verbose, vindentlvl=vindentlvl + 1
+        root_source = FileSlice(path, 0, file_stm_size)
+
+    if dest is None:
+        dest = default_dest(num_contentfiles)
+    root_dir = Path(dest)
+    if not dry_run:
+        os.makedirs(root_dir, exist_ok=True)
+
+    if sli_cache is not None and not isinstance(sli_cache, SLICache):
+        sli_cache = SLICache(sli_cache)
+
+    queue = SCHEDULING_POLICIES[order]()
+    queue.push(WorkItem("", None, root_source))
+    options = UnpackOptions(
+        root_dir,
+        pathfilter=filters,
+        raw_textures=raw_textures,
+        dry_run=dry_run,
+        split_maps=split_maps,
+        sli_cache=sli_cache,
+        dedup_dir=None if dedup_dir is None else Path(dedup_dir),
+        dedup_link=dedup_link,
+    )
+    profile_members = list(profile_members)
+    if profile_members:
+        if profile_dir is None:
+            profile_dir = root_dir.with_name(f"{root_dir.name}_profile")
+        options = options._replace(
+            profile_filter=PathFilter(profile_members), profile_dir=Path(profile_dir)
+        )
+    result = UnpackResult(root_dir)
+    listing = None
+    if verbose:
+        # contents only arrive in tree order depth-first in a single process
+        in_order = executor is None and jobs <= 1 and order == "depth"
+        listing = EventBatcher([ListingSink(full_paths=not in_order)])
+        if on_event is not None:
+            caller_on_event = on_event
+
+            def on_event(event: UnpackEvent):
+                caller_on_event(event)
+                listing(event)
+
+        else:
+            on_event = listing
+
+    journal = None
+    if not dry_run:
+        settings = repr(
+            {
+                "include": [p.pattern for p in filters.include] if filters else [],
+                "exclude": [p.pattern for p in filters.exclude] if filters else [],
+                "types": sorted(filters.types) if filters and filters.types else None,
+                "raw_textures": raw_textures,
+                "split_maps": split_maps,
+                "source": fingerprint,
+            }
+        )
+        try:
+            journal = UnpackJournal(root_dir / JOURNAL_NAME, settings, resume=resume)
+        except GHSJournalError as e:
+            raise GHSUnpackError(str(e)) from e
+        if resume:
+            remove_leftover_tmp_files(root_dir)
+    # only now, so that cleaning up after an interrupted unpack doesn't remove it
+    if max_memory is not None and not dry_run:
+        spill_dir = Path(tempfile.mkdtemp(prefix=".spill.", dir=root_dir))
+        options = options._replace(
+            spill_dir=spill_dir, spill_size=max_memory // (2 * max(jobs, 1))
+        )
+
+    unpack_manifest = None
+    if manifest and not dry_run:
+        manifest_settings = {
+            "raw_textures": raw_textures,
+            "split_maps": split_maps,
+            "source": source_identity(
+                root_source if isinstance(root_source, bytes) else path
+            ),
+        }
+        unpack_manifest = UnpackManifest(root_dir, manifest_settings)
+        if resume:
+            try:
+                previous = UnpackManifest.load(root_dir)
+            except GHSManifestError:
+                pass
+            else:
+                if previous.settings == manifest_settings:
+                    unpack_manifest.files = previous.files
+
+    try:
+        if executor is None and jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(jobs) as executor:
+                events = process_queue(
+                    queue,
+                    options,
+                    executor=executor,
+                    jobs=jobs,
+                    journal=journal,
+                    max_memory=max_memory,
+                )
+                collect_events(events, result, on_event)
+        else:
+            events = process_queue(
+                queue,
+                options,
+                executor=executor,
+                jobs=jobs,
+                journal=journal,
+                max_memory=max_memory,
             )
-        elif contentdata.startswith(b"PM2"):
-            process_file_with_ext(
-                contentfile,
-                "pm2",
-                outdir,
-                i,
-                verbose=verbose,
-                vindentlvl=vindentlvl + 1,
+            collect_events(events, result, on_event)
+    except BaseException:
+        if journal is not None:
+            journal.close()
+        raise
+    finally:
+        if listing is not None:
+            listing.close()
+        if result.profiles:
+            write_summary(result.profiles, options.profile_dir)
+        if options.spill_dir is not None:
+            shutil.rmtree(options.spill_dir, ignore_errors=True)
+        # also when interrupted, so that a resumed unpack's manifest is complete
+        if unpack_manifest is not None:
+            unpack_manifest.add(result.outputs)
+            unpack_manifest.save()
+    if journal is not None:
+        journal.close(remove=True)
+    return result
+
+
+def default_dest(num_contentfiles: int) -> str:
+    """return the directory an STM with num_contentfiles is unpacked into by default"""
+    if num_contentfiles == 300:
+        return "GHS_EU_FILE_STM"
+    elif num_contentfiles == 212:
+        return "GHS_JP_FILE_STM"
+    else:
+        return "GHS_UNK_FILE_STM"
+
+
+def index_stm(
+    source: Union[str, os.PathLike],
+    index_path: Union[str, os.PathLike],
+    *,
+    sli_cache: Optional[SLICache] = None,
+    on_event: Optional[Callable[[UnpackEvent], None]] = None,
+    verbose: bool = False,
+) -> int:
+    """write an SQLite index of all contents of an STM file, see mymodules.ghsindex
+
+    Every .sli is decompressed to find out what it contains, but nothing other than
+    the index is written. Textures' metadata is read from their headers.
+
+    :param source: path to the STM file
+    :param index_path: path to write the index to, replaced if it exists
+    :param sli_cache: if given, .sli contents are decompressed through it
+    :param on_event: called with an UnpackEvent for each content indexed, the same
+        as unpack_stm's. Containers' members are indexed before the contents of
+        nested containers, so not in tree order
+    :param verbose: list contents as they are indexed, through a ListingSink
+    :return: the number of contents indexed
+    :raises GHSUnpackError: if source is not a valid STM file
+    """
+    path = os.fspath(source)
+    if verbose:
+        with EventBatcher([ListingSink(full_paths=True)]) as listing:
+            if on_event is not None:
+                caller_on_event = on_event
+
+                def on_event(event: UnpackEvent):
+                    caller_on_event(event)
+                    listing(event)
+
+            else:
+                on_event = listing
+            return index_stm(source, index_path, sli_cache=sli_cache, on_event=on_event)
+
+    writer = IndexWriter()
+    with open(path, "rb") as file_stm:
+        check_stm_source(file_stm, path)
+        with mmap.mmap(file_stm.fileno(), 0, access=mmap.ACCESS_READ) as stmdata:
+            if on_event is not None:
+                on_event(UnpackEvent("", "stm", len(stmdata)))
+            completion = MemberCompletion()
+            # (vdir, data, offset of data in the STM file or None, size in its parent)
+            stack = [("", stmdata, 0, len(stmdata))]
+            while stack:
+                vdir, data, file_offset, container_size = stack.pop()
+                entries = read_stm_entries(BinaryCursor(data))
+                completion.finish(vdir, len(entries), container_size)
+                children = []
+                for i, (offset, size) in enumerate(entries):
+                    contentdata = bytes(data[offset : offset + size])
+                    from_sli = contentdata.startswith(b"SLI")
+                    decompressed_size = None
+                    if from_sli:
+                        if on_event is not None:
+                            sli_vpath = vjoin(vdir, f"{i:03x}.sli")
+                            on_event(UnpackEvent(sli_vpath, "sli", size))
+                        # a view, so that a cache hit's mmap isn't copied
+                        contentdata = memoryview(
+                            decompress(contentdata, cache=sli_cache)
+                        )
+                        decompressed_size = len(contentdata)
+                    contentfile = BinaryCursor(contentdata)
+                    ext = get_ext(contentdata, contentfile, from_sli=from_sli)
+                    dot_sli = ".sli" if from_sli else ""
+                    vpath = vjoin(vdir, f"{i:03x}{dot_sli}.{ext}")
+                    if ext != "stm":  # containers are finished once they're indexed
+                        completion.finish(vpath, 0, size)
+                    if on_event is not None:
+                        on_event(
+                            UnpackEvent(
+                                vpath,
+                                ext,
+                                len(contentdata),
+                                completed_size=completion.take(),
+                            )
+                        )
+                    member_file_offset = None
+                    if file_offset is not None and not from_sli:
+                        member_file_offset = file_offset + offset
+                    writer.add_member(
+                        vpath,
+                        vdir,
+                        i,
+                        ext,
+                        offset,
+                        member_file_offset,
+                        size,
+                        decompressed_size,
+                        hashlib.sha1(contentdata).hexdigest(),
+                    )
+                    if ext == "stm":
+                        children.append((vpath, contentdata, member_file_offset, size))
+                    elif ext in ("tex", "tex2"):
+                        writer.add_textures(
+                            vpath, read_tex_headers(contentfile, tex2=(ext == "tex2"))
+                        )
+                # reversed, so that containers are indexed in the same order as FILE.STM
+                stack.extend(reversed(children))
+                del data
+    writer.write(index_path, source_name=os.path.basename(path))
+    return len(writer.members)
+
+
+def check_stm_source(file_stm: BinaryIO, name: str) -> int:
+    """make sure file_stm is an STM file, return the number of content files in it"""
+    cursor = BinaryCursor.from_file(file_stm)
+    if not quickcheck_stm_file(cursor):
+        raise GHSUnpackError(f"{name} is not a valid STM file")
+    return quickget_num_contentfiles_from_stm(cursor)
+
+
+def source_fingerprint(
+    file_stm: BinaryIO, size: int, mtime_ns: Optional[int] = None
+) -> dict:
+    """return what identifies an STM file, so that an unpack of it isn't resumed from
+    a different or modified one: its size, modification time (if it's a file) and a
+    hash of its offset/size table
+
+    :param file_stm: the STM file, with its read position at the start
+    """
+    entries = read_stm_entries(file_stm)
+    table_sha1 = hashlib.sha1(repr(entries).encode()).hexdigest()
+    return {"size": size, "mtime_ns": mtime_ns, "table_sha1": table_sha1}
+
+
+# temporary files and directories of atomic_write, copy_file and spill_sli
+_LEFTOVER_TMP_RE = re.compile(r"^\..+\.\d+\.tmp$|^\.spill\.")
+
+
+def remove_leftover_tmp_files(root_dir: Path) -> None:
+    """remove the temporary files an interrupted unpack into root_dir left behind"""
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        for name in filenames:
+            if _LEFTOVER_TMP_RE.match(name):
+                os.remove(os.path.join(dirpath, name))
+        for name in list(dirnames):
+            if _LEFTOVER_TMP_RE.match(name):
+                shutil.rmtree(os.path.join(dirpath, name), ignore_errors=True)
+                dirnames.remove(name)
+
+
+def collect_events(
+    events: Iterable[UnpackEvent],
+    result: UnpackResult,
+    on_event: Optional[Callable[[UnpackEvent], None]] = None,
+):
+    for event in events:
+        result.num_items += 1
+        result.outputs.extend(event.outputs)
+        if event.sli_cache_hit is not None:
+            if event.sli_cache_hit:
+                result.sli_cache_hits += 1
+            else:
+                result.sli_cache_misses += 1
+        if event.peak_rss is not None:
+            stage = event.filetype
+            result.peak_rss[stage] = max(result.peak_rss.get(stage, 0), event.peak_rss)
+            result.peak_rss_raised[stage] = (
+                result.peak_rss_raised.get(stage, 0) + event.peak_rss_increase
             )
-        elif contentdata.startswith(b"ATR"):
-            process_file_with_ext(
-                contentfile,
-                "atr",
-                outdir,
-                i,
-                verbose=verbose,
-                vindentlvl=vindentlvl + 1,
+        if event.profile is not None:
+            result.profiles.append(event.profile)
+        if on_event is not None:
+            on_event(event)
+
+
+def process_queue(
+    queue: WorkQueue,
+    options: UnpackOptions,
+    executor: Optional["Executor"] = None,
+    jobs: int = 1,
+    journal: Optional[UnpackJournal] = None,
+    max_memory: Optional[int] = None,
+) -> Iterator[UnpackEvent]:
+    """process items until queue is empty, pushing each item's children back onto it
+
+    Only the items waiting in queue are kept alive, a container's data is released as
+    soon as its children have been pushed.
+
+    :param executor: if given, items are processed by executor, with up to 2*jobs
+        items submitted at once. Otherwise they are processed one at a time
+    :param journal: if given, completed items are recorded in it, and items it
+        already has as completed are skipped
+    :param max_memory: if given with executor, items are only submitted while the
+        estimated memory of all submitted items (see estimate_item_memory) fits in
+        max_memory bytes. An item is always submitted if nothing else is
+    :return: iterator of an UnpackEvent for each processed item
+    """
+    spills = None
+    if options.spill_dir is not None:
+        spills = SpillFiles(options.spill_dir)
+    completion = MemberCompletion()
+    if executor is None:
+        while queue:
+            item = queue.pop()
+            if journal is not None and journal.is_complete(item.key):
+                journal.mark_complete(item.key)
+                skip_item(item, spills, completion)
+                continue
+            result = process_item(item, options)
+            event = finish_item(queue, item, result, journal, spills, completion)
+            if event is not None:
+                yield event
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    max_pending = max(jobs, 1) * 2
+    pending = {}  # future: (item, estimated memory)
+    pending_memory = 0
+    held = None  # item waiting for memory to become available
+    while queue or pending or held is not None:
+        while (queue or held is not None) and len(pending) < max_pending:
+            if held is not None:
+                item, held = held, None
+            else:
+                item = queue.pop()
+                if journal is not None and journal.is_complete(item.key):
+                    journal.mark_complete(item.key)
+                    skip_item(item, spills, completion)
+                    continue
+            memory = 0
+            if max_memory is not None:
+                memory = estimate_item_memory(item)
+                if pending and pending_memory + memory > max_memory:
+                    held = item
+                    break
+            future = executor.submit(process_item_in_worker, item, options)
+            pending[future] = (item, memory)
+            pending_memory += memory
+        if not pending:
+            continue
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            item, memory = pending.pop(future)
+            pending_memory -= memory
+            event = finish_item(
+                queue, item, future.result(), journal, spills, completion
             )
-        elif contentdata.startswith(b"SDW"):
-            process_file_with_ext(
-                contentfile,
-                "sdw",
+            if event is not None:
+                yield event
+
+
+def finish_item(
+    queue: WorkQueue,
+    item: WorkItem,
+    result: ItemResult,
+    journal: Optional[UnpackJournal] = None,
+    spills: Optional["SpillFiles"] = None,
+    completion: Optional[MemberCompletion] = None,
+) -> Optional[UnpackEvent]:
+    """push a processed item's children, return its event
+
+    Members completed by an item without an event (such as one filtered out) are
+    counted in the next event's completed_size.
+    """
+    queue.extend(result.children)
+    if journal is not None:
+        journal.add_children(item.key, (child.key for child in result.children))
+    if spills is not None:
+        spills.add(result.children)
+        spills.release(item)
+    if completion is not None:
+        completion.finish(item.key, len(result.children), item.size)
+        if result.event is not None:
+            return result.event._replace(completed_size=completion.take())
+    return result.event
+
+
+def skip_item(
+    item: WorkItem,
+    spills: Optional["SpillFiles"] = None,
+    completion: Optional[MemberCompletion] = None,
+) -> None:
+    """account for an item that is skipped because the journal has it as completed"""
+    if spills is not None:
+        spills.release(item)
+    if completion is not None:
+        completion.finish(item.key, 0, item.size)
+
+
+class SpillFiles:
+    """counts the items whose source is in each of spill_sli's temporary files, to
+    delete a file as soon as there are none left"""
+
+    def __init__(self, spill_dir: Path):
+        self.spill_dir = os.fspath(spill_dir)
+        self.refs = Counter()  # path: number of items
+
+    def spill_path(self, item: WorkItem) -> Optional[str]:
+        source = item.source
+        if isinstance(source, FileSlice):
+            if os.path.dirname(source.path) == self.spill_dir:
+                return source.path
+        return None  # such as the input file, which isn't ours to delete
+
+    def add(self, items: Iterable[WorkItem]) -> None:
+        for item in items:
+            path = self.spill_path(item)
+            if path is not None:
+                self.refs[path] += 1
+
+    def release(self, item: WorkItem) -> None:
+        """count item as done, deleting its file if it was the last one in it"""
+        path = self.spill_path(item)
+        if path is None:
+            return
+        self.refs[path] -= 1
+        if self.refs[path] <= 0:
+            del self.refs[path]
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def process_item_in_worker(item: WorkItem, options: UnpackOptions) -> ItemResult:
+    """process_item for an executor's worker process, which can only send back
+    children whose sources can be pickled, so mmapped sources are copied"""
+    result = process_item(item, options)
+    children = [
+        child._replace(source=child.load())
+        if isinstance(child.source, mmap.mmap)
+        else child
+        for child in result.children
+    ]
+    return result._replace(children=children)
+
+
+def process_item(item: WorkItem, options: UnpackOptions) -> ItemResult:
+    """unpack a single item, return the items it contains (if it's a container)
+
+    Its event includes when it started, how long it took, and the process's peak RSS
+    after unpacking it. If options.profile_filter might match the item, it's unpacked
+    under a MemberProfiler, whose profile is kept if it does match.
+    """
+    profiler = None
+    if options.profile_filter is not None and could_be(item, options.profile_filter):
+        profiler = MemberProfiler()
+        profiler.start()
+    started = time.time()
+    start = time.perf_counter()
+    rss_before = peak_rss()
+    try:
+        result = unpack_item(item, options)
+    except BaseException:
+        if profiler is not None:
+            profiler.stop()
+        raise
+    duration = time.perf_counter() - start
+    event = result.event
+    profile = None
+    if profiler is not None:
+        if event is not None and options.profile_filter.matches(event.vpath):
+            profile = profiler.stop(event.vpath, options.profile_dir)
+        else:
+            profiler.stop()
+    if event is None:
+        return result
+    event = event._replace(started=started, duration=duration, profile=profile)
+    if rss_before is not None:
+        rss_after = peak_rss()
+        event = event._replace(
+            peak_rss=rss_after, peak_rss_increase=rss_after - rss_before
+        )
+    return result._replace(event=event)
+
+
+def unpack_item(item: WorkItem, options: UnpackOptions) -> ItemResult:
+    """process_item without measuring its time and memory use"""
+    root_dir = options.root_dir
+    pathfilter = options.pathfilter
+    if item.idx is None:
+        children = process_stm(item)
+        return ItemResult(children, UnpackEvent("", "stm", item.size))
+    if pathfilter is not None and not could_match(item, pathfilter):
+        return ItemResult([])
+
+    outdir = root_dir / item.vdir
+    i = item.idx
+    if (isinstance(item.source, FileSlice) and slice_is_stm(item)) or (
+        isinstance(item.source, mmap.mmap) and data_is_stm(item.source, item.from_sli)
+    ):
+        # a spilled or cached container is parsed from its file rather than read whole
+        ext = "stm"
+    else:
+        contentdata = item.load()
+        contentfile = BinaryCursor(contentdata)
+        ext = get_ext(contentdata, contentfile, from_sli=item.from_sli)
+    if ext == "sli":
+        sli_cache = options.sli_cache
+        cache_hits = sli_cache.hits if sli_cache is not None else 0
+        children = process_sli(
+            contentfile,
+            item,
+            sli_cache=sli_cache,
+            spill_dir=options.spill_dir,
+            spill_size=options.spill_size,
+        )
+        vpath = vjoin(item.vdir, f"{i:03x}.sli")
+        event = UnpackEvent(vpath, ext, len(contentdata))
+        if sli_cache is not None:
+            event = event._replace(sli_cache_hit=sli_cache.hits > cache_hits)
+        return ItemResult(children, event)
+
+    dot_sli = ".sli" if item.from_sli else ""
+    vpath = vjoin(item.vdir, f"{i:03x}{dot_sli}.{ext}")
+    if ext == "stm":
+        if pathfilter is not None and not pathfilter.matches_within(vpath):
+            return ItemResult([])
+        children = process_stm(item)
+        return ItemResult(children, UnpackEvent(vpath, ext, item.size))
+
+    # textures and (with split_maps) maps are written as directories of files
+    split_map = ext in ("map-pm2", "map-atr") and options.split_maps
+    tex_pngs = ext in ("tex", "tex2") and not options.raw_textures
+    namefilter = None  # decides which files inside the directory are written
+    if pathfilter is not None:
+        if split_map or tex_pngs:
+            if not pathfilter.matches_within(vpath, ext):
+                return ItemResult([])
+            namefilter = lambda name: pathfilter.matches(f"{vpath}/{name}", ext)
+        elif not pathfilter.matches(vpath, ext):
+            return ItemResult([])
+
+    def write(outdir: Path, namefilter, dry_run: bool = False):
+        """write the item into outdir, return the names of the files written inside
+        its directory (None if it's a single file)"""
+        if split_map:
+            return process_map(
+                contentdata,
+                ext,
                 outdir,
                 i,
-                verbose=verbose,
-                vindentlvl=vindentlvl + 1,
-            )
-        elif quickcheck_tex_file(contentfile):
-            process_tex(
-                contentfile, outdir, i, verbose=verbose, vindentlvl=vindentlvl + 1
+                cellfilter=namefilter,
+                dry_run=dry_run,
             )
-        elif quickcheck_tex2_file(contentfile):
-            process_tex(
-                contentfile,
+        elif tex_pngs:
+            return process_tex(
+                BinaryCursor(contentdata),
                 outdir,
                 i,
-                tex2=True,
-                verbose=verbose,
-                vindentlvl=vindentlvl + 1,
-            )
-        elif quickcheck_stm_file(contentfile, len(contentdata)):
-            process_stm(
-                contentfile, outdir, i, verbose=verbose, vindentlvl=vindentlvl + 1
+                from_sli=item.from_sli,
+                tex2=(ext == "tex2"),
+                pngfilter=namefilter,
+                dry_run=dry_run,
             )
-        elif quickcheck_mpr_file(contentfile) or quickcheck_mpr_forcedfloat_file(
-            contentfile
-        ):
+        if not dry_run:
             process_file_with_ext(
-                contentfile,
-                "mpr",
+                contentdata,
+                ext,
                 outdir,
                 i,
-                verbose=verbose,
-                vindentlvl=vindentlvl + 1,
-            )
-        elif quickcheck_mapx_file(contentfile, len(contentdata)):
-            process_mapx(
-                contentfile, outdir, i, verbose=verbose, vindentlvl=vindentlvl + 1
-            )
-        else:
-            process_dat_000_fff(
-                contentfile, outdir, i, verbose=verbose, vindentlvl=vindentlvl + 1
+                from_sli=item.from_sli,
             )
+        return None
 
+    if options.dedup_dir is not None and not options.dry_run:
+        key = f"{ext}:{options.raw_textures}:{options.split_maps}"
+        key = hashlib.sha1(contentdata + key.encode()).hexdigest()
+        outnames = link_deduplicated(
+            options.dedup_dir,
+            key,
+            root_dir / vpath,
+            write,
+            namefilter,
+            link=options.dedup_link,
+        )
+    else:
+        outnames = write(outdir, namefilter, dry_run=options.dry_run)
+    if outnames is None:
+        outputs = (vpath,)
+    else:
+        outputs = tuple(f"{vpath}/{outname}" for outname in outnames)
+    return ItemResult([], UnpackEvent(vpath, ext, len(contentdata), outputs))
 
-def process_sli(
-    file: BinaryIO,
-    outdir: Path,
-    filename_idx: int,
-    verbose: bool = False,
-    vindentlvl: int = 0,
-):
-    if verbose:
-        outname = f"{filename_idx:03x}.sli"
-        print(f"{vindent(vindentlvl)}decompressing {outname}")
 
-    contentdata = decompress(file)
-    contentfile = BytesIO(contentdata)
-    if quickcheck_tex_file(contentfile):
-        process_tex(
-            contentfile,
-            outdir,
-            filename_idx,
-            from_sli=True,
-            verbose=verbose,
-            vindentlvl=vindentlvl,
+def slice_is_stm(item: WorkItem) -> bool:
+    """return whether get_ext would find item, whose source is a FileSlice, to be an
+    STM container, reading only the parts of its file that it needs to"""
+    source = item.source
+    if source.size == 0:
+        return False
+    with open(source.path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        with memoryview(data)[source.offset : source.offset + source.size] as view:
+            return data_is_stm(view, item.from_sli)
+
+
+def data_is_stm(data, from_sli: bool) -> bool:
+    """return whether get_ext would find data to be an STM container, without
+    copying it"""
+    if len(data) == 0:
+        return False
+    cursor = BinaryCursor(data)
+    try:
+        if not from_sli and bytes(data[:3]) in _MAGIC_BEFORE_STM:
+            return False
+        return (
+            not quickcheck_tex_file(cursor)
+            and not quickcheck_tex2_file(cursor)
+            and quickcheck_stm_file(cursor, len(data))
         )
+    finally:
+        # so that the buffer data is taken from can be released
+        del cursor
+
+
+# prefixes get_ext recognizes before checking for an STM container
+_MAGIC_BEFORE_STM = (b"SLI", b"MAP", b"PM2", b"ATR", b"SDW")
+
+
+def link_deduplicated(
+    dedup_dir: Path,
+    key: str,
+    outpath: Path,
+    write: Callable,
+    namefilter: Optional[Callable[[str], bool]] = None,
+    link: bool = False,
+) -> Optional[list[str]]:
+    """copy an item's output from dedup_dir to outpath, writing it there first if it
+    isn't there yet
+
+    dedup_dir/xx/key holds the item's output as written by write(directory, None),
+    with no files filtered out. It's written to a temporary directory and renamed into
+    place, so that processes unpacking the same contents at once don't conflict. Its
+    files are read-only, and their sizes and hashes are kept alongside them in
+    DEDUP_SUMS_NAME, so that an output that was changed anyway (such as through a
+    hard link) is written again rather than used.
+
+    :param key: identifies the item's contents and how they're converted
+    :param write: function that writes the item into a directory
+    :param namefilter: if given, only files inside the output directory whose names
+        it returns True for are copied
+    :param link: hard-link the files instead of copying them
+    :return: names of the files copied inside outpath if it's a directory, or None
+    """
+    stored = dedup_dir / key[:2] / key
+    entry = check_stored(stored) if stored.is_dir() else None
+    if entry is None:
+        entry = store_output(stored, write)
+    source = stored / entry
+    if not source.is_dir():
+        copy_file(source, outpath, link=link)
+        return None
+    outnames = sorted(os.listdir(source))
+    if namefilter is not None:
+        outnames = [outname for outname in outnames if namefilter(outname)]
+    if outnames:
+        os.makedirs(outpath, exist_ok=True)
+    for outname in outnames:
+        copy_file(source / outname, outpath / outname, link=link)
+    return outnames
+
+
+DEDUP_SUMS_NAME = ".sums.json"
+
+
+def store_output(stored: Path, write: Callable) -> str:
+    """write an item's output into the dedup directory stored, see link_deduplicated.
+    Return the name of the file or directory write() created
+
+    If stored is there already, it's used if it's valid (such as when another process
+    stored the same contents first), or moved aside and replaced if it isn't. It's
+    never removed in place, since another process may still be copying from it.
+    """
+    tmpdir = stored.with_name(f".{stored.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    try:
+        write(tmpdir, None)
+        (entry,) = os.listdir(tmpdir)
+        files = {}  # path relative to stored: [size, sha1]
+        paths = [tmpdir / entry]
+        if paths[0].is_dir():
+            paths = sorted(paths[0].iterdir())
+        for path in paths:
+            relpath = path.relative_to(tmpdir).as_posix()
+            files[relpath] = [path.stat().st_size, hash_file(path)]
+            os.chmod(path, 0o444)
+        with open(tmpdir / DEDUP_SUMS_NAME, "wt", encoding="utf-8") as file:
+            json.dump({"entry": entry, "files": files}, file)
+        baddir = stored.with_name(f".{stored.name}.{os.getpid()}.bad")
+        while True:
+            try:
+                os.rename(tmpdir, stored)
+                break
+            except OSError:
+                if not stored.is_dir():
+                    raise
+            stored_entry = check_stored(stored)
+            if stored_entry is not None:
+                return stored_entry
+            shutil.rmtree(baddir, ignore_errors=True)
+            try:
+                os.rename(stored, baddir)
+            except FileNotFoundError:
+                pass  # moved aside by another process meanwhile
+        shutil.rmtree(baddir, ignore_errors=True)
+        return entry
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def check_stored(stored: Path) -> Optional[str]:
+    """return the name of the file or directory holding the output in the dedup
+    directory stored, or None if its files don't match their sizes and hashes"""
+    try:
+        with open(stored / DEDUP_SUMS_NAME, "rt", encoding="utf-8") as file:
+            sums = json.load(file)
+        for relpath, (size, sha1) in sums["files"].items():
+            path = stored / relpath
+            if os.stat(path).st_size != size or hash_file(path) != sha1:
+                return None
+        return sums["entry"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def copy_file(source: Path, dest: Path, link: bool = False) -> None:
+    """copy source to dest, replacing dest
+
+    :param link: hard-link source to dest instead, or copy it if that's not possible
+    """
+    if link:
+        try:
+            if os.path.samefile(source, dest):
+                return  # already linked, by an earlier unpack
+        except FileNotFoundError:
+            pass
+    os.makedirs(dest.parent, exist_ok=True)
+    tmppath = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+    try:
+        os.remove(tmppath)  # left over from an interrupted unpack
+    except FileNotFoundError:
+        pass
+    if link:
+        try:
+            os.link(source, tmppath)
+        except OSError:
+            shutil.copyfile(source, tmppath)
+    else:
+        shutil.copyfile(source, tmppath)
+    os.replace(tmppath, dest)
+
+
+def get_ext(contentdata: bytes, contentfile: BinaryIO, from_sli: bool = False) -> str:
+    """determine what kind of file contentdata is, return its output file extension
+
+    Containers are returned as "sli" or "stm".
+    """
+    if from_sli:
+        if quickcheck_tex_file(contentfile):
+            return "tex"
+        elif quickcheck_tex2_file(contentfile):
+            return "tex2"
+        elif quickcheck_stm_file(contentfile, len(contentdata)):
+            return "stm"
+        else:
+            return get_dat_ext(contentdata)
+
+    if contentdata.startswith(b"SLI"):
+        return "sli"
+    elif contentdata.startswith(b"MAP"):
+        return get_map_ext(contentdata)
+    elif contentdata.startswith(b"PM2"):
+        return "pm2"
+    elif contentdata.startswith(b"ATR"):
+        return "atr"
+    elif contentdata.startswith(b"SDW"):
+        return "sdw"
+    elif quickcheck_tex_file(contentfile):
+        return "tex"
     elif quickcheck_tex2_file(contentfile):
-        process_tex(
-            contentfile,
-            outdir,
-            filename_idx,
-            from_sli=True,
-            tex2=True,
-            verbose=verbose,
-            vindentlvl=vindentlvl,
-        )
+        return "tex2"
     elif quickcheck_stm_file(contentfile, len(contentdata)):
-        process_stm(
-            contentfile,
-            outdir,
-            filename_idx,
-            from_sli=True,
-            verbose=verbose,
-            vindentlvl=vindentlvl,
-        )
+        return "stm"
+    elif detect_mpr_layout(contentdata)[0]:
+        return "mpr"
+    elif quickcheck_mapx_file(contentdata):
+        return "map-pm2"
     else:
-        process_dat_000_fff(
-            contentfile,
-            outdir,
-            filename_idx,
-            from_sli=True,
-            verbose=verbose,
-            vindentlvl=vindentlvl,
-        )
+        return get_dat_ext(contentdata)
 
 
-def process_map(
-    mapfile: BinaryIO,
-    outdir: Path,
-    filename_idx: int,
-    verbose: bool = False,
-    vindentlvl: int = 0,
-):
-    mapcontainer = GHSMap.from_mapfile(mapfile)
+def get_map_ext(mapdata: bytes) -> str:
+    mapcontainer = GHSMap.from_mapfile(mapdata)
     mapext = "map-atr"
     # every mapfile contains either all .atr files or all .pm2 files
     for content in mapcontainer:
@@ -258,71 +1426,187 @@ def process_map(
         if contentdata.startswith(b"PM2"):
             mapext = "map-pm2"
         break
+    return mapext
 
-    outname = f"{filename_idx:03x}.{mapext}"
-    if verbose:
-        print(f"{vindent(vindentlvl)}{outname}")
-    outpath = outdir / outname
-    with open(outpath, "wb") as outfile:
-        mapfile.seek(0)
-        outfile.write(mapfile.read())
 
+def get_dat_ext(contentdata: bytes) -> str:
+    if contentdata == b"\x00" * 16:
+        return "000"
+    elif contentdata == b"\xff" * 16:
+        return "fff"
+    else:
+        return "dat"
 
-def process_mapx(
-    mapxfile: BinaryIO,
-    outdir: Path,
-    filename_idx: int,
-    verbose: bool = False,
-    vindentlvl: int = 0,
-):
-    outname = f"{filename_idx:03x}.map-pm2"
-    if verbose:
-        print(f"{vindent(vindentlvl)}{outname}")
-    outpath = outdir / outname
-    with open(outpath, "wb") as outfile:
-        outfile.write(mapxfile.read())
 
+def could_match(item: WorkItem, pathfilter: PathFilter) -> bool:
+    """return True if item might produce anything that pathfilter lets through
 
-def process_dat_000_fff(
-    file: BinaryIO,
-    outdir: Path,
-    filename_idx: int,
-    from_sli=False,
-    verbose: bool = False,
-    vindentlvl: int = 0,
-):
-    dot_sli = ".sli" if from_sli else ""
-    first16 = file.read(16)
-    filesize = file.seek(0, SEEK_END)
-    file.seek(0)
-    if first16 == b"\x00" * 16 and filesize == 16:
-        outname = f"{filename_idx:03x}{dot_sli}.000"
-    elif first16 == b"\xff" * 16 and filesize == 16:
-        outname = f"{filename_idx:03x}{dot_sli}.fff"
+    Only looks at the names that item could possibly be unpacked as, so that items
+    that can't match are skipped without being read, decompressed or converted.
+    """
+    for name, filetype, is_container in candidate_names(item):
+        vpath = vjoin(item.vdir, name)
+        # textures and (with split_maps) maps are written as directories of files
+        if is_container or filetype in ("tex", "tex2", "map-pm2", "map-atr"):
+            if pathfilter.matches_within(vpath, filetype):
+                return True
+        elif pathfilter.matches(vpath, filetype):
+            return True
+    return False
+
+
+def candidate_names(item: WorkItem) -> list[tuple[str, Optional[str], bool]]:
+    """return (name, file type, is_container) of each name item could be unpacked as"""
+    stem = f"{item.idx:03x}"
+    candidates = []
+    if not item.from_sli:
+        candidates.extend((f"{stem}.{ext}", ext, False) for ext in FILE_TYPES)
+        candidates.append((f"{stem}.stm", None, True))
+    candidates.extend((f"{stem}.sli.{ext}", ext, False) for ext in SLI_FILE_TYPES)
+    candidates.append((f"{stem}.sli.stm", None, True))
+    return candidates
+
+
+def could_be(item: WorkItem, pathfilter: PathFilter) -> bool:
+    """return True if item's own vpath might be one that pathfilter matches"""
+    if item.idx is None:
+        return pathfilter.matches("")
+    names = [name for name, filetype, is_container in candidate_names(item)]
+    if not item.from_sli:
+        names.append(f"{item.idx:03x}.sli")  # before it's decompressed
+    return any(pathfilter.matches(vjoin(item.vdir, name)) for name in names)
+
+
+def vjoin(vdir: str, name: str) -> str:
+    """join a virtual directory path and a name"""
+    return f"{vdir}/{name}" if vdir else name
+
+
+def process_stm(item: WorkItem) -> list[WorkItem]:
+    """return an STM container's content files as new items"""
+    vdir = item.vdir
+    if item.idx is not None:
+        dot_sli = ".sli" if item.from_sli else ""
+        vdir = vjoin(vdir, f"{item.idx:03x}{dot_sli}.stm")
+
+    source = item.source
+    if isinstance(source, FileSlice):
+        with open(source.path, "rb") as file:
+            file.seek(source.offset)
+            entries = read_stm_entries(file)
     else:
-        outname = f"{filename_idx:03x}{dot_sli}.dat"
+        entries = read_stm_entries(BinaryCursor(source))
+    return [
+        WorkItem(vdir, i, subsource(source, offset, size), depth=item.depth + 1)
+        for i, (offset, size) in enumerate(entries)
+    ]
 
-    if verbose:
-        print(f"{vindent(vindentlvl)}{outname}")
-    outpath = outdir / outname
-    with open(outpath, "wb") as outfile:
-        outfile.write(file.read())
 
+def process_sli(
+    file: BinaryIO,
+    item: WorkItem,
+    sli_cache: Optional[SLICache] = None,
+    spill_dir: Optional[Path] = None,
+    spill_size: int = 0,
+) -> list[WorkItem]:
+    """decompress a .sli, return its decompressed contents as a new item
 
-def process_file_with_ext(
+    :param sli_cache: if given, the decompressed contents are taken from it or added
+        to it. A hit becomes an mmap of the cache entry rather than a copy of it
+    :param spill_dir: if given, contents of at least spill_size bytes are written to
+        a temporary file in spill_dir, and the new item refers to that file instead
+        of holding them in memory. process_queue deletes the file once everything in
+        it has been unpacked
+    """
+    if sli_cache is not None:
+        cached = sli_cache.lookup(file)
+        if cached is not None:
+            return [item._replace(source=cached, from_sli=True)]
+
+    if spill_dir is not None:
+        with reading(file) as cursor:
+            decompressed_size = read_decompressed_size(cursor.view[cursor.pos :])
+        if decompressed_size >= spill_size:
+            spill_source = spill_sli(file, decompressed_size, spill_dir, sli_cache)
+            return [item._replace(source=spill_source, from_sli=True)]
+
+    # an mmap of the cache entry if another process cached it meanwhile
+    contentdata = decompress(file, cache=sli_cache)
+    return [item._replace(source=contentdata, from_sli=True)]
+
+
+def spill_sli(
     file: BinaryIO,
+    decompressed_size: int,
+    spill_dir: Path,
+    sli_cache: Optional[SLICache] = None,
+) -> FileSlice:
+    """decompress a .sli into a new temporary file in spill_dir, return a FileSlice
+    of the file's contents
+
+    :param sli_cache: if given, the decompressed contents are added to it from the
+        temporary file
+    """
+    fd, path = tempfile.mkstemp(suffix=".sli", dir=spill_dir)
+    with open(fd, "w+b") as spill_file:
+        if decompressed_size:
+            spill_file.truncate(decompressed_size)
+            # decompressed straight into the file's pages, which the OS can write out
+            with mmap.mmap(spill_file.fileno(), decompressed_size) as spill_data:
+                decompress(file, out=spill_data, cache=sli_cache)
+    return FileSlice(path, 0, decompressed_size)
+
+
+def process_file_with_ext(
+    data: bytes,
     ext: str,
     outdir: Path,
     filename_idx: int,
-    verbose: bool = False,
-    vindentlvl: int = 0,
+    from_sli: bool = False,
 ):
-    outname = f"{filename_idx:03x}.{ext}"
-    if verbose:
-        print(f"{vindent(vindentlvl)}{outname}")
+    dot_sli = ".sli" if from_sli else ""
+    outname = f"{filename_idx:03x}{dot_sli}.{ext}"
+    os.makedirs(outdir, exist_ok=True)
     outpath = outdir / outname
-    with open(outpath, "wb") as outfile:
-        outfile.write(file.read())
+    with atomic_write(outpath) as outfile:
+        outfile.write(data)
+
+
+def process_map(
+    mapdata: bytes,
+    mapext: str,
+    outdir: Path,
+    subdirname_idx: int,
+    cellfilter: Optional[Callable[[str], bool]] = None,
+    dry_run: bool = False,
+) -> list[str]:
+    """write each of a MAP/MAPX file's cells as a separate file, return their names
+
+    Files are named after the cell's row and column, e.g. 01_02.pm2
+
+    :param cellfilter: if given, only files whose names it returns True for are
+        written
+    :param dry_run: if True, only return the names without writing anything
+    """
+    if mapdata.startswith(b"MAP"):
+        mapcontainer = GHSMap.from_mapfile(mapdata)
+    else:
+        mapcontainer = GHSMapX.from_mapxfile(mapdata)
+    outdir /= f"{subdirname_idx:03x}.{mapext}"
+    cellext = mapext.removeprefix("map-")
+
+    cell_outnames = []
+    for row, col in mapcontainer.index:
+        cell_outname = f"{row:02x}_{col:02x}.{cellext}"
+        if cellfilter is not None and not cellfilter(cell_outname):
+            continue
+        cell_outnames.append(cell_outname)
+        if dry_run:
+            continue
+        os.makedirs(outdir, exist_ok=True)
+        with atomic_write(outdir / cell_outname) as outfile:
+            outfile.write(mapcontainer.read_cell(row, col))
+    return cell_outnames
 
 
 def process_tex(
@@ -331,38 +1615,43 @@ def process_tex(
     subdirname_idx: int,
     from_sli: bool = False,
     tex2: bool = False,
-    verbose: bool = False,
-    vindentlvl: int = 0,
-):
+    pngfilter: Optional[Callable[[str], bool]] = None,
+    dry_run: bool = False,
+) -> list[str]:
+    """convert a texture file to .png files, return the names of the .png files
+
+    :param pngfilter: if given, only .png files whose names it returns True for are
+        written
+    :param dry_run: if True, only return the names without writing anything
+    """
     dot_sli = ".sli" if from_sli else ""
     dot_tex = ".tex2" if tex2 else ".tex"
-    outname = f"{subdirname_idx:03x}{dot_sli}{dot_tex}"
-    if verbose:
-        print(f"{vindent(vindentlvl)}{outname}")
-    outdir /= outname
-    os.makedirs(outdir, exist_ok=True)
+    outdir /= f"{subdirname_idx:03x}{dot_sli}{dot_tex}"
 
-    if tex2:
-        read_tex = GHSTexImageSingle.from_ghstex2file
+    ghstexs = read_tex_images(file, tex2)
+    tex_outnames = [
+        f"{i:03x}_{ghstex.tex_offset:#05x}.png" for i, ghstex in enumerate(ghstexs)
+    ]
+    if pngfilter is not None:
+        ghstexs_outnames = [
+            (ghstex, tex_outname)
+            for ghstex, tex_outname in zip(ghstexs, tex_outnames)
+            if pngfilter(tex_outname)
+        ]
+        if not ghstexs_outnames:
+            return []
     else:
-        read_tex = GHSTexImageSingle.from_ghstexfile
-    ghstexs = []
-    while not is_eof(file):
-        try:
-            ghstexs.append(read_tex(file))
-        # except GHSTexUnknownPixFormat as e:
-        #     print(f"!! {e}")
-        #     continue
-        except GHSTexExtraDataException:
-            pass
+        ghstexs_outnames = list(zip(ghstexs, tex_outnames))
 
-    for i, ghstex in enumerate(ghstexs):
-        tex_outname = f"{i:03x}_{ghstex.tex_offset:#05x}.png"
+    if dry_run:
+        return [tex_outname for ghstex, tex_outname in ghstexs_outnames]
+
+    os.makedirs(outdir, exist_ok=True)
+    for ghstex, tex_outname in ghstexs_outnames:
         tex_outpath = outdir / tex_outname
-        with open(tex_outpath, "wb") as outfile:
-            if verbose:
-                print(f"{vindent(vindentlvl + 1)}{tex_outname}")
+        with atomic_write(tex_outpath) as outfile:
             ghstex.write_to_png(outfile)
+    return [tex_outname for ghstex, tex_outname in ghstexs_outnames]
 
 
 if __name__ == "__main__":
@@ -1,18 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import os
 import sys
+from dataclasses import dataclass, field
+from io import BytesIO
+from mmap import mmap
 from pathlib import Path
 from sys import argv
+from typing import Optional, Union
 
+from mymodules.common import as_buffer
+from mymodules.ghsanimbake import write_baked_anims
+from mymodules.ghsbinary import ghsb_bytes
 from mymodules.ghsexecutable_eu import (
-    get_anims,
-    get_boneparentinfo_and_numbones,
-    get_default_body_parts,
-    get_stmindex,
-    modelmeta_len,
+    ModelMeta,
+    ModelMetaCache,
+    cache_stats,
+    read_modelmeta_table,
 )
 from mymodules.ghsmodelmetaoutloc import get_modelmeta_outloc
 
@@ -40,6 +45,36 @@ def build_argparser():
         "is from. Use this to override the name of the directory.",
         type=Path,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="extract using N worker processes (default 1)",
+    )
+    parser.add_argument(
+        "--binary",
+        dest="binary",
+        action="store_true",
+        help="Also write each model as a compact binary .ghsb file (.ghsb-shadow for "
+        "shadows) next to its .ghs file",
+    )
+    parser.add_argument(
+        "--bake",
+        dest="bake",
+        action="store_true",
+        help="Also write each model's animations baked into per-frame pm2s and values, "
+        "as a .npz file next to its .ghs file",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="Print how many bone, body part and animation tables were parsed, and how "
+        "many were shared between models and reused",
+    )
     return parser
 
 
@@ -48,64 +83,232 @@ def main(args=tuple(argv[1:])):
     parser = build_argparser()
     parsed_args = parser.parse_args(args)
 
-    executable_path: Path = parsed_args.executable_path
-    alternate_dir: Path = parsed_args.alternate_dir
-
-    if executable_path.name.upper() == "SLES_519.33":
-        version = "EU"
-    elif executable_path.name.upper() == "SLPM_653.24":
-        version = "JP"
-        print(
-            "Sorry, Japanese version is not supported yet... "
-            "Please use the European version for now",
-            file=sys.stderr,
+    try:
+        result = extract_modelmeta(
+            parsed_args.executable_path,
+            parsed_args.alternate_dir,
+            binary=parsed_args.binary,
+            bake=parsed_args.bake,
+            jobs=parsed_args.jobs,
         )
+    except GHSModelMetaError as e:
+        print(e, file=sys.stderr)
         sys.exit(1)
-    else:
-        print(
-            f"unknown executable filename {executable_path.name!r}, "
-            "expecting 'SLES_519.33' or 'SLPM_653.24'",
-            file=sys.stderr,
+    if parsed_args.stats:
+        for line in result.stats:
+            print(line)
+
+
+class GHSModelMetaError(ValueError):
+    pass
+
+
+@dataclass
+class ModelMetaResult:
+    """returned by extract_modelmeta
+
+    dest_dir: directory the .ghs files were extracted into
+    outputs: paths of all .ghs (and .ghsb, .npz) files written
+    stats: how many tables were parsed, and how many were shared between entries and
+        reused instead, a line of text per kind of table
+    """
+
+    dest_dir: Path
+    outputs: list[Path] = field(default_factory=list)
+    stats: list[str] = field(default_factory=list)
+
+
+def extract_modelmeta(
+    executable: Union[str, os.PathLike, bytes, bytearray, memoryview],
+    dest: Union[str, os.PathLike, None] = None,
+    *,
+    version: Optional[str] = None,
+    binary: bool = False,
+    bake: bool = False,
+    jobs: int = 1,
+) -> ModelMetaResult:
+    """extract ###.ghs files from a Gregory Horror Show executable
+
+    :param executable: path to the executable, or the executable's data
+    :param dest: directory to extract into, normally the directory FILE.STM was
+        unpacked into. By default, GHS_EU_FILE_STM or GHS_JP_FILE_STM depending on
+        version
+    :param version: "EU" or "JP". By default, this is determined from the
+        executable's filename, or assumed to be "EU" if executable is data
+    :param binary: also write each model as a .ghsb file, see mymodules.ghsbinary
+    :param bake: also write each model's baked animations as a .npz file, see
+        mymodules.ghsanimbake
+    :param jobs: number of worker processes to extract with. The files written are
+        the same either way
+    :return: a ModelMetaResult
+    :raises GHSModelMetaError: if the version is unknown or not supported
+    """
+    if version is None:
+        if isinstance(executable, (bytes, bytearray, memoryview)):
+            version = "EU"
+        else:
+            executable_name = Path(executable).name
+            if executable_name.upper() == "SLES_519.33":
+                version = "EU"
+            elif executable_name.upper() == "SLPM_653.24":
+                version = "JP"
+            else:
+                raise GHSModelMetaError(
+                    f"unknown executable filename {executable_name!r}, "
+                    "expecting 'SLES_519.33' or 'SLPM_653.24'"
+                )
+    if version == "JP":
+        raise GHSModelMetaError(
+            "Sorry, Japanese version is not supported yet... "
+            "Please use the European version for now"
         )
-        sys.exit(1)
+    elif version != "EU":
+        raise GHSModelMetaError(f"unknown version {version!r}, expecting 'EU' or 'JP'")
 
-    if alternate_dir:
-        destdir = alternate_dir
+    if dest is not None:
+        destdir = Path(dest)
     elif version == "EU":
         destdir = Path("GHS_EU_FILE_STM")
-    elif version == "JP":
+    else:  # elif version == "JP":
         destdir = Path("GHS_JP_FILE_STM")
-    else:
-        # should never happen due to above check
-        destdir = Path("GHS_UNK_FILE_STM")
 
-    with open(executable_path, "rb") as executable_file:
-        ghs_unmatched_dir = destdir / "ghs_unmatched"
-        os.makedirs(ghs_unmatched_dir, exist_ok=True)
+    if isinstance(executable, (bytes, bytearray, memoryview)):
+        execdata = executable
+    else:
+        # memory-mapped (if possible), so parsing needs no reads or seeks at all
+        with open(executable, "rb") as executable_file:
+            execdata = as_buffer(executable_file)
+    result = ModelMetaResult(destdir)
+    try:
+        modelmetas = read_modelmeta_table(execdata)
+        outdirs, filenames = [], []
+        for modelmeta_i, modelmeta in enumerate(modelmetas):
+            subdir, filename = get_modelmeta_outloc(modelmeta_i, modelmeta.stmindex)
+            outdirs.append(destdir / ("ghs_unmatched" if subdir is None else subdir))
+            filenames.append(filename)
+        for outdir in dict.fromkeys(outdirs):
+            os.makedirs(outdir, exist_ok=True)
 
-        for modelmeta_i in range(modelmeta_len):
-            stm_index = get_stmindex(modelmeta_i, executable_file)
-            boneparentinfo, num_bones = get_boneparentinfo_and_numbones(
-                modelmeta_i, executable_file
+        if jobs > 1:
+            if execdata is not executable:
+                executable_arg = str(executable)  # each worker maps it itself
+            elif isinstance(executable, memoryview):
+                # only bytes-like objects that can be pickled can be sent to workers
+                # started with spawn or forkserver (the default on macOS and Windows)
+                executable_arg = bytes(executable)
+            else:
+                executable_arg = executable
+            outputs, hits, misses = _extract_parallel(
+                executable_arg, modelmetas, outdirs, filenames, jobs, binary, bake
             )
-            defaultbodyparts = get_default_body_parts(
-                modelmeta_i, num_bones, executable_file
+            result.outputs.extend(outputs)
+            result.stats = cache_stats(hits, misses)
+        else:
+            cache = ModelMetaCache(execdata)
+            for modelmeta, outdir, filename in zip(modelmetas, outdirs, filenames):
+                for name, data in model_files(cache, modelmeta, filename, binary, bake):
+                    write_file(outdir / name, data)
+                    result.outputs.append(outdir / name)
+            result.stats = cache.stats()
+    finally:
+        if isinstance(execdata, mmap):
+            execdata.close()
+    return result
+
+
+def model_files(
+    cache: ModelMetaCache, modelmeta: ModelMeta, filename: str, binary, bake
+) -> list[tuple[str, bytes]]:
+    """return (filename, data) of each file to write for a modelmeta entry"""
+    tables = cache.modelmeta_tables(modelmeta)
+    files = [(filename, cache.modelmeta_json(modelmeta, tables).encode())]
+    if binary:
+        binfilename = filename.replace(".ghs", ".ghsb", 1)
+        files.append((binfilename, ghsb_bytes(*tables)))
+    if bake:
+        npzfile = BytesIO()
+        write_baked_anims(npzfile, tables[2])
+        files.append((f"{filename}.npz", npzfile.getvalue()))
+    return files
+
+
+def write_file(path: Path, data: bytes) -> None:
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def _extract_parallel(executable, modelmetas, outdirs, filenames, jobs, binary, bake):
+    """extract modelmetas in jobs worker processes, write the files in a thread pool
+
+    Each worker parses and serializes a contiguous chunk of entries at a time, so that
+    entries sharing tables (doors, duplicates...) mostly end up in the same worker's
+    cache. Files are written while the workers are still busy.
+
+    :return: (paths of the files written, in order; cache hits; cache misses)
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    chunk_size = -(-len(modelmetas) // (jobs * 4))
+    outputs = []
+    hits = dict.fromkeys(ModelMetaCache.kinds, 0)
+    misses = dict.fromkeys(ModelMetaCache.kinds, 0)
+    with ProcessPoolExecutor(
+        jobs, initializer=_init_worker, initargs=(executable,)
+    ) as pool, ThreadPoolExecutor(jobs) as writers:
+        chunk_futures = [
+            (
+                start,
+                pool.submit(
+                    _extract_chunk,
+                    modelmetas[start : start + chunk_size],
+                    filenames[start : start + chunk_size],
+                    binary,
+                    bake,
+                ),
             )
-            allanims = get_anims(modelmeta_i, num_bones, executable_file)
-            outdata = {
-                "bone_parenting_info": boneparentinfo,
-                "default_body_parts": defaultbodyparts,
-                "animations": allanims,
-            }
-
-            subdir, filename = get_modelmeta_outloc(modelmeta_i, stm_index)
-            if subdir is None:
-                outdir = ghs_unmatched_dir
-            else:
-                outdir = destdir / subdir
-                os.makedirs(outdir, exist_ok=True)
-            with open(outdir / filename, "wt") as ghsfile:
-                json.dump(outdata, ghsfile)
+            for start in range(0, len(modelmetas), chunk_size)
+        ]
+        write_futures = []
+        for start, future in chunk_futures:  # in order, so outputs are in order
+            chunk_models, chunk_hits, chunk_misses = future.result()
+            for outdir, files in zip(outdirs[start:], chunk_models):
+                for name, data in files:
+                    write_futures.append(
+                        writers.submit(write_file, outdir / name, data)
+                    )
+                    outputs.append(outdir / name)
+            for kind in ModelMetaCache.kinds:
+                hits[kind] += chunk_hits[kind]
+                misses[kind] += chunk_misses[kind]
+        for future in write_futures:
+            future.result()  # raises any exception from writing
+    return outputs, hits, misses
+
+
+# each worker process's own cache, with the executable memory-mapped once per process
+_worker_cache: Optional[ModelMetaCache] = None
+
+
+def _init_worker(executable) -> None:
+    global _worker_cache
+    if isinstance(executable, (bytes, bytearray, memoryview)):
+        execdata = executable
+    else:
+        with open(executable, "rb") as executable_file:
+            execdata = as_buffer(executable_file)
+    _worker_cache = ModelMetaCache(execdata)
+
+
+def _extract_chunk(modelmetas, filenames, binary, bake):
+    hits_before = dict(_worker_cache.hits)
+    misses_before = dict(_worker_cache.misses)
+    models = [
+        model_files(_worker_cache, modelmeta, filename, binary, bake)
+        for modelmeta, filename in zip(modelmetas, filenames)
+    ]
+    hits = {k: v - hits_before[k] for k, v in _worker_cache.hits.items()}
+    misses = {k: v - misses_before[k] for k, v in _worker_cache.misses.items()}
+    return models, hits, misses
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Search an index written by ghs_filestm_unpack.py --index
+
+Examples:
+    ghs_query_index.py FILE.sqlite --pixfmt i4 --width 256 --height 256
+    ghs_query_index.py FILE.sqlite --under 029.stm --min-size 1048576
+"""
+import argparse
+import sqlite3
+import sys
+from sys import argv
+
+from mymodules.ghsindex import GHSIndexError, open_index, query_members
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser()
+    parser.description = (
+        "List the contents of an indexed FILE.STM that match all of the given "
+        "conditions, see ghs_filestm_unpack.py --index"
+    )
+    parser.add_argument(
+        metavar="INDEX_FILE",
+        dest="index_path",
+        help="index written by ghs_filestm_unpack.py --index",
+    )
+    parser.add_argument(
+        "--under",
+        metavar="PATH",
+        dest="under",
+        help="only contents inside the container at PATH, e.g. 029.stm",
+    )
+    parser.add_argument(
+        "--type",
+        metavar="TYPE",
+        dest="types",
+        action="append",
+        help="only contents of this file type (extension, or stm for containers). "
+        "Can be given multiple times",
+    )
+    parser.add_argument(
+        "--min-size",
+        metavar="BYTES",
+        dest="min_size",
+        type=int,
+        help="only contents at least this large (after decompressing)",
+    )
+    parser.add_argument(
+        "--max-size",
+        metavar="BYTES",
+        dest="max_size",
+        type=int,
+        help="only contents at most this large (after decompressing)",
+    )
+    parser.add_argument(
+        "--pixfmt",
+        dest="pixfmt",
+        choices=("i4", "i8"),
+        help="only textures containing an image of this pixel format",
+    )
+    parser.add_argument(
+        "--width",
+        dest="width",
+        type=int,
+        help="only textures containing an image this wide",
+    )
+    parser.add_argument(
+        "--height",
+        dest="height",
+        type=int,
+        help="only textures containing an image this high",
+    )
+    parser.add_argument(
+        "--sql",
+        metavar="QUERY",
+        dest="sql",
+        help="run QUERY against the index instead, and print the resulting rows. "
+        "See mymodules/ghsindex.py for the tables",
+    )
+    return parser
+
+
+def main(args=tuple(argv[1:])):
+    """args: sequence of command line argument strings"""
+    parser = build_argparser()
+    parsed_args = parser.parse_args(args)
+
+    try:
+        conn = open_index(parsed_args.index_path)
+    except GHSIndexError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    try:
+        if parsed_args.sql is not None:
+            try:
+                rows = conn.execute(parsed_args.sql).fetchall()
+            except sqlite3.Error as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+            for row in rows:
+                print("\t".join("" if value is None else str(value) for value in row))
+            return
+
+        rows = query_members(
+            conn,
+            under=parsed_args.under,
+            types=parsed_args.types,
+            min_size=parsed_args.min_size,
+            max_size=parsed_args.max_size,
+            pixfmt=parsed_args.pixfmt,
+            width=parsed_args.width,
+            height=parsed_args.height,
+        )
+    finally:
+        conn.close()
+    for vpath, filetype, size in rows:
+        print(f"{vpath}\t{filetype}\t{size}")
+
+
+if __name__ == "__main__":
+    main()
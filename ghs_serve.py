@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Serve the contents of FILE.STM over HTTP on localhost, without unpacking it
+
+FILE.STM is opened once and memory-mapped. Contents are found, decompressed and
+converted only when they're requested:
+
+    /tree/<path>                JSON listing of the container or texture at path,
+                                or the type and size of the file at path
+    /tex/<path>/<index>.png     image number index of the texture at path, as .png
+
+Paths are the same as where ghs_filestm_unpack.py would unpack things to, e.g.
+/tree/029.stm/000.sli.stm or /tex/0aa.stm/000.sli.tex/0.png. Listings don't decompress
+.sli contents, those not loaded yet are listed by e.g. 000.sli, which works as a path
+too. Responses have ETags, so
+that browsers can reuse them, and recently converted images are kept in memory.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from sys import argv
+from typing import NamedTuple, Optional
+from urllib.parse import unquote, urlsplit
+
+from ghs_filestm_unpack import get_ext, vjoin
+from mymodules.common import BinaryCursor
+from mymodules.ghssli import decompress
+from mymodules.ghsslicache import SLICache
+from mymodules.ghsstmcontainer import quickcheck_stm_file, read_stm_entries
+from mymodules.ghsteximage import read_tex_images
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser()
+    parser.description = (
+        "Serve the contents of a Gregory Horror Show FILE.STM over HTTP on localhost"
+    )
+    parser.add_argument(
+        metavar="FILE_STM",
+        dest="file_stm_path",
+        help="path to FILE.STM from the EU or JP version of Gregory Horror Show",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        dest="port",
+        type=int,
+        default=8000,
+        help="port to listen on (default %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar="MB",
+        dest="cache_size",
+        type=int,
+        default=256,
+        help="how many megabytes of decompressed contents and converted images to "
+        "keep in memory (default %(default)s)",
+    )
+    parser.add_argument(
+        "--sli-cache",
+        metavar="DIR",
+        dest="sli_cache_dir",
+        help="keep decompressed .sli contents in DIR, see ghs_filestm_unpack.py",
+    )
+    return parser
+
+
+def main(args=tuple(argv[1:])):
+    """args: sequence of command line argument strings"""
+    parser = build_argparser()
+    parsed_args = parser.parse_args(args)
+
+    sli_cache = None
+    if parsed_args.sli_cache_dir is not None:
+        sli_cache = SLICache(parsed_args.sli_cache_dir)
+    with open(parsed_args.file_stm_path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as stmdata:
+        if not quickcheck_stm_file(BinaryCursor(stmdata)):
+            print(
+                f"{parsed_args.file_stm_path} is not a valid STM file", file=sys.stderr
+            )
+            sys.exit(1)
+        stat = os.fstat(file.fileno())
+        tree = AssetTree(
+            stmdata,
+            version=f"{stat.st_size:x}-{stat.st_mtime_ns:x}",
+            cache_size=parsed_args.cache_size * 1024 * 1024,
+            sli_cache=sli_cache,
+        )
+        # only reachable from this machine
+        server = ThreadingHTTPServer(("127.0.0.1", parsed_args.port), AssetHandler)
+        server.tree = tree
+        port = server.server_address[1]
+        print(f"Serving {parsed_args.file_stm_path} on http://127.0.0.1:{port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+class AssetNotFound(LookupError):
+    pass
+
+
+class Entry(NamedTuple):
+    """a member of a container, as listed by /tree"""
+
+    name: str
+    filetype: str  # "stm" for containers, "sli" for .sli not decompressed yet
+    size: int
+
+
+class LRUCache:
+    """thread-safe mapping that forgets the least recently used values beyond
+    max_size bytes in total"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._size = 0
+        self._values = OrderedDict()  # key: (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value_size = self._values.get(key)
+            if value_size is None:
+                return None
+            self._values.move_to_end(key)
+            return value_size[0]
+
+    def put(self, key, value, size: int) -> None:
+        with self._lock:
+            if key in self._values:
+                self._size -= self._values.pop(key)[1]
+            self._values[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size and len(self._values) > 1:
+                _, (_, oldsize) = self._values.popitem(last=False)
+                self._size -= oldsize
+
+
+class AssetTree:
+    """finds contents of an STM by path, decompressing only what's needed
+
+    :param stmdata: the whole STM file, such as an mmap of it
+    :param version: identifies stmdata, used in ETags
+    :param cache_size: how many bytes of decompressed containers and converted images
+        to keep in memory
+    :param sli_cache: if given, .sli contents are decompressed through it
+    """
+
+    def __init__(
+        self,
+        stmdata,
+        version: str = "",
+        cache_size: int = 256 * 1024 * 1024,
+        sli_cache: Optional[SLICache] = None,
+    ):
+        self.stmdata = stmdata
+        self.version = version
+        self.sli_cache = sli_cache
+        self._cache = LRUCache(cache_size)
+
+    def etag(self, path: str) -> str:
+        """return an ETag for the response at path, which only changes with the STM"""
+        digest = hashlib.sha1(f"{self.version}:{path}".encode()).hexdigest()
+        return f'"{digest[:32]}"'
+
+    def _cached(self, key, make, size=len):
+        value = self._cache.get(key)
+        if value is None:
+            value = make()
+            self._cache.put(key, value, size(value))
+        return value
+
+    def _decompress(self, data: bytes) -> memoryview:
+        # a view, so that a cache hit's mmap isn't copied
+        return memoryview(decompress(data, cache=self.sli_cache))
+
+    def _member(self, vdir: str, i: int) -> tuple:
+        """return (data, from_sli, file type) of member i of the container at vdir,
+        decompressed if it's a .sli
+
+        :raises AssetNotFound: if vdir isn't a container or has no member i
+        """
+
+        def make():
+            parentdata, filetype = self.load(vdir)
+            if filetype != "stm":
+                raise AssetNotFound(f"{vdir} is not a container")
+            entries = read_stm_entries(BinaryCursor(parentdata))
+            if not 0 <= i < len(entries):
+                raise AssetNotFound(f"{vjoin(vdir, f'{i:03x}')} not found")
+            offset, size = entries[i]
+            member = bytes(parentdata[offset : offset + size])
+            from_sli = member.startswith(b"SLI")
+            if from_sli:
+                member = self._decompress(member)
+            ext = get_ext(member, BinaryCursor(member), from_sli=from_sli)
+            return member, from_sli, ext
+
+        return self._cached(("data", vdir, i), make, size=lambda value: len(value[0]))
+
+    def listing(self, vdir: str) -> list[Entry]:
+        """return the members of the container at vdir ("" for the STM itself)
+
+        .sli members aren't decompressed to list them. Until they've been loaded,
+        they're listed as e.g. 000.sli with type "sli" and their compressed size
+        """
+
+        def make():
+            data, filetype = self.load(vdir)
+            if filetype != "stm":
+                raise AssetNotFound(f"{vdir} is not a container")
+            entries = []
+            for i, (offset, size) in enumerate(read_stm_entries(BinaryCursor(data))):
+                member = bytes(data[offset : offset + size])
+                if member.startswith(b"SLI"):
+                    entries.append(Entry(f"{i:03x}.sli", "sli", size))
+                else:
+                    ext = get_ext(member, BinaryCursor(member))
+                    entries.append(Entry(f"{i:03x}.{ext}", ext, size))
+            return entries
+
+        entries = self._cached(("listing", vdir), make, size=lambda entries: 0)
+        # fill in the .sli members that have been decompressed since
+        for i, entry in enumerate(entries):
+            if entry.filetype == "sli":
+                loaded = self._cache.get(("data", vdir, i))
+                if loaded is not None:
+                    member, _, ext = loaded
+                    entries[i] = Entry(f"{i:03x}.sli.{ext}", ext, len(member))
+        return entries
+
+    def load(self, vpath: str) -> tuple:
+        """return (data, file type) of the contents at vpath
+
+        Members are found by the index their name starts with. The name of a .sli
+        member can be given as listed before it was decompressed, e.g. 000.sli
+
+        :raises AssetNotFound: if there is nothing at vpath
+        """
+        if not vpath:
+            # the STM itself isn't cached, it's already in memory (mapped)
+            return self.stmdata, "stm"
+        vdir, _, name = vpath.rpartition("/")
+        try:
+            i = int(name.split(".", 1)[0], 16)
+        except ValueError:
+            raise AssetNotFound(f"{vpath} not found") from None
+        member, from_sli, ext = self._member(vdir, i)
+        dot_sli = ".sli" if from_sli else ""
+        if name not in (f"{i:03x}{dot_sli}.{ext}", f"{i:03x}{dot_sli}"):
+            raise AssetNotFound(f"{vpath} not found")
+        return member, ext
+
+    def tex_images(self, vpath: str) -> list:
+        """return the GHSTexImageSingles of the texture at vpath"""
+        data, filetype = self.load(vpath)
+        if filetype not in ("tex", "tex2"):
+            raise AssetNotFound(f"{vpath} is not a texture")
+
+        def make():
+            return read_tex_images(BinaryCursor(data), tex2=(filetype == "tex2"))
+
+        return self._cached(("tex", vpath), make, size=lambda texs: len(data) * 4)
+
+    def png(self, vpath: str, index: int) -> bytes:
+        """return image number index of the texture at vpath as a .png file"""
+
+        def make():
+            ghstexs = self.tex_images(vpath)
+            if not 0 <= index < len(ghstexs):
+                raise AssetNotFound(f"{vpath} has no image {index}")
+            out = BytesIO()
+            ghstexs[index].write_to_png(out)
+            return out.getvalue()
+
+        return self._cached(("png", vpath, index), make)
+
+    def tree(self, vpath: str) -> dict:
+        """return what /tree/vpath responds with"""
+        data, filetype = self.load(vpath)
+        if filetype == "stm":
+            entries = [
+                {"name": entry.name, "type": entry.filetype, "size": entry.size}
+                for entry in self.listing(vpath)
+            ]
+        elif filetype in ("tex", "tex2"):
+            entries = [
+                {
+                    "name": f"{i}.png",
+                    "type": "png",
+                    "width": ghstex.width,
+                    "height": ghstex.height,
+                    "url": f"/tex/{vpath}/{i}.png",
+                }
+                for i, ghstex in enumerate(self.tex_images(vpath))
+            ]
+        else:
+            entries = None
+        tree = {"path": vpath, "type": filetype, "size": len(data)}
+        if entries is not None:
+            tree["entries"] = entries
+        return tree
+
+
+class AssetHandler(BaseHTTPRequestHandler):
+    server_version = "ghs_serve"
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path)
+        route, _, vpath = path.strip("/").partition("/")
+        vpath = vpath.strip("/")
+        if route not in ("tree", "tex"):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        tree = self.server.tree
+        etag = tree.etag(path)
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        try:
+            if route == "tree":
+                body = json.dumps(tree.tree(vpath), indent=1).encode()
+                content_type = "application/json"
+            else:
+                texpath, _, filename = vpath.rpartition("/")
+                index_str, dot, ext = filename.partition(".")
+                if not (index_str.isdigit() and dot and ext == "png"):
+                    raise AssetNotFound(f"{vpath} not found")
+                body = tree.png(texpath, int(index_str))
+                content_type = "image/png"
+        except AssetNotFound as e:
+            self.send_error(HTTPStatus.NOT_FOUND, str(e))
+            return
+        except Exception as e:
+            self.log_error("error serving %s: %r", path, e)
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")  # revalidate with the ETag
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Compare the contents of two STM files, such as the EU and JP FILE.STMs
+
+Both STMs are walked side by side. Members whose stored (for .sli, compressed) bytes
+have the same hash are the same, and aren't looked at any further, so only .sli
+members that differ are decompressed.
+
+What's found out about a member is kept in a hash manifest, keyed by the hash of its
+stored bytes: its type, the hash of its contents, the hashes of its members (for
+containers) and of its images (for textures). With --hash-manifest, it's saved, and
+reruns look members up in it instead of decompressing and converting them again.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import sys
+from dataclasses import dataclass, field
+from sys import argv
+from typing import Callable, Optional
+
+from ghs_filestm_unpack import get_ext, vjoin
+from mymodules.common import BinaryCursor, atomic_write
+from mymodules.ghssli import decompress
+from mymodules.ghsstmcontainer import quickcheck_stm_file, read_stm_entries
+from mymodules.ghsteximage import read_tex_images
+
+HASH_MANIFEST_VERSION = 1
+
+
+def build_argparser():
+    parser = argparse.ArgumentParser()
+    parser.description = (
+        "List the contents that were added, removed or changed between two Gregory "
+        "Horror Show FILE.STMs"
+    )
+    parser.add_argument(
+        metavar="OLD_FILE_STM", dest="old_path", help="path to the first STM file"
+    )
+    parser.add_argument(
+        metavar="NEW_FILE_STM", dest="new_path", help="path to the second STM file"
+    )
+    parser.add_argument(
+        "--hash-manifest",
+        metavar="FILE",
+        dest="manifest_path",
+        help="keep the hashes of compared contents in FILE, so that comparing the same "
+        "STMs (or others with the same contents) again is much faster",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="compare using N worker processes (default 1)",
+    )
+    return parser
+
+
+def main(args=tuple(argv[1:])):
+    """args: sequence of command line argument strings"""
+    parser = build_argparser()
+    parsed_args = parser.parse_args(args)
+
+    manifest = {}
+    if parsed_args.manifest_path is not None:
+        manifest = load_hash_manifest(parsed_args.manifest_path)
+    try:
+        result = diff_stm(
+            parsed_args.old_path, parsed_args.new_path, manifest, jobs=parsed_args.jobs
+        )
+    except GHSDiffError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if parsed_args.manifest_path is not None:
+        save_hash_manifest(parsed_args.manifest_path, manifest)
+    for line in result.lines():
+        print(line)
+
+
+class GHSDiffError(ValueError):
+    pass
+
+
+@dataclass
+class DiffResult:
+    """returned by diff_stm, all paths are the paths the contents are unpacked to
+
+    added, removed: contents only in the new or old STM. A container that was added
+    or removed is listed by itself, not with its contents
+    changed: contents in both whose data differs
+    changed_images: for each changed texture, the indexes of its images that differ
+        or are only in one of them
+    """
+
+    added: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    changed_images: dict[str, list[int]] = field(default_factory=dict)
+
+    def extend(self, other: "DiffResult") -> None:
+        self.added += other.added
+        self.removed += other.removed
+        self.changed += other.changed
+        self.changed_images.update(other.changed_images)
+
+    def lines(self) -> list[str]:
+        """return a line per difference, sorted by path"""
+        lines = [(vpath, f"+ {vpath}") for vpath in self.added]
+        lines += [(vpath, f"- {vpath}") for vpath in self.removed]
+        for vpath in self.changed:
+            images = self.changed_images.get(vpath)
+            if images is None:
+                lines.append((vpath, f"M {vpath}"))
+            else:
+                images_str = ", ".join(str(i) for i in images)
+                lines.append((vpath, f"M {vpath} (images {images_str})"))
+        return [line for vpath, line in sorted(lines)]
+
+
+def load_hash_manifest(path) -> dict:
+    """return the hash manifest saved at path, or an empty one if there is none"""
+    try:
+        with open(path, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        raise GHSDiffError(f"can't read hash manifest {path}: {e}") from e
+    if data.get("version") != HASH_MANIFEST_VERSION:
+        return {}
+    return data["members"]
+
+
+def save_hash_manifest(path, manifest: dict) -> None:
+    with atomic_write(path, "wt") as file:
+        json.dump({"version": HASH_MANIFEST_VERSION, "members": manifest}, file)
+
+
+def sha1(data) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+class _Member:
+    """a member of an STM, whose data is only loaded when it's needed
+
+    key: hash of the member's stored data
+    """
+
+    def __init__(self, key: str, load: Callable[[], bytes]):
+        self.key = key
+        self._load = load
+        self._contents = None
+
+    def contents(self) -> tuple[bytes, bool]:
+        """return the member's data (decompressed if it's a .sli), and whether it
+        was a .sli"""
+        if self._contents is None:
+            data = self._load()
+            from_sli = data.startswith(b"SLI")
+            if from_sli:
+                data = bytes(decompress(data))
+            self._contents = data, from_sli
+        return self._contents
+
+
+def describe(member: _Member, manifest: dict) -> dict:
+    """return what the manifest knows about member, finding it out if needed
+
+    {"ext": file type, "sli": was it a .sli, "sha1": hash of its contents,
+    "members": hashes of its members' stored data (only containers),
+    "images": hashes of its images (only textures)}
+    """
+    desc = manifest.get(member.key)
+    if desc is not None:
+        return desc
+    contents, from_sli = member.contents()
+    ext = get_ext(contents, BinaryCursor(contents), from_sli=from_sli)
+    desc = {"ext": ext, "sli": from_sli, "sha1": sha1(contents)}
+    if ext == "stm":
+        entries = read_stm_entries(BinaryCursor(contents))
+        desc["members"] = [sha1(contents[o : o + size]) for o, size in entries]
+    elif ext in ("tex", "tex2"):
+        ghstexs = read_tex_images(BinaryCursor(contents), tex2=(ext == "tex2"))
+        desc["images"] = [image_hash(ghstex) for ghstex in ghstexs]
+    manifest[member.key] = desc
+    return desc
+
+
+def image_hash(ghstex) -> str:
+    """return a hash of everything about a GHSTexImageSingle that's converted"""
+    h = hashlib.sha1(
+        f"{ghstex.pixfmt}:{ghstex.width}:{ghstex.height}:{ghstex.tex_offset}".encode()
+    )
+    if ghstex.palette is not None:
+        h.update(bytes(c for color in ghstex.palette for c in color))
+    h.update(bytes(ghstex.pixels))
+    return h.hexdigest()
+
+
+def submembers(member: _Member, desc: dict) -> list[_Member]:
+    """return the members of the container member, described by desc"""
+
+    def loader(i):
+        def load():
+            contents = member.contents()[0]
+            offset, size = read_stm_entries(BinaryCursor(contents))[i]
+            return contents[offset : offset + size]
+
+        return load
+
+    return [_Member(key, loader(i)) for i, key in enumerate(desc["members"])]
+
+
+def member_name(i: int, desc: dict) -> str:
+    dot_sli = ".sli" if desc["sli"] else ""
+    return f"{i:03x}{dot_sli}.{desc['ext']}"
+
+
+def diff_members(
+    vdir: str,
+    i: int,
+    old: Optional[_Member],
+    new: Optional[_Member],
+    manifest: dict,
+    result: DiffResult,
+) -> None:
+    """compare member i of the STMs at vdir, add the differences to result"""
+    if old is not None and new is not None and old.key == new.key:
+        return
+    old_desc = describe(old, manifest) if old is not None else None
+    new_desc = describe(new, manifest) if new is not None else None
+    old_name = member_name(i, old_desc) if old_desc is not None else None
+    new_name = member_name(i, new_desc) if new_desc is not None else None
+    if old_name != new_name:
+        if old_name is not None:
+            result.removed.append(vjoin(vdir, old_name))
+        if new_name is not None:
+            result.added.append(vjoin(vdir, new_name))
+        return
+    if old_desc["sha1"] == new_desc["sha1"]:
+        return  # only compressed differently
+    vpath = vjoin(vdir, new_name)
+    if new_desc["ext"] == "stm":
+        diff_containers(
+            vpath,
+            submembers(old, old_desc),
+            submembers(new, new_desc),
+            manifest,
+            result,
+        )
+        return
+    result.changed.append(vpath)
+    if "images" in new_desc:
+        old_images = old_desc["images"]
+        new_images = new_desc["images"]
+        result.changed_images[vpath] = [
+            image_i
+            for image_i in range(max(len(old_images), len(new_images)))
+            if image_i >= len(old_images)
+            or image_i >= len(new_images)
+            or old_images[image_i] != new_images[image_i]
+        ]
+
+
+def diff_containers(
+    vdir: str,
+    old_members: list[_Member],
+    new_members: list[_Member],
+    manifest: dict,
+    result: DiffResult,
+) -> None:
+    for i in range(max(len(old_members), len(new_members))):
+        old = old_members[i] if i < len(old_members) else None
+        new = new_members[i] if i < len(new_members) else None
+        diff_members(vdir, i, old, new, manifest, result)
+
+
+# each worker process's copy of the hash manifest, see _init_worker
+_worker_manifest = None
+
+
+def _init_worker(manifest: dict) -> None:
+    global _worker_manifest
+    _worker_manifest = manifest
+
+
+def _diff_top_member(
+    i: int, old: Optional[tuple[str, bytes]], new: Optional[tuple[str, bytes]]
+) -> tuple[DiffResult, dict]:
+    """compare member i of the two STMs, given as (hash, data), in a worker process
+
+    :return: the differences, and what was added to the hash manifest
+    """
+    manifest = {}
+    # look things up in the worker's copy, but only return what's new
+    lookup = _ManifestOverlay(_worker_manifest, manifest)
+    result = DiffResult()
+    old_member = _Member(old[0], lambda: old[1]) if old is not None else None
+    new_member = _Member(new[0], lambda: new[1]) if new is not None else None
+    diff_members("", i, old_member, new_member, lookup, result)
+    return result, manifest
+
+
+class _ManifestOverlay:
+    """a manifest that reads from base too, but only stores into new"""
+
+    def __init__(self, base: dict, new: dict):
+        self.base = base
+        self.new = new
+
+    def get(self, key, default=None):
+        value = self.new.get(key)
+        if value is None:
+            value = self.base.get(key, default)
+        return value
+
+    def __setitem__(self, key, value):
+        self.new[key] = value
+
+
+def diff_stm(
+    old_path, new_path, manifest: Optional[dict] = None, jobs: int = 1
+) -> DiffResult:
+    """compare two STM files
+
+    :param manifest: hash manifest to look members up in and add new ones to
+    :param jobs: number of worker processes to compare differing top-level members
+        with
+    :raises GHSDiffError: if either isn't a valid STM file
+    """
+    if manifest is None:
+        manifest = {}
+    result = DiffResult()
+    with open(old_path, "rb") as old_file, open(new_path, "rb") as new_file:
+        with mmap.mmap(
+            old_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as old_data, mmap.mmap(
+            new_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as new_data:
+            top_members = []
+            for path, data in ((old_path, old_data), (new_path, new_data)):
+                if not quickcheck_stm_file(BinaryCursor(data)):
+                    raise GHSDiffError(f"{path} is not a valid STM file")
+                entries = read_stm_entries(BinaryCursor(data))
+                top_members.append(
+                    [
+                        (sha1(data[offset : offset + size]), offset, size)
+                        for offset, size in entries
+                    ]
+                )
+            old_members, new_members = top_members
+
+            def load(data, member):
+                if member is None:
+                    return None
+                key, offset, size = member
+                return key, data[offset : offset + size]
+
+            # only the members that differ are loaded and compared
+            pairs = []
+            for i in range(max(len(old_members), len(new_members))):
+                old = old_members[i] if i < len(old_members) else None
+                new = new_members[i] if i < len(new_members) else None
+                if old is None or new is None or old[0] != new[0]:
+                    pairs.append((i, old, new))
+
+            if jobs > 1 and len(pairs) > 1:
+                from concurrent.futures import (
+                    FIRST_COMPLETED,
+                    ProcessPoolExecutor,
+                    wait,
+                )
+
+                with ProcessPoolExecutor(
+                    jobs, initializer=_init_worker, initargs=(manifest,)
+                ) as executor:
+                    # at most 2*jobs members' data are loaded at once
+                    pairs.reverse()
+                    pending = set()
+                    while pairs or pending:
+                        while pairs and len(pending) < jobs * 2:
+                            i, old, new = pairs.pop()
+                            pending.add(
+                                executor.submit(
+                                    _diff_top_member,
+                                    i,
+                                    load(old_data, old),
+                                    load(new_data, new),
+                                )
+                            )
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            member_result, new_entries = future.result()
+                            result.extend(member_result)
+                            manifest.update(new_entries)
+            else:
+                for i, old, new in pairs:
+                    old_member = new_member = None
+                    if old is not None:
+                        old_member = _Member(
+                            old[0], lambda old=old: load(old_data, old)[1]
+                        )
+                    if new is not None:
+                        new_member = _Member(
+                            new[0], lambda new=new: load(new_data, new)[1]
+                        )
+                    diff_members("", i, old_member, new_member, manifest, result)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,12 @@
-from io import SEEK_CUR
+import os
+import struct
+import sys
+import zipfile
+from array import array
+from contextlib import contextmanager
+from io import SEEK_CUR, SEEK_END, SEEK_SET, BytesIO
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
 
 
 def keep_file_seek_position(func):
@@ -15,8 +23,262 @@ def keep_file_seek_position(func):
 
 def is_eof(file):
     """return True if file is at exactly the end of its data"""
+    if isinstance(file, BinaryCursor):
+        return file.eof
     b = file.read(1)
     was_already_eof = len(b) == 0
     if not was_already_eof:
         file.seek(-1, SEEK_CUR)
     return was_already_eof
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    """open a temporary file for writing, and rename it to path once it's complete
+
+    This way, path never contains a partially written file, even if the process is
+    killed while writing. If an exception occurs, the temporary file is removed and
+    path is left untouched.
+    """
+    path = Path(path)
+    tmppath = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmppath, mode) as file:
+            yield file
+        os.replace(tmppath, path)
+    except BaseException:
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+def as_buffer(file):
+    """return all of file's data as a buffer, without copying it where possible
+
+    :param file: bytes-like object (returned as-is), BinaryCursor or BytesIO (their
+        buffer is returned), or open file (memory-mapped if possible, read otherwise)
+    """
+    if isinstance(file, (bytes, bytearray, memoryview, mmap)):
+        return file
+    if isinstance(file, BinaryCursor):
+        return file.view
+    if isinstance(file, BytesIO):
+        return file.getbuffer()
+    try:
+        return mmap(file.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        file.seek(0)
+        return file.read()
+
+
+class BinaryCursor:
+    """read position in a buffer, for parsing binary data without any file I/O
+
+    Reads are bounds-checked, and views of the data (read_view, subcursor) are
+    memoryview slices rather than copies. Also has read/seek/tell, so it can be passed
+    to anything that expects an open binary file.
+
+    :param data: bytes-like object or mmap
+    :param pos: initial read position
+    """
+
+    def __init__(self, data, pos: int = 0):
+        self.view = memoryview(data).cast("B")
+        self.pos = pos
+
+    @classmethod
+    def from_file(cls, file) -> "BinaryCursor":
+        """return a cursor over all of file's data, positioned at file's read position
+
+        :param file: BinaryCursor (returned as-is), bytes-like object or open file.
+            Open files are memory-mapped if possible, otherwise read into memory
+        """
+        if isinstance(file, BinaryCursor):
+            return file
+        if isinstance(file, (bytes, bytearray, memoryview, mmap)):
+            return cls(file)
+        if isinstance(file, BytesIO):
+            # getvalue shares BytesIO's buffer rather than copying it, and unlike
+            # getbuffer doesn't stop the BytesIO from being closed or resized
+            return cls(file.getvalue(), file.tell())
+        return cls(as_buffer(file), file.tell())
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    @property
+    def remaining(self) -> int:
+        """number of bytes after the read position, 0 if it's past the end"""
+        return max(0, len(self.view) - self.pos)
+
+    @property
+    def eof(self) -> bool:
+        return self.pos >= len(self.view)
+
+    def _check(self, offset: int, size: int) -> None:
+        if offset < 0 or offset + size > len(self.view):
+            raise EOFError(
+                f"can't read {size} bytes at {offset:#x}, "
+                f"data is only {len(self.view):#x} bytes long"
+            )
+
+    def has(self, size: int) -> bool:
+        """return True if at least size bytes are left to read"""
+        return 0 <= self.pos and self.pos + size <= len(self.view)
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        """unpack fmt at the read position and move past it
+
+        :raises EOFError: if there isn't enough data left
+        """
+        self._check(self.pos, fmt.size)
+        values = fmt.unpack_from(self.view, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def unpack_from(self, fmt: struct.Struct, offset: int) -> tuple:
+        """unpack fmt at offset, without moving the read position
+
+        :raises EOFError: if there isn't enough data at offset
+        """
+        self._check(offset, fmt.size)
+        return fmt.unpack_from(self.view, offset)
+
+    def u8(self) -> int:
+        return self.unpack(U8)[0]
+
+    def u16(self) -> int:
+        return self.unpack(U16)[0]
+
+    def u32(self) -> int:
+        return self.unpack(U32)[0]
+
+    def s32(self) -> int:
+        return self.unpack(S32)[0]
+
+    def f32(self) -> float:
+        return self.unpack(F32)[0]
+
+    def skip(self, size: int) -> None:
+        """move the read position forward by size bytes
+
+        :raises EOFError: if there aren't that many bytes left
+        """
+        self._check(self.pos, size)
+        self.pos += size
+
+    def read_view(self, size: int) -> memoryview:
+        """return the next size bytes as a memoryview (no copy), and move past them
+
+        :raises EOFError: if there aren't that many bytes left
+        """
+        self._check(self.pos, size)
+        view = self.view[self.pos : self.pos + size]
+        self.pos += size
+        return view
+
+    def subcursor(self, size: int) -> "BinaryCursor":
+        """return a cursor over the next size bytes, and move past them"""
+        return BinaryCursor(self.read_view(size))
+
+    # file-like methods, reading past the end returns less data as files do
+
+    def read(self, size: int = -1) -> bytes:
+        start = min(self.pos, len(self.view))
+        end = len(self.view) if size < 0 else min(start + size, len(self.view))
+        self.pos = max(self.pos, end)
+        return bytes(self.view[start:end])
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_CUR:
+            offset += self.pos
+        elif whence == SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+
+@contextmanager
+def reading(file):
+    """with reading(file) as cursor: parse file through a BinaryCursor
+
+    :param file: BinaryCursor (used as-is), open file or bytes-like object. The
+        cursor starts at an open file's read position, and afterwards the file is
+        moved to wherever the cursor stopped, same as if it had been read directly
+    """
+    cursor = BinaryCursor.from_file(file)
+    try:
+        yield cursor
+    finally:
+        if cursor is not file and hasattr(file, "seek"):
+            file.seek(cursor.pos)
+
+
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+S32 = struct.Struct("<i")
+F32 = struct.Struct("<f")
+
+
+# typecodes of array.array/memoryview: dtype descriptions of the .npy format
+_npy_descrs = {
+    "b": "|i1",
+    "B": "|u1",
+    "h": "<i2",
+    "H": "<u2",
+    "i": "<i4",
+    "I": "<u4",
+    "f": "<f4",
+    "d": "<f8",
+}
+
+
+def npy_bytes(values, shape: tuple[int, ...]) -> bytes:
+    """return values in the .npy file format, so that numpy isn't needed to write it
+
+    :param values: array.array or 1-dimensional memoryview, in native byte order. It's
+        written little-endian, as the header says, so it's byteswapped on big-endian
+        machines
+    :param shape: shape of the array, e.g. (num_frames, 6)
+    """
+    typecode = values.typecode if hasattr(values, "typecode") else values.format
+    shape_str = (
+        f"({shape[0]},)" if len(shape) == 1 else f"({', '.join(map(str, shape))})"
+    )
+    header = (
+        f"{{'descr': '{_npy_descrs[typecode]}', 'fortran_order': False, "
+        f"'shape': {shape_str}, }}"
+    )
+    # magic + version + header length + header + newline must be a multiple of 64
+    header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+    header_bytes = header.encode("latin1")
+    if sys.byteorder != "little":
+        values = array(typecode, values)  # a copy, values itself stays as it is
+        values.byteswap()
+    return (
+        b"\x93NUMPY\x01\x00"
+        + struct.pack("<H", len(header_bytes))
+        + header_bytes
+        + memoryview(values).cast("B").tobytes()
+    )
+
+
+def write_npz(file, arrays: dict) -> None:
+    """write arrays as an uncompressed .npz file, same as numpy.savez would
+
+    :param file: path or open binary file
+    :param arrays: name: (values, shape), see npy_bytes
+    """
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_STORED) as npzfile:
+        for name, (values, shape) in arrays.items():
+            # fixed timestamp, so that the same arrays always give the same file
+            info = zipfile.ZipInfo(f"{name}.npy", date_time=(1980, 1, 1, 0, 0, 0))
+            npzfile.writestr(info, npy_bytes(values, shape))
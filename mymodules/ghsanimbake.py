@@ -0,0 +1,97 @@
+"""Bake modelmeta animations into dense per-frame tracks
+
+The .ghs animations store sparse keyframes per body part: each keyframe applies from
+its keyframe_start until the next keyframe's, and the last one has a keyframe_start of
+999 or more. Baking evaluates every body part at every frame 0..anim_len-1, so that a
+frame can be looked up directly instead of searching for its keyframe.
+
+For each frame, a body part's active keyframe is the last one whose keyframe_start is
+at or before the frame. Its pm2 is shown, and its value is
+interp_start + interp_delta * (frame - keyframe_start). Frames without an active
+keyframe get a pm2 and interp_type of -1 and a value of 0.
+
+What interp_type means isn't known: none of these tools (or the parsers of the
+executable) interpret it. interp_start and interp_delta are a starting value and a
+change per frame, which on their own only describe a linear ramp, so that's what every
+keyframe is baked as. interp_type is baked alongside the values, so that a consumer
+that learns a type means something else can still tell those frames apart.
+
+NumPy isn't a dependency, so the arrays are array.arrays, and each keyframe's frames
+are filled with one slice assignment into the animation's (anim_len, body parts)
+array. The interpolated values are generated by map() over a range, without a Python
+loop per frame.
+"""
+from array import array
+from math import ceil
+from typing import Iterator
+
+from mymodules.common import write_npz
+
+
+def keyframe_ranges(keyframes: list, anim_len: int) -> Iterator[tuple[int, int, dict]]:
+    """yield (first frame, end frame, keyframe) of each keyframe that is active for at
+    least one of an animation's anim_len frames
+
+    :param keyframes: a body part's keyframes, as in a .ghs file
+    """
+    for i, kf in enumerate(keyframes):
+        start = max(0, ceil(kf["keyframe_start"]))  # first whole frame
+        if i + 1 < len(keyframes):
+            end = min(anim_len, ceil(keyframes[i + 1]["keyframe_start"]))
+        else:
+            end = anim_len
+        if start < end:
+            yield start, end, kf
+
+
+def bake_anim(anim: dict) -> tuple[array, array, array]:
+    """return the pm2, interp_type and value of each frame of each of an animation's
+    body parts, as flat frame-major arrays of shape (anim_len, number of body parts)
+
+    :param anim: an animation, as in a .ghs file
+    """
+    anim_len = max(0, anim["anim_len"])
+    tracks = anim["animation_data"]
+    num_tracks = len(tracks)
+    # frame-major, so that all body parts of one frame are next to each other
+    pm2s = array("b", [-1]) * (anim_len * num_tracks)
+    interp_types = array("b", [-1]) * (anim_len * num_tracks)
+    values = array("f", bytes(4 * anim_len * num_tracks))
+    for track_i, keyframes in enumerate(tracks):
+        for start, end, kf in keyframe_ranges(keyframes, anim_len):
+            num_frames = end - start
+            # this body part's column, from frame start to frame end
+            frames = slice(start * num_tracks + track_i, end * num_tracks, num_tracks)
+            pm2 = -1 if kf["pm2"] is None else kf["pm2"]
+            pm2s[frames] = array("b", [pm2]) * num_frames
+            interp_types[frames] = array("b", [kf["interp_type"]]) * num_frames
+            delta = float(kf["interp_delta"])
+            # the value at frame start, then delta more at each following frame
+            first = kf["interp_start"] + delta * (start - kf["keyframe_start"])
+            values[frames] = array(
+                "f", map(first.__add__, map(delta.__mul__, range(num_frames)))
+            )
+    return pm2s, interp_types, values
+
+
+def bake_anims(allanims: list) -> dict:
+    """bake all of a model's animations
+
+    :param allanims: the model's animations, as in a .ghs file
+    :return: arrays for common.write_npz. For each animation ###, anim###_pm2,
+        anim###_interp_type (int8) and anim###_value (float32) of shape
+        (anim_len, number of body parts)
+    """
+    arrays = {}
+    for anim_i, anim in enumerate(allanims):
+        pm2s, interp_types, values = bake_anim(anim)
+        shape = (max(0, anim["anim_len"]), len(anim["animation_data"]))
+        arrays[f"anim{anim_i:03}_pm2"] = (pm2s, shape)
+        arrays[f"anim{anim_i:03}_interp_type"] = (interp_types, shape)
+        arrays[f"anim{anim_i:03}_value"] = (values, shape)
+    return arrays
+
+
+def write_baked_anims(file, allanims: list) -> None:
+    """bake all of a model's animations and write them to an .npz file"""
+    write_npz(file, bake_anims(allanims))
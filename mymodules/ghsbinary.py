@@ -0,0 +1,231 @@
+"""Compact binary version of the .ghs modelmeta format (.ghsb)
+
+Holds the same data as a .ghs file, but as fixed-width little-endian records that can
+be used straight from the file's buffer instead of being parsed from JSON:
+
+    header          "GHSB", u16 version, u16 num_bones, u16 num_default_body_parts,
+                    u16 num_anims, u32 num_tracks, u32 num_keyframes
+    bones           num_bones * (s16 parent, s16 unk1, f32 posx, f32 posy, f32 posz)
+    body parts      num_default_body_parts * (s16 pm2, s16 unk)
+    anims           num_anims * (s32 anim_len, u32 first track, u32 num tracks)
+    track index     (num_tracks + 1) * u32, track i's keyframes are
+                    keyframes[index[i]:index[i + 1]]
+    keyframes       num_keyframes * (f32 keyframe_start, u8 boneidx_unused, s8 pm2,
+                    s8 interp_type, u8 unknown, f32 interp_start, f32 interp_delta)
+
+A track is one body part's keyframes within one animation. -1 stands for null
+parents/pm2s, the same as in the executable. Every record is a multiple of 4 bytes
+long, so all arrays are 4-byte aligned.
+"""
+import sys
+from array import array
+from struct import Struct
+from typing import Iterator
+
+GHSB_MAGIC = b"GHSB"
+GHSB_VERSION = 1
+
+_header_struct = Struct("<4sHHHHII")
+_bone_struct = Struct("<hh3f")
+_bodypart_struct = Struct("<hh")
+_anim_struct = Struct("<iII")
+_index_struct = Struct("<I")
+_keyframe_struct = Struct("<fBbbBff")
+
+# numpy dtype equivalent of a keyframe record, see GHSBinary.keyframes_array
+KEYFRAME_FIELDS = (
+    ("keyframe_start", "<f4"),
+    ("boneidx_unused", "u1"),
+    ("pm2", "i1"),
+    ("interp_type", "i1"),
+    ("unknown", "u1"),
+    ("interp_start", "<f4"),
+    ("interp_delta", "<f4"),
+)
+
+
+class GHSBinaryError(ValueError):
+    pass
+
+
+def _none_to_minus1(value):
+    return -1 if value is None else value
+
+
+def _minus1_to_none(value):
+    return None if value == -1 else value
+
+
+def ghsb_bytes(boneparentinfo: list, defaultbodyparts: list, allanims: list) -> bytes:
+    """return the .ghsb file contents of a model
+
+    Arguments are the same as the bone_parenting_info, default_body_parts and
+    animations of a .ghs file.
+    """
+    tracks = [track for anim in allanims for track in anim["animation_data"]]
+    num_keyframes = sum(len(track) for track in tracks)
+    out = bytearray(
+        _header_struct.pack(
+            GHSB_MAGIC,
+            GHSB_VERSION,
+            len(boneparentinfo),
+            len(defaultbodyparts),
+            len(allanims),
+            len(tracks),
+            num_keyframes,
+        )
+    )
+    for bone in boneparentinfo:
+        out += _bone_struct.pack(
+            _none_to_minus1(bone["parent"]),
+            bone["unk1"],
+            bone["posx"],
+            bone["posy"],
+            bone["posz"],
+        )
+    for bodypart in defaultbodyparts:
+        out += _bodypart_struct.pack(_none_to_minus1(bodypart["pm2"]), bodypart["unk"])
+    first_track = 0
+    for anim in allanims:
+        num_tracks = len(anim["animation_data"])
+        out += _anim_struct.pack(anim["anim_len"], first_track, num_tracks)
+        first_track += num_tracks
+    keyframe_i = 0
+    for track in tracks:
+        out += _index_struct.pack(keyframe_i)
+        keyframe_i += len(track)
+    out += _index_struct.pack(keyframe_i)
+    for track in tracks:
+        for kf in track:
+            out += _keyframe_struct.pack(
+                kf["keyframe_start"],
+                kf["boneidx_unused"],
+                _none_to_minus1(kf["pm2"]),
+                kf["interp_type"],
+                kf["unknown"],
+                kf["interp_start"],
+                kf["interp_delta"],
+            )
+    return bytes(out)
+
+
+class GHSBinary:
+    """read-only view of .ghsb data, nothing is copied or parsed until it's used
+
+    bones, defaultbodyparts, anims and keyframes are memoryviews of the respective
+    arrays' bytes; track_index is a memoryview of u32s.
+    """
+
+    def __init__(self, data):
+        """:param data: bytes-like object or mmap containing the whole .ghsb file"""
+        view = memoryview(data)
+        if len(view) < _header_struct.size:
+            raise GHSBinaryError("Not a .ghsb file (too short)")
+        (
+            magic,
+            version,
+            self.num_bones,
+            self.num_defaultbodyparts,
+            self.num_anims,
+            self.num_tracks,
+            self.num_keyframes,
+        ) = _header_struct.unpack_from(view)
+        if magic != GHSB_MAGIC:
+            raise GHSBinaryError("Not a .ghsb file (wrong magic)")
+        if version != GHSB_VERSION:
+            raise GHSBinaryError(f"Unsupported .ghsb version {version}")
+
+        pos = _header_struct.size
+        sections = []
+        for count, struct in (
+            (self.num_bones, _bone_struct),
+            (self.num_defaultbodyparts, _bodypart_struct),
+            (self.num_anims, _anim_struct),
+            (self.num_tracks + 1, _index_struct),
+            (self.num_keyframes, _keyframe_struct),
+        ):
+            end = pos + count * struct.size
+            sections.append(view[pos:end])
+            pos = end
+        if pos != len(view):
+            raise GHSBinaryError(".ghsb file size doesn't match its header")
+        (
+            self.bones,
+            self.defaultbodyparts,
+            self.anims,
+            track_index,
+            self.keyframes,
+        ) = sections
+        self.track_index = track_index.cast("I")
+        if sys.byteorder != "little":
+            self.track_index = array("I", self.track_index)
+            self.track_index.byteswap()
+
+    def track_keyframes(self, track: int) -> memoryview:
+        """return the keyframe records of track as a memoryview, without copying"""
+        start = self.track_index[track] * _keyframe_struct.size
+        end = self.track_index[track + 1] * _keyframe_struct.size
+        return self.keyframes[start:end]
+
+    def iter_track(self, track: int) -> Iterator[tuple]:
+        """yield track's keyframes as (keyframe_start, boneidx_unused, pm2,
+        interp_type, unknown, interp_start, interp_delta) tuples"""
+        return _keyframe_struct.iter_unpack(self.track_keyframes(track))
+
+    def anim_tracks(self, anim: int) -> range:
+        """return the track numbers of anim's body parts"""
+        anim_len, first_track, num_tracks = _anim_struct.unpack_from(
+            self.anims, anim * _anim_struct.size
+        )
+        return range(first_track, first_track + num_tracks)
+
+    def keyframes_array(self):
+        """return all keyframes as a numpy structured array sharing the file's buffer
+
+        Requires numpy, which is otherwise not needed.
+        """
+        import numpy
+
+        return numpy.frombuffer(
+            self.keyframes, dtype=numpy.dtype(list(KEYFRAME_FIELDS))
+        )
+
+    def to_ghs(self) -> dict:
+        """return the same dict as is stored in the equivalent .ghs file"""
+        boneparentinfo = [
+            {
+                "parent": _minus1_to_none(parent),
+                "unk1": unk1,
+                "posx": posx,
+                "posy": posy,
+                "posz": posz,
+            }
+            for parent, unk1, posx, posy, posz in _bone_struct.iter_unpack(self.bones)
+        ]
+        defaultbodyparts = [
+            {"pm2": _minus1_to_none(pm2), "unk": unk}
+            for pm2, unk in _bodypart_struct.iter_unpack(self.defaultbodyparts)
+        ]
+        allanims = []
+        for anim_i, (anim_len, _, _) in enumerate(_anim_struct.iter_unpack(self.anims)):
+            animation_data = [
+                [
+                    {
+                        "keyframe_start": kf[0],
+                        "boneidx_unused": kf[1],
+                        "pm2": _minus1_to_none(kf[2]),
+                        "interp_type": kf[3],
+                        "unknown": kf[4],
+                        "interp_start": kf[5],
+                        "interp_delta": kf[6],
+                    }
+                    for kf in self.iter_track(track)
+                ]
+                for track in self.anim_tracks(anim_i)
+            ]
+            allanims.append({"anim_len": anim_len, "animation_data": animation_data})
+        return {
+            "bone_parenting_info": boneparentinfo,
+            "default_body_parts": defaultbodyparts,
+            "animations": allanims,
+        }
@@ -1,9 +1,28 @@
-from struct import unpack
-from typing import BinaryIO
+import json
+from struct import Struct
+from typing import NamedTuple
 
 modelmeta_start = 0x1FF510
 modelmeta_len = 0x45A
 
+# precompiled, all parsing below is done with unpack_from on the executable's data
+_modelmeta_struct = Struct("<IIIi")
+_s32 = Struct("<i")
+_u32 = Struct("<I")
+_bone_struct = Struct("<hhfff")
+_bodypart_struct = Struct("<hh")
+_animbodypart_struct = Struct("<iI")
+_keyframe_struct = Struct("<fBbbBff")
+
+
+class ModelMeta(NamedTuple):
+    """one entry of the modelmeta table, pointers are ps2 pointers (0 if absent)"""
+
+    boneparentinfo_pointer: int
+    defaultbodyparts_pointer: int
+    anims_pointer: int
+    stmindex: int
+
 
 def into_executable(ps2_pointer: int) -> int:
     """from a ps2 pointer, return the equivalent pointer into the executable data
@@ -14,114 +33,259 @@ def into_executable(ps2_pointer: int) -> int:
     return ps2_pointer - 0xFFF80
 
 
-def get_stmindex(modelmeta_index: int, execfile: BinaryIO) -> int:
-    stmindex_start = modelmeta_start + (0x10 * modelmeta_index) + 0xC
-    execfile.seek(stmindex_start)
-    (stmindex,) = unpack("<i", execfile.read(4))
-    return stmindex
+def read_modelmeta_table(execdata) -> list[ModelMeta]:
+    """decode the whole modelmeta table in one pass
+
+    :param execdata: the executable's data (bytes-like object or mmap)
+    """
+    table_end = modelmeta_start + _modelmeta_struct.size * modelmeta_len
+    with memoryview(execdata) as view:
+        table = view[modelmeta_start:table_end]
+        entries = [ModelMeta(*e) for e in _modelmeta_struct.iter_unpack(table)]
+        table.release()
+    return entries
 
 
-def get_boneparentinfo_and_numbones(
-    modelmeta_index: int, execfile: BinaryIO
-) -> tuple[list, int]:
+def parse_boneparentinfo(execdata, pointer: int) -> tuple[list, int]:
+    """return (bone parenting info, number of bones) of the table at ps2 pointer"""
     boneparentinfo = []
-    bpidata_start = modelmeta_start + (0x10 * modelmeta_index)
-    execfile.seek(bpidata_start)
-    (bpipointer,) = unpack("<I", execfile.read(4))
-    if bpipointer == 0:
+    if pointer == 0:
         return boneparentinfo, 0
-    execfile.seek(into_executable(bpipointer))
-    (sentinel,) = unpack("<i", execfile.read(4))
-    numbones = 0
+    pos = into_executable(pointer)
+    (sentinel,) = _s32.unpack_from(execdata, pos)
+    pos += 4
     while sentinel != -1:
-        numbones += 1
-        parent, unk1, posx, posy, posz = unpack("<hhfff", execfile.read(16))
+        parent, unk1, posx, posy, posz = _bone_struct.unpack_from(execdata, pos)
         if parent == -1:
             parent = None
         boneparentinfo.append(
             {"parent": parent, "unk1": unk1, "posx": posx, "posy": posy, "posz": posz}
         )
-        (sentinel,) = unpack("<i", execfile.read(4))
-    return boneparentinfo, numbones
+        (sentinel,) = _s32.unpack_from(execdata, pos + 16)
+        pos += 20
+    return boneparentinfo, len(boneparentinfo)
 
 
-def get_default_body_parts(modelmeta_index: int, numbones: int, execfile: BinaryIO):
+def parse_default_body_parts(execdata, pointer: int, numbones: int) -> list:
     defaultbodyparts = []
-    dbpdata_start = modelmeta_start + (0x10 * modelmeta_index) + 4
-    execfile.seek(dbpdata_start)
-    (dbppointer,) = unpack("<I", execfile.read(4))
-    if dbppointer == 0:
+    if pointer == 0:
         return defaultbodyparts
-    execfile.seek(into_executable(dbppointer))
-
+    pos = into_executable(pointer)
     for x in range(numbones):
-        defaultbodypart, unk = unpack("<hh", execfile.read(4))
+        defaultbodypart, unk = _bodypart_struct.unpack_from(execdata, pos + 4 * x)
         if defaultbodypart == -1:
             defaultbodypart = None
         defaultbodyparts.append({"pm2": defaultbodypart, "unk": unk})
     return defaultbodyparts
 
 
-def get_anims(modelmeta_index: int, numbones: int, execfile: BinaryIO):
-    allanims = []
-    allanimsdata_start = modelmeta_start + (0x10 * modelmeta_index) + 8
-    execfile.seek(allanimsdata_start)
-    (allanimspointer,) = unpack("<I", execfile.read(4))
-    if allanimspointer == 0:
-        return allanims
+def parse_bodypart_keyframes(execdata, pointer: int) -> list:
+    """return the keyframes at ps2 pointer, up to and including the one at >= 999"""
+    keyframes = []
+    pos = into_executable(pointer)
+    while True:
+        (
+            keyframestart,
+            boneidx_unused,
+            pm2,
+            interp_type,
+            bpkf_unk,
+            interp_start,
+            interp_delta,
+        ) = _keyframe_struct.unpack_from(execdata, pos)
+        pos += _keyframe_struct.size
+        if pm2 == -1:
+            pm2 = None
+        keyframes.append(
+            {
+                "keyframe_start": keyframestart,
+                "boneidx_unused": boneidx_unused,
+                "pm2": pm2,
+                "interp_type": interp_type,
+                "unknown": bpkf_unk,
+                "interp_start": interp_start,
+                "interp_delta": interp_delta,
+            }
+        )
+        if keyframestart >= 999:
+            return keyframes
+
+
+def parse_anim_bodyparts(
+    execdata, pointer: int, numbones: int, get_keyframes=parse_bodypart_keyframes
+) -> list:
+    """return the keyframes of each of an animation's numbones body parts
+
+    :param get_keyframes: function(execdata, pointer) used to parse each body part's
+        keyframes
+    """
+    this_anim = []
+    pos = into_executable(pointer)
+    for x in range(numbones):
+        abp_unk, bodypartkeyframes_pointer = _animbodypart_struct.unpack_from(
+            execdata, pos + 8 * x
+        )
+        if bodypartkeyframes_pointer != 0:
+            this_anim.append(get_keyframes(execdata, bodypartkeyframes_pointer))
+        else:
+            this_anim.append([])
+    return this_anim
+
 
+def parse_anims(
+    execdata, pointer: int, numbones: int, get_keyframes=parse_bodypart_keyframes
+) -> list:
     # allanims pointer
     #  list of: (s32 num frames, u32 pointer to allbodyparts)
     #   list of: pointer to a body part keyframes
     #    list of: keyframe
-
-    execfile.seek(into_executable(allanimspointer))
-    (num_frames,) = unpack("<i", execfile.read(4))
+    allanims = []
+    if pointer == 0:
+        return allanims
+    pos = into_executable(pointer)
+    (num_frames,) = _s32.unpack_from(execdata, pos)
     while num_frames != -1:
-        this_anim = []
-        (animbodyparts_pointer,) = unpack("<I", execfile.read(4))
+        (animbodyparts_pointer,) = _u32.unpack_from(execdata, pos + 4)
         if animbodyparts_pointer != 0:
-            savemyplace_in_allanims = execfile.tell()
-            execfile.seek(into_executable(animbodyparts_pointer))
-
-            for x in range(numbones):
-                this_bodypart = []
-                abp_unk, bodypartkeyframes_pointer = unpack("<iI", execfile.read(8))
-                if bodypartkeyframes_pointer != 0:
-                    savemyplace_in_animbodyparts = execfile.tell()
-
-                    execfile.seek(into_executable(bodypartkeyframes_pointer))
-                    while True:
-                        (keyframestart,) = unpack("<f", execfile.read(4))
-                        (
-                            boneidx_unused,
-                            pm2,
-                            interp_type,
-                            bpkf_unk,
-                            interp_start,
-                            interp_delta,
-                        ) = unpack("<BbbBff", execfile.read(12))
-                        if pm2 == -1:
-                            pm2 = None
-                        this_keyframe = {
-                            "keyframe_start": keyframestart,
-                            "boneidx_unused": boneidx_unused,
-                            "pm2": pm2,
-                            "interp_type": interp_type,
-                            "unknown": bpkf_unk,
-                            "interp_start": interp_start,
-                            "interp_delta": interp_delta,
-                        }
-                        this_bodypart.append(this_keyframe)
-                        if keyframestart >= 999:
-                            break
-
-                    execfile.seek(savemyplace_in_animbodyparts)
-                this_anim.append(this_bodypart)
-
-            execfile.seek(savemyplace_in_allanims)
-
+            this_anim = parse_anim_bodyparts(
+                execdata, animbodyparts_pointer, numbones, get_keyframes
+            )
+        else:
+            this_anim = []
         allanims.append({"anim_len": num_frames, "animation_data": this_anim})
-        (num_frames,) = unpack("<i", execfile.read(4))
-
+        pos += 8
+        (num_frames,) = _s32.unpack_from(execdata, pos)
     return allanims
+
+
+class ModelMetaCache:
+    """parses modelmeta tables, each table only once
+
+    Many modelmeta entries point at the same tables (the gregory duplicates, doors,
+    characters and their shadows...), so parsed tables are memoized by their ps2
+    pointer, and by the number of bones for tables whose length depends on it. The
+    same goes for their JSON, so shared tables are also serialized only once.
+
+    hits and misses count, per kind of table, how many lookups were served from the
+    cache and how many tables had to be parsed.
+    """
+
+    kinds = ("bone_parenting_info", "default_body_parts", "animations", "keyframes")
+
+    def __init__(self, execdata):
+        self.execdata = execdata
+        self._tables = {}  # (kind, pointer[, numbones]): parsed table
+        self._json = {}  # same keys: the table's JSON
+        self.hits = dict.fromkeys(self.kinds, 0)
+        self.misses = dict.fromkeys(self.kinds, 0)
+
+    def _get(self, key: tuple, parse):
+        table = self._tables.get(key)
+        if table is None:
+            table = self._tables[key] = parse()
+            self.misses[key[0]] += 1
+        else:
+            self.hits[key[0]] += 1
+        return table
+
+    def get_boneparentinfo(self, pointer: int) -> tuple[list, int]:
+        key = ("bone_parenting_info", pointer)
+        return self._get(key, lambda: parse_boneparentinfo(self.execdata, pointer))
+
+    def get_default_body_parts(self, pointer: int, numbones: int) -> list:
+        key = ("default_body_parts", pointer, numbones)
+        return self._get(
+            key, lambda: parse_default_body_parts(self.execdata, pointer, numbones)
+        )
+
+    def get_anims(self, pointer: int, numbones: int) -> list:
+        key = ("animations", pointer, numbones)
+        return self._get(
+            key,
+            lambda: parse_anims(self.execdata, pointer, numbones, self._get_keyframes),
+        )
+
+    def _get_keyframes(self, execdata, pointer: int) -> list:
+        key = ("keyframes", pointer)
+        return self._get(key, lambda: parse_bodypart_keyframes(execdata, pointer))
+
+    def _get_json(self, key: tuple, table) -> str:
+        text = self._json.get(key)
+        if text is None:
+            text = self._json[key] = json.dumps(table)
+        return text
+
+    def modelmeta_tables(self, modelmeta: ModelMeta) -> tuple[list, list, list]:
+        """return (bone parenting info, default body parts, animations)"""
+        boneparentinfo, numbones = self.get_boneparentinfo(
+            modelmeta.boneparentinfo_pointer
+        )
+        return (
+            boneparentinfo,
+            self.get_default_body_parts(modelmeta.defaultbodyparts_pointer, numbones),
+            self.get_anims(modelmeta.anims_pointer, numbones),
+        )
+
+    def modelmeta_json(self, modelmeta: ModelMeta, tables: tuple = None) -> str:
+        """return the .ghs file contents of a modelmeta entry
+
+        The same as json.dump() of a dict with the bone_parenting_info,
+        default_body_parts and animations keys.
+
+        :param tables: the entry's modelmeta_tables(), if already looked up
+        """
+        if tables is None:
+            tables = self.modelmeta_tables(modelmeta)
+        numbones = len(tables[0])
+        keys = (
+            ("bone_parenting_info", modelmeta.boneparentinfo_pointer),
+            ("default_body_parts", modelmeta.defaultbodyparts_pointer, numbones),
+            ("animations", modelmeta.anims_pointer, numbones),
+        )
+        fragments = tuple(self._get_json(k, t) for k, t in zip(keys, tables))
+        return (
+            '{"bone_parenting_info": %s, "default_body_parts": %s, '
+            '"animations": %s}' % fragments
+        )
+
+    def stats(self) -> list[str]:
+        """return a line per kind of table: how many were parsed and reused"""
+        return cache_stats(self.hits, self.misses)
+
+
+def cache_stats(hits: dict, misses: dict) -> list[str]:
+    """return ModelMetaCache.stats() of the given hits and misses per kind of table,
+    such as the totals of several caches"""
+    return [
+        f"{kind}: {misses[kind]} parsed, {hits[kind]} reused"
+        for kind in ModelMetaCache.kinds
+    ]
+
+
+# the functions below parse the entry at modelmeta_index, as used before
+# read_modelmeta_table existed. They take the executable's data (bytes-like object or
+# mmap) like the rest of this module, so that it's mapped or read only once
+
+
+def _get_modelmeta(modelmeta_index: int, execdata) -> ModelMeta:
+    pos = modelmeta_start + (0x10 * modelmeta_index)
+    return ModelMeta(*_modelmeta_struct.unpack_from(execdata, pos))
+
+
+def get_stmindex(modelmeta_index: int, execdata) -> int:
+    return _get_modelmeta(modelmeta_index, execdata).stmindex
+
+
+def get_boneparentinfo_and_numbones(modelmeta_index: int, execdata) -> tuple[list, int]:
+    pointer = _get_modelmeta(modelmeta_index, execdata).boneparentinfo_pointer
+    return parse_boneparentinfo(execdata, pointer)
+
+
+def get_default_body_parts(modelmeta_index: int, numbones: int, execdata):
+    pointer = _get_modelmeta(modelmeta_index, execdata).defaultbodyparts_pointer
+    return parse_default_body_parts(execdata, pointer, numbones)
+
+
+def get_anims(modelmeta_index: int, numbones: int, execdata):
+    pointer = _get_modelmeta(modelmeta_index, execdata).anims_pointer
+    return parse_anims(execdata, pointer, numbones)
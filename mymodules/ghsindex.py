@@ -0,0 +1,222 @@
+"""SQLite index of everything inside an STM, for answering questions about its
+contents without unpacking it
+
+members has a row per content file at any nesting level:
+    vpath               path it's unpacked to, e.g. "029.stm/000.sli.stm/003.pm2"
+    parent              vpath of the container it's in, "" for the STM itself
+    idx                 index within parent
+    type                file type (extension), "stm" for containers
+    offset              offset within parent's (decompressed) data
+    file_offset         offset within the STM file, NULL if it's inside a .sli
+    size                size as stored in parent, compressed if it's a .sli
+    decompressed_size   size after decompressing, NULL if it isn't a .sli
+    sha1                hash of the contents (after decompressing)
+
+textures has a row per image of each .tex/.tex2 member, read from the image headers:
+    vpath, image_index, pixfmt, width, height, palette_size (number of colors),
+    tex_offset, swizzled
+"""
+import os
+import sqlite3
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from mymodules.ghsteximage import TexHeader
+
+INDEX_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE members (
+    vpath TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    file_offset INTEGER,
+    size INTEGER NOT NULL,
+    decompressed_size INTEGER,
+    sha1 TEXT NOT NULL
+);
+CREATE TABLE textures (
+    vpath TEXT NOT NULL REFERENCES members (vpath),
+    image_index INTEGER NOT NULL,
+    pixfmt TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    palette_size INTEGER NOT NULL,
+    tex_offset INTEGER NOT NULL,
+    swizzled INTEGER NOT NULL,
+    PRIMARY KEY (vpath, image_index)
+);
+"""
+# created after the bulk insert, which is faster than updating them for every row
+_INDEXES = """
+CREATE INDEX members_parent ON members (parent);
+CREATE INDEX members_type_size ON members (type, size);
+CREATE INDEX members_size ON members (coalesce(decompressed_size, size));
+CREATE INDEX members_sha1 ON members (sha1);
+CREATE INDEX textures_format ON textures (pixfmt, width, height);
+"""
+
+
+class GHSIndexError(ValueError):
+    pass
+
+
+class IndexWriter:
+    """collects rows for a new index, which write() then inserts all at once"""
+
+    def __init__(self):
+        self.members = []
+        self.textures = []
+
+    def add_member(
+        self,
+        vpath: str,
+        parent: str,
+        idx: int,
+        filetype: str,
+        offset: int,
+        file_offset: Optional[int],
+        size: int,
+        decompressed_size: Optional[int],
+        sha1: str,
+    ) -> None:
+        self.members.append(
+            (
+                vpath,
+                parent,
+                idx,
+                filetype,
+                offset,
+                file_offset,
+                size,
+                decompressed_size,
+                sha1,
+            )
+        )
+
+    def add_textures(self, vpath: str, headers: Iterable[TexHeader]) -> None:
+        self.textures.extend(
+            (
+                vpath,
+                i,
+                h.pixfmt,
+                h.width,
+                h.height,
+                h.palette_size,
+                h.tex_offset,
+                h.pixels_swizzled,
+            )
+            for i, h in enumerate(headers)
+        )
+
+    def write(self, path: Union[str, os.PathLike], source_name: str = "") -> None:
+        """write the index to a new SQLite database at path, replacing any existing
+        file once it's complete"""
+        path = Path(path)
+        tmppath = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            os.remove(tmppath)
+        except FileNotFoundError:
+            pass
+        conn = sqlite3.connect(tmppath)
+        try:
+            # nothing to protect until the file is renamed into place
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.executescript(_SCHEMA)
+            with conn:  # all rows in one transaction
+                conn.executemany(
+                    "INSERT INTO info VALUES (?, ?)",
+                    (("version", str(INDEX_VERSION)), ("source", source_name)),
+                )
+                conn.executemany(
+                    "INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self.members,
+                )
+                conn.executemany(
+                    "INSERT INTO textures VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    self.textures,
+                )
+            conn.executescript(_INDEXES)
+            conn.execute("ANALYZE")
+            conn.close()
+            os.replace(tmppath, path)
+        except BaseException:
+            conn.close()
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            raise
+
+
+def open_index(path: Union[str, os.PathLike]) -> sqlite3.Connection:
+    """open an index written by IndexWriter, read-only
+
+    :raises GHSIndexError: if path isn't an index, or one of a different version
+    """
+    try:
+        conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+        row = conn.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+    except sqlite3.Error as e:
+        raise GHSIndexError(f"can't read index {path}: {e}") from e
+    if row is None or row[0] != str(INDEX_VERSION):
+        conn.close()
+        raise GHSIndexError(f"{path} is not a version {INDEX_VERSION} index")
+    return conn
+
+
+def query_members(
+    conn: sqlite3.Connection,
+    under: Optional[str] = None,
+    types: Optional[Iterable[str]] = None,
+    min_size: Optional[int] = None,
+    max_size: Optional[int] = None,
+    pixfmt: Optional[str] = None,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+) -> list[tuple[str, str, int]]:
+    """return (vpath, type, size) of the members matching all given conditions
+
+    Sizes are after decompressing.
+
+    :param under: only members inside the container at this vpath
+    :param types: only members of these file types
+    :param pixfmt, width, height: only textures containing an image with these
+    """
+    size = "coalesce(decompressed_size, size)"
+    conditions = []
+    params = []
+    if under:
+        # a range rather than LIKE, so that the primary key's index is used.
+        # "0" is the character after "/"
+        under = under.strip("/")
+        conditions.append("vpath > ? AND vpath < ?")
+        params += [f"{under}/", f"{under}0"]
+    if types is not None:
+        types = list(types)
+        conditions.append(f"type IN ({', '.join('?' * len(types))})")
+        params += types
+    if min_size is not None:
+        conditions.append(f"{size} >= ?")
+        params.append(min_size)
+    if max_size is not None:
+        conditions.append(f"{size} <= ?")
+        params.append(max_size)
+    tex_conditions = []
+    for column, value in (("pixfmt", pixfmt), ("width", width), ("height", height)):
+        if value is not None:
+            tex_conditions.append(f"{column} = ?")
+            params.append(value)
+    if tex_conditions:
+        conditions.append(
+            "vpath IN (SELECT vpath FROM textures WHERE "
+            f"{' AND '.join(tex_conditions)})"
+        )
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return conn.execute(
+        f"SELECT vpath, type, {size} FROM members {where} ORDER BY vpath", params
+    ).fetchall()
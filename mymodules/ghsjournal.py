@@ -0,0 +1,92 @@
+"""Checkpoint journal for resuming an unpack that was interrupted
+
+The journal is a text file with one line per completely unpacked item, identified by
+its WorkItem.key. A container only counts as complete once all of its contents are,
+so resuming skips finished containers without reading or decompressing them. The
+first line records the unpack settings, since a journal can only be resumed with the
+same settings it was written with.
+"""
+import os
+from pathlib import Path
+from typing import Iterable
+
+JOURNAL_NAME = ".ghs_unpack_journal"
+
+
+class GHSJournalError(ValueError):
+    pass
+
+
+class UnpackJournal:
+    def __init__(self, path: Path, settings: str, resume: bool = False):
+        """
+        :param path: path of the journal file
+        :param settings: str describing the unpack settings, a journal written with
+            different settings can't be resumed
+        :param resume: if True and the journal file exists, continue from it.
+            Otherwise, any existing journal file is overwritten
+        """
+        self.path = Path(path)
+        self.completed = set()
+        # key: remaining number of incomplete children of that container
+        self._remaining = {}
+        # key: key of the container it's in
+        self._parents = {}
+
+        if resume and self.path.exists():
+            with open(self.path, "rt", encoding="utf-8") as file:
+                journal_settings = file.readline().rstrip("\n")
+                if journal_settings != settings:
+                    raise GHSJournalError(
+                        f"can't resume, {self.path} was written with different "
+                        f"settings ({journal_settings})"
+                    )
+                self.completed.update(line.rstrip("\n") for line in file)
+            self._file = open(self.path, "at", encoding="utf-8")
+        else:
+            self._file = open(self.path, "wt", encoding="utf-8")
+            self._file.write(f"{settings}\n")
+            self._file.flush()
+
+    def is_complete(self, key: str) -> bool:
+        return key in self.completed
+
+    def add_children(self, key: str, child_keys: Iterable[str]) -> None:
+        """record that the container key was expanded into child_keys
+
+        If there are no child_keys, key is complete right away.
+        """
+        num_children = 0
+        for child_key in child_keys:
+            self._parents[child_key] = key
+            num_children += 1
+        if num_children:
+            self._remaining[key] = num_children
+        else:
+            self.mark_complete(key)
+
+    def mark_complete(self, key: str) -> None:
+        """record that key has been unpacked, and so has any container now finished"""
+        while key is not None:
+            if key not in self.completed:
+                self.completed.add(key)
+                # flushed right away, so it survives the process being killed
+                self._file.write(f"{key}\n")
+                self._file.flush()
+            parent_key = self._parents.pop(key, None)
+            if parent_key is None:
+                return
+            self._remaining[parent_key] -= 1
+            if self._remaining[parent_key]:
+                return
+            del self._remaining[parent_key]
+            key = parent_key
+
+    def close(self, remove: bool = False) -> None:
+        """close the journal file
+
+        :param remove: also remove the journal file, for when the unpack finished
+        """
+        self._file.close()
+        if remove:
+            os.remove(self.path)
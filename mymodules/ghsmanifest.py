@@ -0,0 +1,123 @@
+"""Manifest of the files written by an unpack, for finding out which were changed
+
+For each file it records the size, modification time and SHA-1 hash at the time it
+was unpacked. A file whose size and modification time are unchanged counts as
+unchanged without being read; otherwise, its hash decides. The unpack settings that
+affect how contents map to files are recorded too, since repacking needs them, as are
+the size and hash of the STM file that was unpacked, so that edited files are only ever
+packed into the STM they came from.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+from mymodules.common import atomic_write
+
+MANIFEST_NAME = ".ghs_unpack_manifest.json"
+MANIFEST_VERSION = 2
+
+
+class GHSManifestError(ValueError):
+    pass
+
+
+def hash_file(path: Path) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        while chunk := file.read(0x100000):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def source_identity(source) -> dict:
+    """return the size and SHA-1 hash of an STM file, for the "source" setting
+
+    :param source: path to the STM file, or its contents as a bytes-like object
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return {"size": len(source), "sha1": hashlib.sha1(source).hexdigest()}
+    return {"size": os.stat(source).st_size, "sha1": hash_file(source)}
+
+
+class UnpackManifest:
+    def __init__(self, root_dir: Path, settings: Optional[dict] = None):
+        """
+        :param root_dir: directory the contents were unpacked into, the manifest file
+            is kept there and all paths are relative to it
+        :param settings: unpack settings to record, such as raw_textures
+        """
+        self.root_dir = Path(root_dir)
+        self.settings = settings or {}
+        self.files = {}  # relative path: [size, mtime_ns, sha1]
+
+    @property
+    def path(self) -> Path:
+        return self.root_dir / MANIFEST_NAME
+
+    @classmethod
+    def load(cls, root_dir: Path) -> "UnpackManifest":
+        """:raises GHSManifestError: if root_dir has no (readable) manifest"""
+        manifest = cls(root_dir)
+        try:
+            with open(manifest.path, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            raise GHSManifestError(f"can't read manifest {manifest.path}: {e}")
+        if data.get("version") != MANIFEST_VERSION:
+            raise GHSManifestError(
+                f"unsupported manifest version {data.get('version')!r} in "
+                f"{manifest.path}"
+            )
+        manifest.settings = data["settings"]
+        manifest.files = data["files"]
+        return manifest
+
+    def save(self) -> None:
+        data = {
+            "version": MANIFEST_VERSION,
+            "settings": self.settings,
+            "files": self.files,
+        }
+        with atomic_write(self.path, "wt") as file:
+            json.dump(data, file, sort_keys=True)
+
+    def check_source(self, path: Path) -> None:
+        """:raises GHSManifestError: if the STM file at path isn't the one unpacked"""
+        expected = self.settings.get("source")
+        if expected is None:
+            raise GHSManifestError(f"{self.path} doesn't record the unpacked STM file")
+        # the size is checked first, to not hash a file that can't be the same
+        if (
+            os.stat(path).st_size != expected["size"]
+            or source_identity(path) != expected
+        ):
+            raise GHSManifestError(
+                f"{path} is not the STM file that was unpacked into {self.root_dir}"
+            )
+
+    def add(self, relpaths: Iterable[str]) -> None:
+        """record the current state of the files at relpaths"""
+        for relpath in relpaths:
+            path = self.root_dir / relpath
+            stat = os.stat(path)
+            self.files[relpath] = [stat.st_size, stat.st_mtime_ns, hash_file(path)]
+
+    def is_changed(self, relpath: str) -> bool:
+        """return True if the file at relpath differs from when it was recorded
+
+        Files that weren't recorded, or have been removed since, count as unchanged.
+        """
+        recorded = self.files.get(relpath)
+        if recorded is None:
+            return False
+        size, mtime_ns, sha1 = recorded
+        path = self.root_dir / relpath
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+            return False
+        return stat.st_size != size or hash_file(path) != sha1
@@ -1,32 +1,132 @@
-"""Gregory Horror Show .MAP container format"""
-from io import SEEK_CUR, SEEK_END
-from struct import unpack
-from typing import BinaryIO
+"""Gregory Horror Show .MAP container format, and the similar MAPX format
 
-from mymodules.common import keep_file_seek_position
+Both are a grid of num1 x num2 cells, each holding the offset of a .pm2 or .atr file
+(or 0 for an empty cell). Each content file extends to the next content file, or to
+the end of the MAP file.
 
+- MAP: "MAP" magic, 5 unknown bytes, u16 num1, u16 num2, 4 unknown bytes, offsets
+- MAPX: u32 file size, u16 num1, u16 num2, offsets
+"""
+from struct import unpack_from
+from typing import Iterator, Optional, Sequence
 
-class GHSMap(list):
+from mymodules.common import as_buffer
+
+
+class GHSMapGrid:
+    """grid of content files, shared by GHSMap and GHSMapX
+
+    Only the header and the offset table are parsed up front. Content files are
+    sliced out of the underlying buffer when they're accessed, so looking at one cell
+    doesn't require reading the rest.
+
+    Cells are addressed as (row, col) with num1 rows of num2 cells each, in the order
+    their offsets are stored.
+    """
+
+    # magics that content files are allowed to start with
+    content_magics = (b"PM2", b"ATR")
+
+    def __init__(
+        self, data, num1: int, num2: int, offsets: Sequence[int], table_end: int
+    ):
+        """
+        :param data: the whole file's data, a bytes-like object or mmap
+        :param num1: number of rows
+        :param num2: number of cells per row
+        :param offsets: offset of each cell's content file, 0 for empty cells
+        :param table_end: offset where the offset table ends
+        """
+        self.data = memoryview(data)
+        self.num1 = num1
+        self.num2 = num2
+        self.offsets = offsets
+        self.table_end = table_end
+
+        sorted_offsets = sorted(set(offsets).difference((0,)))
+        sizes = [o2 - o1 for o1, o2 in zip(sorted_offsets, sorted_offsets[1:])]
+        if sorted_offsets:
+            sizes.append(len(self.data) - sorted_offsets[-1])
+        self._sizes = dict(zip(sorted_offsets, sizes))
+
+    @property
+    def index(self) -> dict[tuple[int, int], tuple[int, int]]:
+        """(row, col): (offset, size) of every cell that isn't empty"""
+        sizes = self._sizes
+        return {
+            divmod(i, self.num2): (offset, sizes[offset])
+            for i, offset in enumerate(self.offsets)
+            if offset
+        }
+
+    def read_cell(self, row: int, col: int) -> Optional[memoryview]:
+        """return the content file data at (row, col), or None if the cell is empty
+
+        The data is a memoryview into the MAP file's data, not a copy.
+        """
+        if not (0 <= row < self.num1 and 0 <= col < self.num2):
+            raise IndexError(f"cell ({row}, {col}) is outside the map")
+        offset = self.offsets[row * self.num2 + col]
+        if offset == 0:
+            return None
+        return self.data[offset : offset + self._sizes[offset]]
+
+    def is_valid(self) -> bool:
+        """check the offset table in bulk: see check_offset_table"""
+        return check_offset_table(
+            self.data, self._sizes, self.table_end, self.content_magics
+        )
+
+    def __iter__(self) -> Iterator["ContentFile"]:
+        """yield the content files in the order they're stored in, skipping empty cells
+
+        Cells that share a content file yield it only once.
+        """
+        data = self.data
+        for offset, size in self._sizes.items():
+            yield ContentFile(data[offset : offset + size].tobytes())
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+
+class GHSMap(GHSMapGrid):
     @classmethod
-    def from_mapfile(cls, file: BinaryIO) -> "GHSMap":
-        magic = file.read(3)
+    def from_mapfile(cls, file) -> "GHSMap":
+        """
+        :param file: open file or bytes-like object, see common.as_buffer
+        """
+        data = as_buffer(file)
+        magic = bytes(data[:3])
         if magic != b"MAP":
             raise ValueError(f"Not a valid MAP file (magic='{magic})'")
-        file.seek(5, SEEK_CUR)
-        num1, num2 = unpack("<2H", file.read(4))
-        file.seek(4, SEEK_CUR)
-        num_offsets = num1 * num2
-        offsets_raw = unpack(f"<{num_offsets}I", file.read(num_offsets * 4))
-        offsets = [o for o in offsets_raw if o > 0]
-        offsets.sort()
-        filesizes = [o2 - o1 for o1, o2 in zip(offsets, offsets[1:])]
-        filesizes.append(-1)  # last content file extends to the end of the MAP file
-        contentfiles = []
-        for offset, size in zip(offsets, filesizes):
-            file.seek(offset)
-            data = file.read(size)
-            contentfiles.append(ContentFile(data))
-        return cls(contentfiles)
+        num1, num2 = unpack_from("<2H", data, 8)
+        offsets = read_offset_table(data, 0x10, num1 * num2)
+        if offsets is None:
+            raise ValueError("Not a valid MAP file (offset table is truncated)")
+        return cls(data, num1, num2, offsets, 0x10 + len(offsets) * 4)
+
+
+class GHSMapX(GHSMapGrid):
+    content_magics = (b"PM2",)
+
+    @classmethod
+    def from_mapxfile(cls, file) -> Optional["GHSMapX"]:
+        """
+        :param file: open file or bytes-like object, see common.as_buffer
+        :return: GHSMapX, or None if file is too short to be a MAPX file or the file
+            size in its header doesn't match
+        """
+        data = as_buffer(file)
+        if len(data) < 8:
+            return None
+        filesize, num1, num2 = unpack_from("<I2H", data)
+        if filesize != len(data):
+            return None
+        offsets = read_offset_table(data, 8, num1 * num2)
+        if offsets is None:
+            return None
+        return cls(data, num1, num2, offsets, 8 + len(offsets) * 4)
 
 
 class ContentFile:
@@ -43,33 +143,42 @@ class ContentFile:
             return "dat"
 
 
-@keep_file_seek_position
-def quickcheck_mapx_file(file, mapxfilesize: int = None) -> bool:
-    if mapxfilesize is None:
-        file.seek(0, SEEK_END)
-        mapxfilesize = file.tell()
-        file.seek(0)
-    filesize_data = file.read(4)
-    if len(filesize_data) < 4:
-        return False
-    filesize = unpack("<I", filesize_data)[0]
-    if filesize != mapxfilesize:
-        return False
-    nums_data = file.read(4)
-    if len(nums_data) < 4:
-        return False
-    num1, num2 = unpack("<2H", nums_data)
-    num_offsets = num1 * num2
-    offsets_data = file.read(num_offsets * 4)
-    if len(offsets_data) < num_offsets * 4:
-        return False
-    offsets_raw = unpack(f"<{num_offsets}I", offsets_data)
-    offsets = [o for o in offsets_raw if o > 0]
+def read_offset_table(data, table_start: int, num_offsets: int) -> Optional[tuple]:
+    """unpack the whole offset table in one go, or return None if data is too short"""
+    if table_start + num_offsets * 4 > len(data):
+        return None
+    return unpack_from(f"<{num_offsets}I", data, table_start)
+
+
+def check_offset_table(
+    data, offsets: Sequence[int], table_end: int, magics: Sequence[bytes]
+) -> bool:
+    """check a MAP/MAPX offset table against data, all in memory
+
+    Checks for the following conditions:
+
+    - at least one cell isn't empty
+    - all content files start after the offset table and before the end of data
+    - all content files start with one of magics
+
+    :param offsets: offsets of content files, 0 (empty) is ignored
+    """
+    offsets = set(offsets).difference((0,))
     if not offsets:
         return False
-    for offset in offsets:
-        file.seek(offset)
-        magic = file.read(3)
-        if magic != b"PM2":
-            return False
-    return True
+    # reject bad offsets up front, so the magic check below can't go out of bounds
+    if min(offsets) < table_end or max(offsets) + 3 > len(data):
+        return False
+    view = memoryview(data)
+    found_magics = {view[o : o + 3].tobytes() for o in offsets}
+    return found_magics.issubset(magics)
+
+
+def quickcheck_mapx_file(file) -> bool:
+    """quickly check whether file is (very likely) a GHSMapX
+
+    :param file: open file or bytes-like object, see common.as_buffer. An open file's
+        read position is not changed
+    """
+    mapx = GHSMapX.from_mapxfile(file)
+    return mapx is not None and mapx.is_valid()
@@ -0,0 +1,60 @@
+"""Memory accounting for unpacking: estimating how much memory a work item needs, and
+measuring peak memory use (RSS)
+
+Estimates only look at an item's size, and for a .sli at the decompressed size in its
+header, so that they're cheap enough to make for every item before it's processed.
+"""
+import sys
+from typing import Optional
+
+from mymodules.ghssli import read_decompressed_size
+from mymodules.ghsworkqueue import FileSlice, WorkItem
+
+# how many times its size an item needs while it's being processed. A container's
+# data is copied a few times; a texture's pixels are expanded into Python lists of
+# ints and RGBA tuples, about 8 bytes per pixel per list, two pixels per byte for i4
+COPIES_FACTOR = 4
+TEXTURE_FACTOR = 40
+# what an item's data starts with if it's definitely not a texture
+_NOT_TEXTURE_MAGICS = (b"MAP", b"PM2", b"ATR", b"SDW")
+
+
+def read_item_header(item: WorkItem, size: int = 16) -> bytes:
+    """return the first size bytes of item's data, without loading all of it"""
+    source = item.source
+    if isinstance(source, FileSlice):
+        with open(source.path, "rb") as file:
+            file.seek(source.offset)
+            return file.read(min(size, source.size))
+    return bytes(source[:size])
+
+
+def estimate_item_memory(item: WorkItem) -> int:
+    """return roughly how many bytes of memory processing item takes at most"""
+    header = read_item_header(item)
+    if header.startswith(b"SLI"):
+        try:
+            decompressed_size = read_decompressed_size(header)
+        except ValueError:
+            decompressed_size = 0
+        # the compressed data and the decompressed bytearray
+        return item.size + decompressed_size
+    if item.idx is None or header.startswith(_NOT_TEXTURE_MAGICS):
+        return COPIES_FACTOR * item.size
+    return TEXTURE_FACTOR * item.size
+
+
+def peak_rss() -> Optional[int]:
+    """return the highest RSS this process has had so far in bytes, or None if that
+    can't be found out (on Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def format_size(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} MiB"
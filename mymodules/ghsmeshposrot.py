@@ -1,57 +1,188 @@
-"""Gregory Horror Show .MPR (mesh position/rotation) animation format"""
-from struct import unpack
-from typing import BinaryIO
+"""Gregory Horror Show .MPR (mesh position/rotation) animation format
 
-from mymodules.common import is_eof, keep_file_seek_position
+Layout: u32 number of bones, then a u32 offset per bone, then for each bone a header
+(u16 number of frames, 1 unknown byte, u8 is_float) followed by its frames. Each frame
+is 6 values (presumably position xyz and rotation xyz), either as 16-bit fixed point
+(12 bytes per frame) or as 32-bit floats (24 bytes per frame) if is_float is set.
+Some .mpr files use floats for every bone even though is_float isn't set, these are
+called "forced float" here.
+"""
+import os
+import sys
+from array import array
+from mmap import mmap
+from struct import unpack_from
+from typing import BinaryIO, NamedTuple, Optional, Union
+
+from mymodules.common import BinaryCursor, as_buffer, write_npz
+
+VALUES_PER_FRAME = 6
+
+# every bone's frames are fixed point or float depending on the bone's is_float
+MPR_LAYOUT_STANDARD = "standard"
+# every bone's frames are float, no bone has is_float set
+MPR_LAYOUT_FORCED_FLOAT = "forced-float"
+
+
+class MPRBone(NamedTuple):
+    """one bone's animation frames
+
+    values: flat typed array of num_frames * 6 values, "h" (int16 fixed point) or "f"
+        (float32). When parsed on a little-endian machine this is a memoryview into the
+        .mpr data rather than a copy
+    """
+
+    num_frames: int
+    is_float: bool  # as stored in the header, False for forced float files
+    unk: int
+    values: Union[memoryview, array]
+
+    def frame(self, i: int) -> tuple:
+        """return the 6 values of frame i"""
+        start = i * VALUES_PER_FRAME
+        return tuple(self.values[start : start + VALUES_PER_FRAME])
+
+
+def detect_mpr_layout(data) -> tuple[bool, Optional[str]]:
+    """check whether data is an .mpr file and which frame layout it uses
+
+    Only the bone headers are read, the frames are skipped over by their size. The
+    standard and forced float layouts are followed side by side, so it's a single pass
+    over the headers either way.
+
+    :param data: bytes-like object or mmap containing the whole file
+    :return: (is_mpr, layout), layout being MPR_LAYOUT_STANDARD,
+        MPR_LAYOUT_FORCED_FLOAT, or None if data isn't an .mpr file
+    """
+    size = len(data)
+    if size < 4:
+        return False, None
+    (num_bones,) = unpack_from("<I", data)
+    start = 4 + num_bones * 4
+    pos = pos_forced = start  # positions of the next bone header in either layout
+    while num_bones and (pos is not None or pos_forced is not None):
+        num_bones -= 1
+        if pos is not None:
+            if pos + 4 > size:
+                pos = None
+            else:
+                num_frames, is_float = unpack_from("<HxB", data, pos)
+                pos += 4 + num_frames * (24 if is_float else 12)
+        if pos_forced is not None:
+            if pos_forced + 4 > size:
+                pos_forced = None
+            else:
+                num_frames, is_float = unpack_from("<HxB", data, pos_forced)
+                pos_forced = None if is_float else pos_forced + 4 + num_frames * 24
+    if start > size or num_bones:
+        return False, None
+    if pos == size:
+        return True, MPR_LAYOUT_STANDARD
+    if pos_forced == size:
+        return True, MPR_LAYOUT_FORCED_FLOAT
+    return False, None
+
+
+class GHSMeshPosRot:
+    def __init__(
+        self, bones: list[MPRBone], offsets: tuple = (), layout=MPR_LAYOUT_STANDARD
+    ):
+        self.bones = bones
+        self.offsets = offsets
+        self.layout = layout
+
+    @classmethod
+    def from_buffer(cls, data, layout: Optional[str] = None) -> "GHSMeshPosRot":
+        """parse .mpr data without copying the frames
+
+        :param data: bytes-like object or mmap containing the whole .mpr file
+        :param layout: layout returned by detect_mpr_layout() if it was already called
+            on data, detected here otherwise
+        :raises ValueError: if data isn't a valid .mpr file
+        """
+        if layout is None:
+            is_mpr, layout = detect_mpr_layout(data)
+            if not is_mpr:
+                raise ValueError("Not a valid MPR file")
+        forced_float = layout == MPR_LAYOUT_FORCED_FLOAT
+
+        view = memoryview(data)
+        size = len(view)
+        if size < 4:
+            raise ValueError("Not a valid MPR file, too short")
+        (num_bones,) = unpack_from("<I", view)
+        pos = 4 + num_bones * 4
+        if pos > size:
+            raise ValueError(f"Not a valid MPR file, offset table of {num_bones} bones")
+        offsets = unpack_from(f"<{num_bones}I", view, 4)
+        bones = []
+        for i in range(num_bones):
+            # a layout passed in may not have been detected on this data
+            if pos + 4 > size:
+                raise ValueError(f"Not a valid MPR file, bone {i} header is truncated")
+            num_frames, unk, is_float = unpack_from("<HBB", view, pos)
+            pos += 4
+            use_float = forced_float or is_float
+            end = pos + num_frames * (24 if use_float else 12)
+            if end > size:
+                raise ValueError(f"Not a valid MPR file, bone {i} frames are truncated")
+            values = view[pos:end].cast("f" if use_float else "h")
+            if sys.byteorder != "little":
+                values = array(values.format, values)
+                values.byteswap()
+            bones.append(MPRBone(num_frames, bool(is_float), unk, values))
+            pos = end
+        return cls(bones, offsets, layout=layout)
+
+    @classmethod
+    def from_mprfile(cls, file: BinaryIO, layout: Optional[str] = None):
+        """read the whole file in one go (or memory-map it), then parse it"""
+        return cls.from_buffer(as_buffer(file), layout=layout)
+
+    def write_npz(self, file) -> None:
+        """write all bones' frames to an .npz file, readable with numpy.load
+
+        Each bone's frames are stored as bone###, an array of shape (num_frames, 6),
+        int16 or float32. is_float holds each bone's is_float flag.
+        """
+        is_float = array("B", (bone.is_float for bone in self.bones))
+        arrays = {"is_float": (is_float, (len(self.bones),))}
+        for i, bone in enumerate(self.bones):
+            arrays[f"bone{i:03}"] = (bone.values, (bone.num_frames, VALUES_PER_FRAME))
+        write_npz(file, arrays)
+
+
+def _detect_mpr_file_layout(mprfile: Union[BinaryIO, BinaryCursor]) -> Optional[str]:
+    if isinstance(mprfile, BinaryCursor):
+        return detect_mpr_layout(mprfile.view)[1]
+    data = as_buffer(mprfile)
+    try:
+        return detect_mpr_layout(data)[1]
+    finally:
+        if isinstance(data, memoryview):
+            data.release()  # so mprfile can be resized again
+        elif isinstance(data, mmap):
+            data.close()
 
 
-@keep_file_seek_position
 def quickcheck_mpr_file(mprfile: BinaryIO) -> bool:
-    numbones_data = mprfile.read(4)
-    if len(numbones_data) < 4:
-        return False
-    num_bones = unpack("<I", numbones_data)[0]
-    offsets_data = mprfile.read(num_bones * 4)
-    if len(offsets_data) < num_bones * 4:
-        return False
-    for i in range(num_bones):
-        various_data = mprfile.read(4)
-        if len(various_data) < 4:
-            return False
-        num_frames, is_float = unpack("<HxB", various_data)
-        if is_float:
-            frame_length = 24
-        else:
-            frame_length = 12
-        frames_data = mprfile.read(num_frames * frame_length)
-        if len(frames_data) < num_frames * frame_length:
-            return False
-    if not is_eof(mprfile):
-        return False
-    return True
-
-
-@keep_file_seek_position
+    return _detect_mpr_file_layout(mprfile) == MPR_LAYOUT_STANDARD
+
+
 def quickcheck_mpr_forcedfloat_file(mprfile: BinaryIO) -> bool:
     """some .mpr files have is_float unset but use floats anyway; this detects them"""
-    numbones_data = mprfile.read(4)
-    if len(numbones_data) < 4:
-        return False
-    num_bones = unpack("<I", numbones_data)[0]
-    offsets_data = mprfile.read(num_bones * 4)
-    if len(offsets_data) < num_bones * 4:
-        return False
-    for i in range(num_bones):
-        various_data = mprfile.read(4)
-        if len(various_data) < 4:
-            return False
-        num_frames, is_float = unpack("<HxB", various_data)
-        if is_float:
-            return False
-        frame_length = 24
-        frames_data = mprfile.read(num_frames * frame_length)
-        if len(frames_data) < num_frames * frame_length:
-            return False
-    if not is_eof(mprfile):
-        return False
-    return True
+    return _detect_mpr_file_layout(mprfile) == MPR_LAYOUT_FORCED_FLOAT
+
+
+def main(args=tuple(sys.argv[1:])):
+    if not args:
+        print(f"{sys.argv[0]} [.mpr file] [.mpr file] ...")
+    for filepath in args:
+        print(os.path.basename(filepath))
+        with open(filepath, "rb") as file:
+            mpr = GHSMeshPosRot.from_mprfile(file)
+            mpr.write_npz(f"{filepath}.npz")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 # ghs modelmeta output locations
 # tells where to put .ghs files and what to name them
-from typing import Optional
+import sys
+from types import MappingProxyType
+from typing import NamedTuple, Optional
 
 characters = {
     0x00: ("02c.sli.tex", "guestboy"),
@@ -192,6 +194,52 @@ doors = range(0xA7, 0xF3 + 1)
 doors = {i: ("028.stm", "door") for i in doors}
 
 
+class ModelMetaLoc(NamedTuple):
+    """where a modelmeta entry's .ghs file goes
+
+    subdir: virtual path of the FILE.STM contents that the model belongs to
+    name: name part of the .ghs filename, may be empty
+    kind: which of the tables above the entry comes from, e.g. "character_shadow"
+    """
+
+    subdir: str
+    name: str
+    kind: str
+
+
+def _build_index() -> tuple[MappingProxyType, MappingProxyType]:
+    # in order of precedence, an earlier table wins if two contain the same entry
+    tables = (
+        ("character", characters),
+        ("held_object", held_objects),
+        ("figurine", figurines),
+        ("gregoryshop_item", gregoryshop_items),
+        ("effect", effects),
+        ("rouletteboy_horrorshow", rouletteboy_horrorshow),
+        ("angeldog_horrorshow", angeldog_horrorshow),
+        ("door", doors),
+        ("character_shadow", character_shadows),
+    )
+    forward = {}
+    for kind, table in tables:
+        for modelmeta_i, (subdir, name) in table.items():
+            forward.setdefault(modelmeta_i, ModelMetaLoc(subdir, name, kind))
+    forward = dict(sorted(forward.items()))
+    reverse = {}
+    for modelmeta_i, loc in forward.items():
+        reverse.setdefault(loc.subdir, []).append(modelmeta_i)
+    reverse = {subdir: tuple(ids) for subdir, ids in reverse.items()}
+    return MappingProxyType(forward), MappingProxyType(reverse)
+
+
+# built once, read-only
+# modelmeta_index: modelmeta entry -> ModelMetaLoc
+# vpath_index: virtual path -> modelmeta entries whose models belong to it, in order
+# Room props (located by the .stm index in their modelmeta entry) aren't included,
+# since that requires the executable
+modelmeta_index, vpath_index = _build_index()
+
+
 def get_modelmeta_outloc(
     modelmeta_i: int, stm_index: int = -1
 ) -> tuple[Optional[str], str]:
@@ -203,27 +251,44 @@ def get_modelmeta_outloc(
     outsubdir = None
     outfilename = f"{modelmeta_i:03x}.ghs"
 
-    ghs_stuff = (
-        characters
-        | held_objects
-        | figurines
-        | gregoryshop_items
-        | effects
-        | rouletteboy_horrorshow
-        | angeldog_horrorshow
-        | doors
-    )
-    if modelmeta_i in ghs_stuff:
-        outsubdir, namepart = ghs_stuff[modelmeta_i]
-        if namepart:
-            outfilename = f"{modelmeta_i:03x}_{namepart}.ghs"
-
-    elif modelmeta_i in character_shadows:
-        outsubdir, namepart = character_shadows[modelmeta_i]
-        if namepart:
-            outfilename = f"{modelmeta_i:03x}_{namepart}.ghs-shadow"
+    loc = modelmeta_index.get(modelmeta_i)
+    if loc is not None:
+        outsubdir = loc.subdir
+        if loc.name:
+            ext = "ghs-shadow" if loc.kind == "character_shadow" else "ghs"
+            outfilename = f"{modelmeta_i:03x}_{loc.name}.{ext}"
 
     elif stm_index != -1:  # room props that provide a .stm index
         outsubdir = f"{stm_index:03x}.sli.stm"
 
     return outsubdir, outfilename
+
+
+def main(args=tuple(sys.argv[1:])):
+    """look up modelmeta entries in hex (e.g. 2a or 0x2a) or virtual paths
+    (e.g. 0aa.stm/000.sli.tex)"""
+    if not args:
+        print(f"{sys.argv[0]} [modelmeta index or virtual path] ...")
+    for arg in args:
+        if "/" in arg or "." in arg:
+            modelmeta_is = vpath_index.get(arg.strip("/"), ())
+            for modelmeta_i in modelmeta_is:
+                loc = modelmeta_index[modelmeta_i]
+                print(f"{arg}: 0x{modelmeta_i:03x} {loc.name} ({loc.kind})")
+            if not modelmeta_is:
+                print(f"{arg}: not found")
+            continue
+        try:
+            modelmeta_i = int(arg, 16)
+        except ValueError:
+            print(f"{arg}: not found")
+            continue
+        loc = modelmeta_index.get(modelmeta_i)
+        if loc is not None:
+            print(f"0x{modelmeta_i:03x}: {loc.subdir} {loc.name} ({loc.kind})")
+        else:
+            print(f"0x{modelmeta_i:03x}: not found")
+
+
+if __name__ == "__main__":
+    main()
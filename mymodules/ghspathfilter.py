@@ -0,0 +1,108 @@
+"""Filtering of unpacked contents by virtual path and file type
+
+Virtual paths are the paths that contents are unpacked to relative to the root
+directory, e.g. "0aa.stm/000.sli.tex" or "029.stm/000.sli.stm/003.pm2". Glob patterns
+match them one path segment at a time: "*", "?" and "[...]" never match "/", and
+"**" matches any number of whole segments. A pattern that matches a container also
+matches everything inside it, so "029.stm" is the same as "029.stm/**".
+"""
+from fnmatch import fnmatchcase
+from typing import Iterable, Optional
+
+
+class GlobPattern:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.segments = tuple(seg for seg in pattern.split("/") if seg)
+
+    def _closure(self, states: set) -> frozenset:
+        """add the states reachable by letting "**" match zero segments"""
+        stack = list(states)
+        while stack:
+            i = stack.pop()
+            if i < len(self.segments) and self.segments[i] == "**":
+                if i + 1 not in states:
+                    states.add(i + 1)
+                    stack.append(i + 1)
+        return frozenset(states)
+
+    def _walk(self, path: str) -> tuple[frozenset, bool]:
+        """match path's segments against the pattern
+
+        :return: (states, matched_ancestor), where states are the positions in the
+            pattern that can be reached after consuming all of path's segments, and
+            matched_ancestor is True if the whole pattern matched one of the path's
+            parent directories
+        """
+        end = len(self.segments)
+        states = self._closure({0})
+        matched_ancestor = False
+        for seg in path.split("/"):
+            if end in states:
+                matched_ancestor = True
+                break
+            next_states = set()
+            for i in states:
+                if i == end:
+                    continue
+                if self.segments[i] == "**":
+                    next_states.add(i)
+                elif fnmatchcase(seg, self.segments[i]):
+                    next_states.add(i + 1)
+            states = self._closure(next_states)
+            if not states:
+                break
+        return states, matched_ancestor
+
+    def matches(self, path: str) -> bool:
+        """return True if path, or any directory containing it, matches the pattern"""
+        states, matched_ancestor = self._walk(path)
+        return matched_ancestor or len(self.segments) in states
+
+    def matches_within(self, dirpath: str) -> bool:
+        """return True if the pattern could match dirpath or anything inside it"""
+        states, matched_ancestor = self._walk(dirpath)
+        return matched_ancestor or bool(states)
+
+
+class PathFilter:
+    """decides which virtual paths get unpacked
+
+    :param include: glob patterns, if given only matching paths are unpacked
+    :param exclude: glob patterns, matching paths are never unpacked
+    :param types: file types (extensions such as "tex", "pm2", "map-atr"), if given
+        only files of these types are unpacked. Containers are always traversed.
+    """
+
+    def __init__(
+        self,
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+        types: Optional[Iterable[str]] = None,
+    ):
+        self.include = [GlobPattern(p) for p in include]
+        self.exclude = [GlobPattern(p) for p in exclude]
+        self.types = None if types is None else frozenset(types)
+
+    def matches(self, vpath: str, filetype: Optional[str] = None) -> bool:
+        """return True if the file at vpath (of type filetype) should be unpacked"""
+        if self.types is not None and filetype not in self.types:
+            return False
+        if self.include and not any(p.matches(vpath) for p in self.include):
+            return False
+        return not any(p.matches(vpath) for p in self.exclude)
+
+    def matches_within(self, vdirpath: str, filetype: Optional[str] = None) -> bool:
+        """return True if anything inside the directory at vdirpath could be unpacked
+
+        When this returns False, the container at vdirpath can be skipped entirely.
+
+        :param filetype: type of the directory's contents, if they are all the same
+            type (such as the .png files inside a .tex directory)
+        """
+        if self.types is not None and filetype is not None:
+            if filetype not in self.types:
+                return False
+        if self.include and not any(p.matches_within(vdirpath) for p in self.include):
+            return False
+        return not any(p.matches(vdirpath) for p in self.exclude)
@@ -0,0 +1,124 @@
+"""Profiling the unpacking of single members, to find out why a member is slow
+
+A MemberProfiler runs cProfile and tracemalloc while a member is unpacked, and saves
+what they found in a directory, named after the member's virtual path with "/"
+replaced by "__":
+
+    <name>.prof         cProfile statistics, for pstats or a viewer such as snakeviz
+    <name>.tracemalloc  tracemalloc snapshot of the memory still allocated when the
+                        member was done, for tracemalloc.Snapshot.load()
+
+Both slow down unpacking a lot, so the times they measure are only comparable with each
+other, not with unprofiled unpacks.
+"""
+import cProfile
+import os
+import time
+import tracemalloc
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from mymodules.common import atomic_write
+
+SUMMARY_NAME = "summary.txt"
+
+
+class MemberProfile(NamedTuple):
+    """what was measured while unpacking a member
+
+    vpath: the member's virtual path
+    duration: how long unpacking it took in seconds (while being profiled)
+    peak_memory: the most memory allocated at once while unpacking it, in bytes
+    allocated_memory: memory allocated while unpacking it that was still in use
+        afterwards, such as its contents, in bytes
+    prof_name, snapshot_name: names of the files written to the profile directory
+    """
+
+    vpath: str
+    duration: float
+    peak_memory: int
+    allocated_memory: int
+    prof_name: str
+    snapshot_name: str
+
+
+def profile_name(vpath: str) -> str:
+    """return the name of vpath's profile files, without extension"""
+    return vpath.replace("/", "__") or "root"
+
+
+class MemberProfiler:
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.start_time = None
+        self.baseline = 0  # memory already allocated when profiling started
+        self.started_tracemalloc = False
+
+    def start(self) -> None:
+        # tracemalloc could already be tracing, e.g. if python was run with -X
+        # tracemalloc. It's then left running afterwards
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+        self.start_time = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self, vpath: Optional[str] = None, profile_dir: Optional[Path] = None):
+        """stop profiling, and write the results to profile_dir if vpath is given
+
+        :return: a MemberProfile if vpath was given, otherwise None
+        """
+        self.profiler.disable()
+        duration = time.perf_counter() - self.start_time
+        try:
+            if vpath is None:
+                return None
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            name = profile_name(vpath)
+            profile = MemberProfile(
+                vpath,
+                duration,
+                peak - self.baseline,
+                current - self.baseline,
+                f"{name}.prof",
+                f"{name}.tracemalloc",
+            )
+            os.makedirs(profile_dir, exist_ok=True)
+            self.profiler.dump_stats(profile_dir / profile.prof_name)
+            snapshot.dump(str(profile_dir / profile.snapshot_name))
+            return profile
+        finally:
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+
+def summary_lines(
+    profiles: list[MemberProfile], top: Optional[int] = None
+) -> list[str]:
+    """return lines ranking the profiled members by time and by peak memory
+
+    :param top: only list this many members in each ranking
+    """
+    by_time = sorted(profiles, key=lambda p: p.duration, reverse=True)[:top]
+    by_memory = sorted(profiles, key=lambda p: p.peak_memory, reverse=True)[:top]
+    lines = ["slowest members (seconds, peak MiB, vpath):"]
+    lines.extend(
+        f"  {p.duration:9.3f} {p.peak_memory / (1024 * 1024):9.1f}  {p.vpath}"
+        for p in by_time
+    )
+    lines.append("members with the most memory allocated (peak MiB, seconds, vpath):")
+    lines.extend(
+        f"  {p.peak_memory / (1024 * 1024):9.1f} {p.duration:9.3f}  {p.vpath}"
+        for p in by_memory
+    )
+    return lines
+
+
+def write_summary(profiles: list[MemberProfile], profile_dir: Path) -> None:
+    """write the full rankings of summary_lines to profile_dir"""
+    os.makedirs(profile_dir, exist_ok=True)
+    with atomic_write(Path(profile_dir) / SUMMARY_NAME, "wt") as file:
+        file.write("\n".join(summary_lines(profiles)) + "\n")
@@ -0,0 +1,271 @@
+"""Reporting an unpack's progress from its UnpackEvents
+
+Events are collected by an EventBatcher, which passes them on to its sinks in batches,
+so that reporting costs a list append per item rather than a write:
+
+    ListingSink         lists the unpacked contents (what -v used to print)
+    ProgressBarSink     a progress bar with an ETA, redrawn at most every few tenths of
+                        a second
+    JSONLinesSink       a JSON object per item, for other programs to parse
+    ProgressSink        reports nothing
+
+Progress goes by the top-level members of the STM: the fraction of the STM's size that
+the members unpacked so far take up, where a member only counts once everything in it
+has been unpacked, which a MemberCompletion finds out for the events'
+completed_size. This is accurate to within the members being unpacked, in any order.
+"""
+import json
+import sys
+import time
+from typing import Iterable, Optional, TextIO
+
+
+class ProgressSink:
+    """receives batches of UnpackEvents. This one ignores them"""
+
+    def handle(self, events: list) -> None:
+        pass
+
+    def close(self, completed: bool = True) -> None:
+        """called once after the last batch
+
+        :param completed: False if the unpack failed or was interrupted
+        """
+        pass
+
+
+class ListingSink(ProgressSink):
+    def __init__(
+        self,
+        file: Optional[TextIO] = None,
+        outputs_only: bool = False,
+        full_paths: bool = False,
+    ):
+        """
+        :param file: text file to list to, sys.stdout by default
+        :param outputs_only: list only the paths of the files written, rather than an
+            indented tree of all contents
+        :param full_paths: list the whole path of each content, unindented, rather
+            than a tree of names, for when contents don't arrive in tree order
+        """
+        self.file = file
+        self.outputs_only = outputs_only
+        self.full_paths = full_paths
+
+    def handle(self, events: list) -> None:
+        lines = []
+        for event in events:
+            if self.outputs_only:
+                lines.extend(event.outputs)
+                continue
+            if not event.vpath:
+                continue
+            outputs = [output for output in event.outputs if output != event.vpath]
+            if self.full_paths:
+                lines.append(event.vpath)
+                lines.extend(outputs)
+                continue
+            depth = event.vpath.count("/")
+            lines.append(f"{'  ' * depth}{event.vpath.rpartition('/')[2]}")
+            indent = "  " * (depth + 1)
+            for output in outputs:
+                lines.append(f"{indent}{output.rpartition('/')[2]}")
+        if lines:
+            file = self.file if self.file is not None else sys.stdout
+            file.write("\n".join(lines) + "\n")
+            file.flush()
+
+
+def top_level_member(key: str) -> Optional[str]:
+    """return the index of the top-level member of the STM that the item with key (a
+    WorkItem key or a virtual path) is part of, as a hex string, None for the STM"""
+    if not key:
+        return None
+    return key.partition("/")[0].partition(".")[0]
+
+
+class MemberCompletion:
+    """finds out when everything in each top-level member of the STM has been unpacked
+
+    Every item is passed to finish() once it has been unpacked, after its parent.
+    """
+
+    def __init__(self):
+        self.pending = {}  # top-level member: [number of unfinished items, size]
+        self.completed_size = 0
+
+    def finish(self, key: str, num_children: int, size: int) -> None:
+        """
+        :param key: the item's WorkItem key or virtual path
+        :param num_children: number of items the item contains, which are yet to be
+            unpacked
+        :param size: the item's size, which only matters for top-level members
+        """
+        member = top_level_member(key)
+        if member is None:
+            return
+        pending = self.pending.setdefault(member, [1, size])
+        pending[0] += num_children - 1
+        if pending[0] <= 0:
+            del self.pending[member]
+            self.completed_size += pending[1]
+
+    def take(self) -> int:
+        """return the size of the members completed since the previous take()"""
+        size, self.completed_size = self.completed_size, 0
+        return size
+
+
+class ProgressBarSink(ProgressSink):
+    def __init__(
+        self, file: Optional[TextIO] = None, interval: float = 0.2, width: int = 30
+    ):
+        """
+        :param file: terminal to draw on, sys.stderr by default
+        :param interval: minimum number of seconds between redraws
+        :param width: width of the bar itself in characters
+        """
+        self.file = file if file is not None else sys.stderr
+        self.interval = interval
+        self.width = width
+        self.start_time = time.monotonic()
+        self.last_draw = None
+        self.total_size = 0
+        self.done_size = 0
+        self.num_items = 0
+        self.num_bytes = 0
+        self.line_length = 0
+
+    def handle(self, events: list) -> None:
+        for event in events:
+            self.num_items += 1
+            self.num_bytes += event.size
+            if not event.vpath:
+                self.total_size = event.size
+            self.done_size += event.completed_size
+        now = time.monotonic()
+        if self.last_draw is None or now - self.last_draw >= self.interval:
+            self.draw(now)
+
+    def close(self, completed: bool = True) -> None:
+        self.draw(time.monotonic(), final=True, completed=completed)
+        self.file.write("\n")
+        self.file.flush()
+
+    def draw(self, now: float, final: bool = False, completed: bool = False) -> None:
+        self.last_draw = now
+        elapsed = now - self.start_time
+        # the STM's header isn't part of any member, so it's never quite 100% otherwise
+        fraction = 1.0 if completed else self.fraction()
+        filled = int(fraction * self.width)
+        line = (
+            f"[{'#' * filled}{'-' * (self.width - filled)}] {fraction:4.0%} "
+            f"{self.num_items} items, {self.num_bytes / (1024 * 1024):.1f} MiB"
+        )
+        if final:
+            line += f" in {format_duration(elapsed)}"
+            if not completed:
+                line += ", stopped"
+        elif fraction > 0:
+            eta = elapsed * (1 - fraction) / fraction
+            line += f", ETA {format_duration(eta)}"
+        # pad with spaces to overwrite the rest of a longer previous line
+        padding = " " * max(self.line_length - len(line), 0)
+        self.line_length = len(line)
+        self.file.write(f"\r{line}{padding}")
+        self.file.flush()
+
+    def fraction(self) -> float:
+        if not self.total_size:
+            return 0.0
+        return min(self.done_size / self.total_size, 1.0)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+class JSONLinesSink(ProgressSink):
+    """writes a JSON object per event, with the UnpackEvent's fields and
+    "event": "item", and finally one with "event": "done", the number of items and
+    whether the unpack completed"""
+
+    def __init__(self, fd: int):
+        """
+        :param fd: file descriptor to write to, left open by close()
+        """
+        self.file = open(fd, "wt", encoding="utf-8", closefd=False)
+        self.num_items = 0
+
+    def handle(self, events: list) -> None:
+        self.num_items += len(events)
+        self.file.write(
+            "".join(
+                json.dumps({"event": "item", **event_dict(event)}) + "\n"
+                for event in events
+            )
+        )
+        self.file.flush()
+
+    def close(self, completed: bool = True) -> None:
+        done = {"event": "done", "items": self.num_items, "completed": completed}
+        self.file.write(json.dumps(done) + "\n")
+        self.file.close()
+
+
+def event_dict(event) -> dict:
+    """return an UnpackEvent's fields as a dict, including those of its NamedTuples"""
+    return {
+        key: value._asdict() if hasattr(value, "_asdict") else value
+        for key, value in event._asdict().items()
+    }
+
+
+class EventBatcher:
+    """on_event callback for unpack_stm that passes events on to sinks in batches
+
+    A batch is passed on once it has max_events events, or once max_delay seconds have
+    passed since the previous one. close() passes on the rest and closes the sinks,
+    which leaving a with block does as well.
+    """
+
+    def __init__(
+        self,
+        sinks: Iterable[ProgressSink],
+        max_events: int = 512,
+        max_delay: float = 0.25,
+    ):
+        self.sinks = list(sinks)
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.events = []
+        self.last_flush = time.monotonic()
+
+    def __call__(self, event) -> None:
+        self.events.append(event)
+        if (
+            len(self.events) >= self.max_events
+            or time.monotonic() - self.last_flush >= self.max_delay
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        self.last_flush = time.monotonic()
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        for sink in self.sinks:
+            sink.handle(events)
+
+    def close(self, completed: bool = True) -> None:
+        self.flush()
+        for sink in self.sinks:
+            sink.close(completed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(completed=exc_type is None)
@@ -3,16 +3,57 @@ import os
 import struct
 import sys
 
-
-def decompress(file) -> bytearray:
-    magic = file.read(4)
-    if magic != b"SLID":
-        raise ValueError(f"Not a valid SLID file, magic is {magic!r}")
-    file_size, decompressed_size, compressed_size = struct.unpack("<3I", file.read(12))
-    compressed_data = file.read(compressed_size)
+from mymodules.common import reading
+
+_header_struct = struct.Struct("<4s3I")
+
+_default_cache = None  # SLICache used by decompress() when it isn't given one
+
+
+def set_default_cache(cache) -> None:
+    """make decompress() go through cache (an SLICache) by default, None to stop"""
+    global _default_cache
+    _default_cache = cache
+
+
+def decompress(file, out=None, cache=None):
+    """
+    :param file: open file, BinaryCursor or bytes-like object positioned at the SLID
+    :param out: if given, a writable buffer of at least the decompressed size (such as
+        an mmap of a temporary file) to decompress into instead of a new bytearray
+    :param cache: SLICache to take the decompressed data from or add it to, by default
+        the one set with set_default_cache() if any
+    :return: the decompressed data, out if it was given. Without out, a cache hit is
+        returned as a read-only mmap of the cache entry rather than copied
+    """
+    if cache is None:
+        cache = _default_cache
+    if cache is not None:
+        return cache.decompress(file, out=out)
+    return decompress_uncached(file, out=out)
+
+
+def decompress_uncached(file, out=None):
+    """decompress() without any cache"""
+    with reading(file) as cursor:
+        if not cursor.has(_header_struct.size):
+            magic = bytes(cursor.view[cursor.pos : cursor.pos + 4])
+            raise ValueError(f"Not a valid SLID file, magic is {magic!r}")
+        magic, file_size, decompressed_size, compressed_size = cursor.unpack(
+            _header_struct
+        )
+        if magic != b"SLID":
+            raise ValueError(f"Not a valid SLID file, magic is {magic!r}")
+        # a view rather than a copy of the compressed data
+        compressed_data = cursor.read_view(min(compressed_size, cursor.remaining))
 
     slid_buffer = bytearray(0x1000)
-    decompressed_data = bytearray(decompressed_size)
+    if out is None:
+        decompressed_data = bytearray(decompressed_size)
+    elif len(out) < decompressed_size:
+        raise ValueError(f"out is too small, {decompressed_size} bytes are needed")
+    else:
+        decompressed_data = out
     s1_processed_bytes = a0_ci = 0
     a1_di = 0
     s2 = 0
@@ -104,6 +145,85 @@ def decompress(file) -> bytearray:
     return decompressed_data
 
 
+def read_decompressed_size(header) -> int:
+    """return the decompressed size of a .sli from its first 16 bytes (its header)
+
+    :raises ValueError: if header isn't the start of a .sli
+    """
+    if len(header) < _header_struct.size:
+        raise ValueError("Not a valid SLID file, too short")
+    magic, file_size, decompressed_size, compressed_size = _header_struct.unpack_from(
+        header
+    )
+    if magic != b"SLID":
+        raise ValueError(f"Not a valid SLID file, magic is {magic!r}")
+    return decompressed_size
+
+
+# compression parameters matching decompress(): a 0x1000 byte ring buffer starting
+# out as zeros with its write position at 0xFEE, and matches of 3 to 18 bytes
+_RING_SIZE = 0x1000
+_RING_START = 0xFEE
+_MIN_MATCH = 3
+_MAX_MATCH = 18
+# furthest back a match may start, so that it's never overwritten while being copied
+_MAX_DISTANCE = _RING_SIZE - _MAX_MATCH
+
+
+def compress(data) -> bytes:
+    """compress data into a .sli (SLID) file that decompress() turns back into data
+
+    Uses greedy LZSS: at each position, the longest match within the ring buffer's
+    window (found with bytes.rfind) is used if it's at least 3 bytes long, otherwise
+    a literal byte is written. The result decompresses to the same data, but isn't
+    necessarily byte-identical to the game's own .sli files.
+    """
+    # the ring buffer starts out filled with zeros, so data can refer back to those
+    # as if they came before it
+    prefix_len = _MAX_MATCH
+    buf = bytes(prefix_len) + bytes(data)
+    end = len(buf)
+    out = bytearray()
+    flags_pos = 0
+    flag_bit = 0x100  # next bit of the current flags byte, 0x100 means none left
+    pos = prefix_len
+    while pos < end:
+        if flag_bit == 0x100:
+            flags_pos = len(out)
+            out.append(0)
+            flag_bit = 1
+
+        window_start = max(0, pos - _MAX_DISTANCE)
+        match_pos = -1
+        match_len = 0
+        max_len = min(_MAX_MATCH, end - pos)
+        length = _MIN_MATCH
+        while length <= max_len:
+            # a match may run past pos, the decompressor copies one byte at a time
+            found = buf.rfind(buf[pos : pos + length], window_start, pos + length - 1)
+            if found < 0:
+                break
+            match_pos = found
+            match_len = length
+            length += 1
+
+        if match_len >= _MIN_MATCH:
+            ring_pos = (_RING_START + match_pos - prefix_len) & 0xFFF
+            out.append(ring_pos & 0xFF)
+            out.append(((ring_pos >> 4) & 0xF0) | (match_len - _MIN_MATCH))
+            pos += match_len
+        else:
+            out[flags_pos] |= flag_bit  # literal
+            out.append(buf[pos])
+            pos += 1
+        flag_bit <<= 1
+
+    header = _header_struct.pack(
+        b"SLID", _header_struct.size + len(out), len(buf) - prefix_len, len(out)
+    )
+    return header + bytes(out)
+
+
 def main(args=tuple(sys.argv[1:])):
     if not args:
         print(f"{sys.argv[0]} [.sli file] [.sli file] ...")
@@ -0,0 +1,181 @@
+"""On-disk cache of decompressed .sli contents
+
+Decompressing a .sli in pure Python is slow, so the decompressed data is kept in a
+cache directory, keyed by the SHA-1 hash of the compressed .sli. Entries are sharded
+into subdirectories named after the first two hex digits of their hash. Hits are
+memory-mapped rather than read.
+
+Once the cache is larger than its size limit, the least recently used entries are
+removed. Using an entry updates its modification time, which is what "least recently
+used" goes by. Several processes can use the same cache directory at once: entries are
+written with atomic_write, so they're never seen partially written.
+
+Hits are memory-mapped, so they stay readable even if their entry is evicted while
+they're still in use.
+
+mymodules.ghssli.decompress() goes through an SLICache when given one, or by default
+once one is set with mymodules.ghssli.set_default_cache().
+"""
+import hashlib
+import mmap
+import os
+from pathlib import Path
+from typing import Union
+
+from mymodules.common import as_buffer, atomic_write
+from mymodules.ghssli import decompress_uncached, read_decompressed_size
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024  # 1 GiB
+
+
+class SLICache:
+    """
+    hits/misses count this instance's lookups. When an instance is pickled (such as
+    when it's sent to a worker process), only its directory and size limit are kept.
+    """
+
+    def __init__(
+        self, cache_dir: Union[str, os.PathLike], max_size: int = DEFAULT_MAX_SIZE
+    ):
+        """
+        :param cache_dir: directory to keep the cache in, created if it doesn't exist
+        :param max_size: size limit of the cache in bytes
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._total_size = None  # scanned from the cache directory when first needed
+
+    def __getstate__(self):
+        return {"cache_dir": self.cache_dir, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"], state["max_size"])
+
+    def entry_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key[2:]
+
+    def key(self, file) -> str:
+        """return the key of a .sli's cache entry, see decompress for file"""
+        return hashlib.sha1(as_buffer(file)).hexdigest()
+
+    def decompress(self, file, out=None):
+        """return the decompressed contents of a .sli, from the cache if possible
+
+        :param file: the whole .sli, as an open file, BinaryCursor or bytes-like object
+            positioned at its start
+        :param out: see mymodules.ghssli.decompress
+        :return: a bytes-like object, out if it was given, otherwise an mmap of the
+            cache entry if it was a hit
+        """
+        data = as_buffer(file)
+        key = self.key(data)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            if out is None:
+                return cached
+            try:
+                if len(out) < len(cached):
+                    raise ValueError(
+                        f"out is too small, {len(cached)} bytes are needed"
+                    )
+                out[: len(cached)] = cached
+            finally:
+                if isinstance(cached, mmap.mmap):
+                    cached.close()
+            return out
+        self.misses += 1
+        decompressed = decompress_uncached(data, out=out)
+        if out is None:
+            self.put(key, decompressed)
+        else:
+            # out may be larger than the decompressed contents
+            with memoryview(out)[: read_decompressed_size(data)] as view:
+                self.put(key, view)
+        return decompressed
+
+    def lookup(self, file):
+        """return a .sli's cache entry as an mmap (b"" if it's empty) and count a hit,
+        or return None without counting a miss if it isn't cached. See decompress for
+        file"""
+        cached = self.get(self.key(file))
+        if cached is not None:
+            self.hits += 1
+        return cached
+
+    def get(self, key: str):
+        """return the cache entry for key as an mmap (b"" if it's empty), or None"""
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    data = b""
+                else:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass  # evicted by another process meanwhile, data is still mapped
+        return data
+
+    def put(self, key: str, data) -> None:
+        """store data as the cache entry for key, then evict entries if needed"""
+        path = self.entry_path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        with atomic_write(path) as file:
+            file.write(data)
+        if self._total_size is None:
+            self._total_size = self.total_size()
+        else:
+            self._total_size += len(data)
+        if self._total_size > self.max_size:
+            self.evict()
+
+    def _entries(self) -> list[os.DirEntry]:
+        entries = []
+        try:
+            shards = list(os.scandir(self.cache_dir))
+        except FileNotFoundError:
+            return entries
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            # temporary files of entries being written start with "."
+            entries.extend(
+                entry
+                for entry in os.scandir(shard.path)
+                if entry.is_file() and not entry.name.startswith(".")
+            )
+        return entries
+
+    def total_size(self) -> int:
+        """return the size of all entries in the cache directory, in bytes"""
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def evict(self) -> None:
+        """remove the least recently used entries until the cache fits max_size"""
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            total_size -= size
+        self._total_size = total_size
+
+    def stats(self) -> list[str]:
+        return [f"sli cache: {self.hits} hits, {self.misses} misses"]
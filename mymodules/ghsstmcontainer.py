@@ -1,45 +1,103 @@
 """Gregory Horror Show .STM container format"""
-from io import SEEK_END
-from struct import unpack
-from typing import BinaryIO
+from io import BytesIO
+from struct import Struct
+from typing import BinaryIO, Sequence, Union
 
-from mymodules.common import keep_file_seek_position
+from mymodules.common import BinaryCursor, keep_file_seek_position, reading
+
+_entry_struct = Struct("<2I")
 
 
 class GHSStmContainer(list[bytes]):
     @classmethod
-    def from_stmfile(cls, file: BinaryIO) -> "GHSStmContainer":
-        offsets = []
-        sizes = []
-        datas = []
+    def from_stmfile(cls, file: Union[BinaryIO, BinaryCursor]) -> "GHSStmContainer":
+        with reading(file) as cursor:
+            start = cursor.pos
+            datas = []
+            for offset, size in read_stm_entries(cursor):
+                cursor.seek(start + offset)
+                datas.append(bytes(cursor.read_view(size)))
+        return cls(datas)
+
+    def to_bytes(self) -> bytes:
+        out = BytesIO()
+        write_stm(out, self)
+        return out.getvalue()
+
+
+def stm_offsets(sizes: Sequence[int]) -> list[int]:
+    """return where each content file of the given sizes goes in an STM
+
+    The offset/size table comes first, then the content files in order, each starting
+    at a multiple of 0x10.
+    """
+    offsets = []
+    pos = align16(_entry_struct.size * len(sizes))
+    for size in sizes:
+        offsets.append(pos)
+        pos = align16(pos + size)
+    return offsets
+
+
+def write_stm(file: BinaryIO, contentfiles: Sequence) -> int:
+    """write an STM container, return the number of bytes written
+
+    :param file: open file to write to
+    :param contentfiles: the content files' data, bytes-like objects (such as
+        memoryview slices of another STM, which are written without being copied)
+    :raises ValueError: if contentfiles is empty, an STM needs at least one
+    """
+    if not contentfiles:
+        raise ValueError("an STM container needs at least one content file")
+    sizes = [memoryview(data).nbytes for data in contentfiles]
+    offsets = stm_offsets(sizes)
+    table = bytearray()
+    for i, (offset, size) in enumerate(zip(offsets, sizes)):
+        if size > 0x7FFFFFFF:
+            raise ValueError(f"content file {i} is too large for an STM ({size:#x})")
+        is_final = 0x80000000 if i == len(sizes) - 1 else 0
+        table += _entry_struct.pack(offset, size | is_final)
+    file.write(table)
+    pos = len(table)
+    for offset, data in zip(offsets, contentfiles):
+        file.write(bytes(offset - pos))  # padding to 0x10 alignment
+        file.write(data)
+        pos = offset + memoryview(data).nbytes
+    return pos
+
+
+def align16(pos: int) -> int:
+    return (pos + 0xF) & ~0xF
+
+
+def read_stm_entries(file: Union[BinaryIO, BinaryCursor]) -> list[tuple[int, int]]:
+    """read the STM offset/size table, without reading any of the content files
+
+    :param file: an open file or BinaryCursor with its current read position at the
+        start of the STM
+    :return: list of (offset, size) for each content file, offsets are relative to
+        the start of the STM
+    """
+    entries = []
+    with reading(file) as cursor:
         while True:
-            offset, size_raw = unpack("<2I", file.read(8))
+            offset, size_raw = cursor.unpack(_entry_struct)
             is_final = size_raw & 0x80000000
             size = size_raw & 0x7FFFFFFF
-            offsets.append(offset)
-            sizes.append(size)
+            entries.append((offset, size))
             if is_final:
-                break
-        for offset, size in zip(offsets, sizes):
-            file.seek(offset)
-            data = file.read(size)
-            datas.append(data)
-        return cls(datas)
+                return entries
 
 
 @keep_file_seek_position
-def quickget_num_contentfiles_from_stm(file: BinaryIO):
-    num_contentfiles = 0
-    while True:
-        size_raw = unpack("<4x1I", file.read(8))[0]
-        is_final = size_raw & 0x80000000
-        num_contentfiles += 1
-        if is_final:
-            return num_contentfiles
+def quickget_num_contentfiles_from_stm(file: Union[BinaryIO, BinaryCursor]):
+    return len(read_stm_entries(file))
 
 
 @keep_file_seek_position
-def quickcheck_stm_file(stmfile: BinaryIO, stmfilesize: int = None) -> bool:
+def quickcheck_stm_file(
+    stmfile: Union[BinaryIO, BinaryCursor], stmfilesize: int = None
+) -> bool:
     """quickly check whether stmfile is (very likely) a GHSStmContainer
 
     Checks for the following conditions:
@@ -50,32 +108,30 @@ def quickcheck_stm_file(stmfile: BinaryIO, stmfilesize: int = None) -> bool:
     - each offset is after the previous file, with a gap of no more than 15 bytes
     - the size of the final file reaches the end of the STM file
 
-    :param stmfile: an open file with its current read position at 0
+    :param stmfile: an open file or BinaryCursor with its current read position at 0
     :param stmfilesize: optional size of stmfile, helps determine things a little faster
     :return: True if we think stmfile is a GHSStmContainer, False otherwise.
         After return, file's current read position is back to what it was originally
     """
-    ...
+    with reading(stmfile) as cursor:
+        return _quickcheck_stm(cursor, stmfilesize)
+
+
+def _quickcheck_stm(cursor: BinaryCursor, stmfilesize: int = None) -> bool:
     if stmfilesize is None:
-        stmfile.seek(0, SEEK_END)
-        stmfilesize = stmfile.tell()
-        stmfile.seek(0)
+        stmfilesize = len(cursor)
+        cursor.seek(0)
     prev_size_end = None
 
     while True:
-        offset_data = stmfile.read(4)
-        if len(offset_data) < 4:
+        if not cursor.has(8):
             return False
-        offset = unpack("<I", offset_data)[0]
+        offset, size_raw = cursor.unpack(_entry_struct)
 
         # ensure all offsets are a multiple of 0x10
         if offset & 0xF:
             return False
 
-        size_data = stmfile.read(4)
-        if len(size_data) < 4:
-            return False
-        size_raw = unpack("<I", size_data)[0]
         is_final = size_raw & 0x80000000
         size = size_raw & 0x7FFFFFFF
 
@@ -6,14 +6,12 @@ no indication of whether a given texture file is a GHSTexImage or GHSTexImage2.
 
 Example of GHSTexImage2 can be found in FILE.STM at 28.stm/03.dat
 """
-from io import SEEK_CUR
+from functools import lru_cache
 from math import ceil
-from struct import unpack
-from typing import BinaryIO, Optional, Sequence, Union
+from struct import Struct
+from typing import BinaryIO, NamedTuple, Optional, Sequence, Union
 
-from PIL import Image
-
-from mymodules.common import is_eof, keep_file_seek_position
+from mymodules.common import BinaryCursor, is_eof, keep_file_seek_position, reading
 
 SeqIndexed = Sequence[int]
 SeqRGB = Sequence[tuple[int, int, int]]
@@ -49,6 +47,15 @@ palette_deswizzler = (
 )
 
 
+# pixfmt, palette_size, tex_index, unk1, unk2
+_texheader1_struct = Struct("<3I2H")
+# unk3, unk4, pixels_size, tex_offset, width, height
+_texheader2_struct = Struct("<2H2I2H")
+# last, pixels_are_swizzled, unk3, pixels_size, tex_offset, width, height
+_tex2header2_struct = Struct("<HBB2I2H")
+_u32x2_struct = Struct("<2I")
+
+
 class GHSTexUnknownPixFormat(ValueError):
     pass
 
@@ -57,9 +64,16 @@ class GHSTexExtraDataException(Exception):
     pass
 
 
-def read_and_check(file, size):
-    """read size bytes into file, and make sure that much data actually exists"""
-    return len(file.read(size)) == size
+class TexHeader(NamedTuple):
+    """what the headers of an image in a texture file say about it, see
+    read_tex_headers"""
+
+    pixfmt: str
+    width: int
+    height: int
+    palette_size: int  # number of colors, 0 if there's no palette
+    tex_offset: int
+    pixels_swizzled: bool
 
 
 class GHSTexImageSingle:
@@ -72,6 +86,8 @@ class GHSTexImageSingle:
         pixfmt: Optional[str] = None,
         tex_offset: int = 0,
         alpha128: bool = True,
+        pixels_swizzled: bool = False,
+        pixels_size: Optional[int] = None,
     ) -> None:
         self.width = width
         self.height = height
@@ -97,38 +113,41 @@ class GHSTexImageSingle:
 
         self.tex_offset = tex_offset
         self.alpha128 = alpha128
+        # whether the pixels were swizzled in the file they came from
+        self.pixels_swizzled = pixels_swizzled
+        # size of the pixel data in the file they came from, in bytes
+        self.pixels_size = pixels_size
 
     @classmethod
-    def from_ghstexfile(cls, file: BinaryIO) -> "GHSTexImageSingle":
-        # Account for that one texture file that ends in 16 extra 0xff's
-        bytes16 = file.read(16)
-        if is_eof(file) and bytes16 == b"\xff" * 16:
-            raise GHSTexExtraDataException
-        file.seek(-16, SEEK_CUR)
-
-        pixfmt_raw = unpack("<I", file.read(4))[0]
-        pixfmt = _pixfmtval_pixfmt.get(pixfmt_raw)
-        if pixfmt is None:
-            raise GHSTexUnknownPixFormat(
-                f"Unknown pixel format value {pixfmt_raw:#010x}"
+    def from_ghstexfile(
+        cls, file: Union[BinaryIO, BinaryCursor]
+    ) -> "GHSTexImageSingle":
+        with reading(file) as cursor:
+            # Account for that one texture file that ends in 16 extra 0xff's
+            if cursor.remaining == 16 and cursor.view[cursor.pos :] == b"\xff" * 16:
+                cursor.skip(16)
+                raise GHSTexExtraDataException
+
+            pixfmt_raw, palette_size, tex_index, unk1, unk2 = cursor.unpack(
+                _texheader1_struct
             )
+            pixfmt = _pixfmtval_pixfmt.get(pixfmt_raw)
+            if pixfmt is None:
+                raise GHSTexUnknownPixFormat(
+                    f"Unknown pixel format value {pixfmt_raw:#010x}"
+                )
 
-        palette_size = unpack("<I", file.read(4))[0]
-        tex_index = unpack("<I", file.read(4))[0]
-        unk1, unk2 = unpack("<2H", file.read(4))
-
-        if palette_size == 0:
-            palette = None
-        else:
-            palette_flat = unpack(f"<{palette_size}B", file.read(palette_size))
-            palette = list(chunks(palette_flat, 4))
+            if palette_size == 0:
+                palette = None
+            else:
+                palette_flat = tuple(cursor.read_view(palette_size))
+                palette = list(chunks(palette_flat, 4))
 
-        unk3, unk4 = unpack("<2H", file.read(4))
-        pixels_size = unpack("<I", file.read(4))[0]
-        tex_offset = unpack("<I", file.read(4))[0]
-        width, height = unpack("<2H", file.read(4))
+            unk3, unk4, pixels_size, tex_offset, width, height = cursor.unpack(
+                _texheader2_struct
+            )
 
-        pixels_raw = unpack(f"<{pixels_size}B", file.read(pixels_size))
+            pixels_raw = bytes(cursor.read_view(pixels_size))
         if pixfmt == "i4":
             pixels = list(from_nibbles(pixels_raw))
         else:  # elif pixfmt == "i8":
@@ -143,39 +162,48 @@ class GHSTexImageSingle:
             pixfmt=pixfmt,
             tex_offset=tex_offset,
             alpha128=True,
+            pixels_size=pixels_size,
         )
 
     @classmethod
-    def from_ghstex2file(cls, file: BinaryIO) -> "GHSTexImageSingle":
-        pixfmt_raw = unpack("<I", file.read(4))[0]
-        pixfmt = _pixfmtval_pixfmt.get(pixfmt_raw)
-        if pixfmt is None:
-            raise GHSTexUnknownPixFormat(
-                f"Unknown pixel format value {pixfmt_raw:#010x}"
+    def from_ghstex2file(
+        cls, file: Union[BinaryIO, BinaryCursor]
+    ) -> "GHSTexImageSingle":
+        with reading(file) as cursor:
+            pixfmt_raw, palette_size, tex_index, unk1, unk2 = cursor.unpack(
+                _texheader1_struct
             )
+            pixfmt = _pixfmtval_pixfmt.get(pixfmt_raw)
+            if pixfmt is None:
+                raise GHSTexUnknownPixFormat(
+                    f"Unknown pixel format value {pixfmt_raw:#010x}"
+                )
 
-        palette_size = unpack("<I", file.read(4))[0]
-        tex_index = unpack("<I", file.read(4))[0]
-        unk1, unk2 = unpack("<2H", file.read(4))
+            cursor.skip(128)
 
-        file.seek(128, SEEK_CUR)
+            if palette_size == 0:
+                palette = None
+            else:
+                palette_flat = tuple(cursor.read_view(palette_size))
+                palette = list(chunks(palette_flat, 4))
 
-        if palette_size == 0:
-            palette = None
-        else:
-            palette_flat = unpack(f"<{palette_size}B", file.read(palette_size))
-            palette = list(chunks(palette_flat, 4))
+            cursor.skip(32)
 
-        file.seek(32, SEEK_CUR)
+            (
+                last,
+                pixels_are_swizzled,
+                unk3,
+                pixels_size,
+                tex_offset,
+                width,
+                height,
+            ) = cursor.unpack(_tex2header2_struct)
 
-        last, pixels_are_swizzled, unk3 = unpack("<HBB", file.read(4))
-        pixels_size = unpack("<I", file.read(4))[0]
-        tex_offset = unpack("<I", file.read(4))[0]
-        width, height = unpack("<2H", file.read(4))
+            cursor.skip(128)
 
-        file.seek(128, SEEK_CUR)
+            pixels_raw = bytes(cursor.read_view(pixels_size))
 
-        pixels_raw = unpack(f"<{pixels_size}B", file.read(pixels_size))
+            cursor.skip(32)
         if pixfmt == "i4":
             pixels = list(from_nibbles(pixels_raw))
             if pixels_are_swizzled:
@@ -184,8 +212,6 @@ class GHSTexImageSingle:
             palette = deswizzle_palette(palette)
             pixels = pixels_raw
 
-        file.seek(32, SEEK_CUR)
-
         return cls(
             width,
             height,
@@ -194,6 +220,8 @@ class GHSTexImageSingle:
             pixfmt=pixfmt,
             tex_offset=tex_offset,
             alpha128=True,
+            pixels_swizzled=bool(pixfmt == "i4" and pixels_are_swizzled),
+            pixels_size=pixels_size,
         )
 
     @property
@@ -205,6 +233,10 @@ class GHSTexImageSingle:
         return not self.alpha128
 
     def write_to_png(self, file: BinaryIO) -> None:
+        # imported here rather than at the top, so that Pillow is only needed (and
+        # only spends time being imported) once a texture is actually converted
+        from PIL import Image
+
         if self.palette is not None:
             image = Image.new("RGBA", self.size)
             ghs_palette = self.palette255
@@ -215,6 +247,45 @@ class GHSTexImageSingle:
             image.putdata(self.pixels255)
         image.save(file, format="png")
 
+    def encode_pixels(self, pixels_rgba: SeqRGBA) -> bytes:
+        """return the raw pixel data for an image of RGBA colors, using this texture's
+        palette, in the same format as this texture's own pixels in the file
+
+        Where a pixel's color is still the same as this texture's, its palette index
+        is kept as-is, so unedited pixels are encoded exactly as they were.
+
+        :param pixels_rgba: (r, g, b, a) colors with 255-based alpha, such as read
+            from a .png written by write_to_png
+        :raises ValueError: if the size doesn't match, or a color isn't in the palette
+        """
+        if self.palette is None:
+            raise ValueError("Can only encode pixels of textures that have a palette")
+        if len(pixels_rgba) != self.width * self.height:
+            raise ValueError(
+                f"Expected {self.width}x{self.height} pixels, got {len(pixels_rgba)}"
+            )
+        palette = [tuple(color) for color in self.palette255]
+        color_indices = {}
+        for i, color in enumerate(palette):
+            color_indices.setdefault(color, i)
+        indices = []
+        for pixel_i, (old_i, color) in enumerate(zip(self.pixels, pixels_rgba)):
+            color = tuple(color)
+            if palette[old_i] == color:
+                indices.append(old_i)
+                continue
+            new_i = color_indices.get(color)
+            if new_i is None:
+                x, y = pixel_i % self.width, pixel_i // self.width
+                raise ValueError(f"Color {color} at ({x}, {y}) isn't in the palette")
+            indices.append(new_i)
+
+        if self.pixfmt == "i4":
+            if self.pixels_swizzled:
+                indices = swizzle_pixels(indices)
+            return bytes(lo | (hi << 4) for lo, hi in chunks(indices, 2, [0]))
+        return bytes(indices)
+
     @property
     def palette255(self) -> Optional[SeqRGBA]:
         """palette with 255-based alpha"""
@@ -251,77 +322,68 @@ def quickcheck_tex_file(file) -> bool:
 
     Works by checking if expected header/palette/pixel values match the file size
 
-    :param file: an open file with its current read position at 0
+    :param file: an open file or BinaryCursor with its current read position at 0
     :return: True if we think file is a Gregory Horror Show texture, False otherwise.
         After return, file's current read position is back to what it was originally
     """
-    texcount = 0
-    while True:
-        header1_b = file.read(4)
-        if header1_b not in (b"\x08\0\0\0", b"\x09\0\0\0"):
-            # Account for that one texture that ends in 4 extra 0xffffffff's
-            if header1_b == b"\xff\xff\xff\xff":
-                read_and_check(file, 12)
-                if is_eof(file) and texcount > 1:
-                    return True
-                else:
-                    return False
-            else:
+    with reading(file) as cursor:
+        texcount = 0
+        while True:
+            if not cursor.has(4):
+                return False
+            pixfmt_raw = cursor.u32()
+            if pixfmt_raw not in (8, 9):
+                # Account for that one texture that ends in 4 extra 0xffffffff's
+                # (followed by up to 12 more bytes)
+                if pixfmt_raw == 0xFFFFFFFF:
+                    return cursor.remaining <= 12 and texcount > 1
                 return False
 
-        texcount += 1
-        palette_size_b = file.read(4)
-        if len(palette_size_b) < 4:
-            return False
-        palette_size = unpack("<I", palette_size_b)[0]
-        if not read_and_check(file, 8 + palette_size):
-            return False
-        if not read_and_check(file, 4):
-            return False
-        pixels_size_b = file.read(4)
-        if len(pixels_size_b) < 4:
-            return False
-        pixels_size = unpack("<I", pixels_size_b)[0]
-        if pixels_size == 0:
-            return False
-        if not read_and_check(file, 8 + pixels_size):
-            return False
-        # now at beginning of next texture or end of file
-        if is_eof(file):
-            return True
+            texcount += 1
+            if not cursor.has(4):
+                return False
+            palette_size = cursor.u32()
+            if not cursor.has(8 + palette_size + 8):
+                return False
+            cursor.skip(8 + palette_size + 4)
+            pixels_size = cursor.u32()
+            if pixels_size == 0:
+                return False
+            if not cursor.has(8 + pixels_size):
+                return False
+            cursor.skip(8 + pixels_size)
+            # now at beginning of next texture or end of file
+            if cursor.eof:
+                return True
 
 
 @keep_file_seek_position
 def quickcheck_tex2_file(file) -> bool:
     """quickly check whether file is (very likely) a GHSTexImage2
 
-    :param file: an open file with its current read position at 0
+    :param file: an open file or BinaryCursor with its current read position at 0
     :return: True if we think file is a Gregory Horror Show texture, False otherwise.
         After return, file's current read position is back to what it was originally
     """
-    while True:
-        header1_b = file.read(4)
-        if header1_b not in (b"\x08\0\0\0", b"\x09\0\0\0"):
-            return False
-        palette_size_b = file.read(4)
-        if len(palette_size_b) < 4:
-            return False
-        palette_size = unpack("<I", palette_size_b)[0]
-        if not read_and_check(file, 8 + 128 + palette_size + 32):
-            return False
-        if not read_and_check(file, 4):
-            return False
-        pixels_size_b = file.read(4)
-        if len(pixels_size_b) < 4:
-            return False
-        pixels_size = unpack("<I", pixels_size_b)[0]
-        if pixels_size == 0:
-            return False
-        if not read_and_check(file, 8 + 128 + pixels_size + 32):
-            return False
-        # now at beginning of next texture or end of file
-        if is_eof(file):
-            return True
+    with reading(file) as cursor:
+        while True:
+            if not cursor.has(8):
+                return False
+            pixfmt_raw, palette_size = cursor.unpack(_u32x2_struct)
+            if pixfmt_raw not in (8, 9):
+                return False
+            if not cursor.has(8 + 128 + palette_size + 32 + 8):
+                return False
+            cursor.skip(8 + 128 + palette_size + 32 + 4)
+            pixels_size = cursor.u32()
+            if pixels_size == 0:
+                return False
+            if not cursor.has(8 + 128 + pixels_size + 32):
+                return False
+            cursor.skip(8 + 128 + pixels_size + 32)
+            # now at beginning of next texture or end of file
+            if cursor.eof:
+                return True
 
 
 def chunks(seq, n, fillseq=None):
@@ -443,6 +505,141 @@ def deswizzle_pixels(pixels_swizzled: SeqIndexed) -> SeqIndexed:
     return pixels_deswizzled
 
 
+@lru_cache(maxsize=1)
+def _swizzle_order() -> list[int]:
+    # deswizzling the pixel numbers themselves tells where each one ends up
+    return deswizzle_pixels(range(65536))
+
+
+def swizzle_pixels(pixels_deswizzled: SeqIndexed) -> SeqIndexed:
+    """the opposite of deswizzle_pixels"""
+    if len(pixels_deswizzled) != 65536:
+        raise ValueError("Can only swizzle pixels of length 65536 (256x256)")
+    pixels_swizzled = [0] * 65536
+    for pixel, swizzled_i in zip(pixels_deswizzled, _swizzle_order()):
+        pixels_swizzled[swizzled_i] = pixel
+    return pixels_swizzled
+
+
+def read_tex_images(file, tex2: bool) -> list[GHSTexImageSingle]:
+    """read all images of a texture file, skipping any extra data between them
+
+    :param file: open file or BinaryCursor positioned at the start of the texture
+    :param tex2: True if file is a GHSTexImage2
+    """
+    if tex2:
+        read_tex = GHSTexImageSingle.from_ghstex2file
+    else:
+        read_tex = GHSTexImageSingle.from_ghstexfile
+    ghstexs = []
+    while not is_eof(file):
+        try:
+            ghstexs.append(read_tex(file))
+        except GHSTexExtraDataException:
+            pass
+    return ghstexs
+
+
+def read_tex_headers(file, tex2: bool) -> list[TexHeader]:
+    """read the headers of all images of a texture file, without reading their
+    palettes or pixels
+
+    :param file: open file or BinaryCursor positioned at the start of the texture
+    :param tex2: True if file is a GHSTexImage2
+    :raises GHSTexUnknownPixFormat: if an image has an unknown pixel format
+    """
+    headers = []
+    with reading(file) as cursor:
+        while not cursor.eof:
+            if not tex2 and cursor.remaining == 16:
+                if cursor.view[cursor.pos :] == b"\xff" * 16:  # see from_ghstexfile
+                    cursor.skip(16)
+                    continue
+            pixfmt_raw, palette_size = cursor.unpack(_texheader1_struct)[:2]
+            pixfmt = _pixfmtval_pixfmt.get(pixfmt_raw)
+            if pixfmt is None:
+                raise GHSTexUnknownPixFormat(
+                    f"Unknown pixel format value {pixfmt_raw:#010x}"
+                )
+            if tex2:
+                cursor.skip(128 + palette_size + 32)
+                (
+                    _,
+                    pixels_are_swizzled,
+                    _,
+                    pixels_size,
+                    tex_offset,
+                    width,
+                    height,
+                ) = cursor.unpack(_tex2header2_struct)
+                cursor.skip(128 + pixels_size + 32)
+            else:
+                cursor.skip(palette_size)
+                _, _, pixels_size, tex_offset, width, height = cursor.unpack(
+                    _texheader2_struct
+                )
+                pixels_are_swizzled = False
+                cursor.skip(pixels_size)
+            headers.append(
+                TexHeader(
+                    pixfmt,
+                    width,
+                    height,
+                    palette_size // 4,
+                    tex_offset,
+                    bool(pixfmt == "i4" and pixels_are_swizzled),
+                )
+            )
+    return headers
+
+
+def reencode_tex(texdata: bytes, tex2: bool, replacements: dict[int, SeqRGBA]) -> bytes:
+    """return texdata with some of its images' pixels replaced
+
+    Only the pixel data changes, the images' palettes, sizes and everything else stay
+    the same.
+
+    :param texdata: a texture file's data, containing one or more images
+    :param tex2: True if texdata is a GHSTexImage2
+    :param replacements: image number (in order, as numbered by the unpacker):
+        new RGBA pixels, see GHSTexImageSingle.encode_pixels
+    :raises ValueError: if an image can't be encoded, or its encoded pixels aren't
+        the size of the pixel data they replace
+    """
+    if tex2:
+        read_tex = GHSTexImageSingle.from_ghstex2file
+    else:
+        read_tex = GHSTexImageSingle.from_ghstexfile
+    out = bytearray(texdata)
+    cursor = BinaryCursor(texdata)
+    tex_i = 0
+    while not cursor.eof:
+        try:
+            ghstex = read_tex(cursor)
+        except GHSTexExtraDataException:
+            continue
+        if tex_i in replacements:
+            raw = ghstex.encode_pixels(replacements[tex_i])
+            if len(raw) != ghstex.pixels_size:
+                raise ValueError(
+                    f"image {tex_i} encodes to {len(raw)} bytes of pixels, but has "
+                    f"{ghstex.pixels_size}"
+                )
+            # pixels are at the end of each image, followed by 32 bytes in a tex2
+            pixels_end = cursor.pos - 32 if tex2 else cursor.pos
+            out[pixels_end - ghstex.pixels_size : pixels_end] = raw
+        tex_i += 1
+    return bytes(out)
+
+
+def read_png_rgba(file) -> list[tuple[int, int, int, int]]:
+    """return the pixels of a .png file as RGBA colors, requires Pillow"""
+    from PIL import Image
+
+    with Image.open(file) as image:
+        return list(image.convert("RGBA").getdata())
+
+
 def deswizzle_palette(swizzled_palette: SeqRGBA) -> SeqRGBA:
     if len(swizzled_palette) != 256:
         raise ValueError("Can only deswizzle palette of length 256")
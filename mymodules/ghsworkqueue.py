@@ -0,0 +1,166 @@
+"""Work queue for traversing nested Gregory Horror Show containers
+
+Instead of recursing into each container (.stm inside .sli inside .stm...), containers
+are expanded into WorkItems which are pushed onto a WorkQueue. The order in which
+items are popped back off is decided by the queue's scheduling policy.
+"""
+import heapq
+import mmap
+from abc import ABC, abstractmethod
+from collections import deque
+from itertools import count
+from typing import Iterable, NamedTuple, Optional, Union
+
+
+class FileSlice(NamedTuple):
+    """reference to size bytes at offset in the file at path, read only when needed"""
+
+    path: str
+    offset: int
+    size: int
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            return file.read(self.size)
+
+
+Source = Union[bytes, FileSlice, mmap.mmap]
+
+
+def subsource(source: Source, offset: int, size: int) -> Source:
+    """return the part of source that is size bytes long starting at offset
+
+    If source is a FileSlice, the returned part is also a FileSlice. Otherwise it is a
+    copy (even of an mmap), so that source itself can be released while the part is still in use.
+    """
+    if isinstance(source, FileSlice):
+        return FileSlice(source.path, source.offset + offset, size)
+    return bytes(source[offset : offset + size])
+
+
+class WorkItem(NamedTuple):
+    """a single container member waiting to be unpacked
+
+    vdir: virtual path of the directory the item is unpacked into, "" for the root
+    idx: index of the item within its parent container, None for the root container
+    source: the item's data, an mmap of it or a FileSlice reference to it. An mmap
+        stays readable even if the file it maps is removed (such as an evicted .sli
+        cache entry), but can't be sent to another process
+    from_sli: True if source was decompressed from a .sli
+    depth: nesting level
+    """
+
+    vdir: str
+    idx: Optional[int]
+    source: Source
+    from_sli: bool = False
+    depth: int = 0
+
+    @property
+    def size(self) -> int:
+        if isinstance(self.source, FileSlice):
+            return self.source.size
+        return len(self.source)
+
+    @property
+    def key(self) -> str:
+        """identifies the item by its position, which is the same in every unpack"""
+        if self.idx is None:
+            return self.vdir
+        dot_sli = ".sli" if self.from_sli else ""
+        name = f"{self.idx:03x}{dot_sli}"
+        return f"{self.vdir}/{name}" if self.vdir else name
+
+    def load(self) -> bytes:
+        if isinstance(self.source, FileSlice):
+            return self.source.read()
+        if isinstance(self.source, mmap.mmap):
+            return self.source[:]
+        return self.source
+
+
+class WorkQueue(ABC):
+    """base class for work queues, subclasses decide the scheduling policy
+
+    Children of a single item are passed to extend() in container order.
+    """
+
+    @abstractmethod
+    def push(self, item: WorkItem) -> None:
+        pass
+
+    @abstractmethod
+    def pop(self) -> WorkItem:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def extend(self, items: Iterable[WorkItem]) -> None:
+        for item in items:
+            self.push(item)
+
+
+class DepthFirstQueue(WorkQueue):
+    """finish each container before moving on to the next one (same order as FILE.STM)
+
+    Keeps the fewest buffers alive at once.
+    """
+
+    def __init__(self) -> None:
+        self._stack = []
+
+    def push(self, item: WorkItem) -> None:
+        self._stack.append(item)
+
+    def pop(self) -> WorkItem:
+        return self._stack.pop()
+
+    def __len__(self) -> int:
+        return len(self._stack)
+
+    def extend(self, items: Iterable[WorkItem]) -> None:
+        # reversed, so that the first child is popped first
+        self._stack.extend(reversed(list(items)))
+
+
+class BreadthFirstQueue(WorkQueue):
+    """finish each nesting level before moving on to the next one"""
+
+    def __init__(self) -> None:
+        self._deque = deque()
+
+    def push(self, item: WorkItem) -> None:
+        self._deque.append(item)
+
+    def pop(self) -> WorkItem:
+        return self._deque.popleft()
+
+    def __len__(self) -> int:
+        return len(self._deque)
+
+
+class LargestFirstQueue(WorkQueue):
+    """always pop the largest waiting item, so big items don't straggle at the end"""
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._counter = count()  # tiebreaker, keeps container order for equal sizes
+
+    def push(self, item: WorkItem) -> None:
+        heapq.heappush(self._heap, (-item.size, next(self._counter), item))
+
+    def pop(self) -> WorkItem:
+        return heapq.heappop(self._heap)[2]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+SCHEDULING_POLICIES = {
+    "depth": DepthFirstQueue,
+    "breadth": BreadthFirstQueue,
+    "largest": LargestFirstQueue,
+}